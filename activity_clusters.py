@@ -0,0 +1,387 @@
+import hashlib
+import json
+import random
+import re
+import sqlite3
+
+MINHASH_BANDS = 20
+MINHASH_ROWS = 3  # Names with trigram Jaccard 0.5 become candidates ~93% of the time, 0.3 ~42%
+MAX_HASH = (1 << 61) - 1  # Mersenne prime for the universal hash family
+CLUSTER_INDEX_FILE = "activity_clusters.db"
+# Candidates with a lower trigram Jaccard are dropped before difflib scoring
+MIN_JACCARD = 0.2
+BAND_KEY_VERSION = 1  # Bumped whenever the stored band key format changes; old keys are recomputed
+
+
+def normalize_name(name):
+    return " ".join(re.findall(r"\w+", str(name).lower()))
+
+
+def name_grams(name, size=3):
+    padded = f" {name} "
+    return {padded[i:i + size] for i in range(max(1, len(padded) - size + 1))}
+
+
+class MinHasher:
+    """MinHash signatures over character n-grams.
+
+    Each distinct gram is hashed once and its permuted values are memoized, so a signature is
+    an element-wise min over precomputed tuples instead of hashes * grams Python operations.
+    """
+
+    def __init__(self, num_hashes=MINHASH_BANDS * MINHASH_ROWS, seed=1):
+        rng = random.Random(seed)
+        self.permutations = [(rng.randrange(1, MAX_HASH), rng.randrange(MAX_HASH)) for _ in range(num_hashes)]
+        self.gram_values = {}
+
+    def _values(self, gram):
+        values = self.gram_values.get(gram)
+        if values is None:
+            base = int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "big")
+            values = self.gram_values[gram] = tuple((a * base + b) % MAX_HASH for a, b in self.permutations)
+        return values
+
+    def signature(self, grams):
+        return tuple(map(min, zip(*(self._values(gram) for gram in grams))))
+
+
+def band_keys(signature, bands=MINHASH_BANDS, rows=MINHASH_ROWS):
+    return [(band, signature[band * rows:(band + 1) * rows]) for band in range(bands)]
+
+
+def band_digest(band, rows):
+    """Band key that stays the same across processes and Python versions, unlike hash()."""
+    data = b"".join(value.to_bytes(8, "big") for value in rows)
+    return f"{band}:{hashlib.blake2b(data, digest_size=8).hexdigest()}"
+
+
+class UnionFind:
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, item):
+        parent = self.parent.setdefault(item, item)
+        if parent != item:
+            parent = self.parent[item] = self.find(parent)
+        return parent
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            # Keep the smallest id as the root so cluster order follows input order
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+
+def grams_close(grams1, grams2, min_jaccard=MIN_JACCARD):
+    shared = len(grams1 & grams2)
+    return shared >= min_jaccard * (len(grams1) + len(grams2) - shared)
+
+
+def candidate_name_pairs(names, hasher=None, min_jaccard=MIN_JACCARD):
+    """Yields pairs of indices into `names` that share a MinHash LSH band and whose trigram sets
+    have a Jaccard similarity of at least `min_jaccard`."""
+    hasher = hasher or MinHasher()
+    grams = [name_grams(name) for name in names]
+    keys = [band_keys(hasher.signature(name_grams)) for name_grams in grams]
+    buckets = {}
+    for index, name_keys in enumerate(keys):
+        for key in name_keys:
+            buckets.setdefault(key, []).append(index)
+    for first, name_keys in enumerate(keys):
+        first_grams = grams[first]
+        for second in set().union(*(buckets[key] for key in name_keys)):
+            if second > first and grams_close(first_grams, grams[second], min_jaccard):
+                yield first, second
+
+
+class DuplicateJudge:
+    """Decides whether two distinct names (with their descriptions) are duplicates.
+
+    `names_similar(a, b)` returns True, False or None; None means the names are duplicates
+    if `descriptions_similar` holds for any pair of their non-empty descriptions. Pairs are
+    always judged in sorted order and description verdicts are memoized, so a decision does
+    not depend on which side was seen first.
+    """
+
+    def __init__(self, names_similar, descriptions_similar):
+        self.names_similar = names_similar
+        self.descriptions_similar = descriptions_similar
+        self.description_verdicts = {}
+
+    def _descriptions_match(self, description1, description2):
+        key = (min(description1, description2), max(description1, description2))
+        if key not in self.description_verdicts:
+            self.description_verdicts[key] = key[0] == key[1] or self.descriptions_similar(*key)
+        return self.description_verdicts[key]
+
+    def name_verdict(self, name1, name2):
+        return self.names_similar(min(name1, name2), max(name1, name2))
+
+    def descriptions_match(self, descriptions1, descriptions2):
+        return any(
+            self._descriptions_match(description1, description2)
+            for description1 in descriptions1 if description1
+            for description2 in descriptions2 if description2
+        )
+
+    def duplicates(self, name1, descriptions1, name2, descriptions2):
+        verdict = self.name_verdict(name1, name2)
+        if verdict is None:
+            verdict = self.descriptions_match(descriptions1, descriptions2)
+        return verdict
+
+
+def name_components(descriptions_by_name, judge):
+    """Groups names into connected components of duplicate pairs; returns a list of name lists."""
+    names = list(descriptions_by_name)
+    clusters = UnionFind()
+    for index in range(len(names)):
+        clusters.find(index)
+    for first, second in candidate_name_pairs(names):
+        if clusters.find(first) == clusters.find(second):
+            continue
+        if judge.duplicates(names[first], descriptions_by_name[names[first]],
+                            names[second], descriptions_by_name[names[second]]):
+            clusters.union(first, second)
+    components = {}
+    for index, name in enumerate(names):
+        components.setdefault(clusters.find(index), []).append(name)
+    return list(components.values())
+
+
+def cluster_activities(activities, names_similar, descriptions_similar):
+    """Groups activities that are duplicates of each other; returns lists of indices in input order.
+
+    Activities with the same normalized name are one cluster up front, and MinHash LSH over
+    the distinct names finds candidate name pairs to check with a `DuplicateJudge`.
+    """
+    descriptions_by_name = {}
+    for activity in activities:
+        name = normalize_name(activity.get("name") or "")
+        if name:
+            descriptions_by_name.setdefault(name, set()).add(activity.get("description") or "")
+    component_of = {}
+    for component, names in enumerate(name_components(descriptions_by_name,
+                                                       DuplicateJudge(names_similar, descriptions_similar))):
+        for name in names:
+            component_of[name] = component
+
+    groups = {}
+    for index, activity in enumerate(activities):
+        name = normalize_name(activity.get("name") or "")
+        groups.setdefault(component_of[name] if name else ("unnamed", index), []).append(index)
+    return list(groups.values())
+
+
+def activity_key(activity):
+    """Content hash identifying an activity across runs."""
+    return hashlib.sha1(json.dumps(activity, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class ClusterIndex:
+    """Duplicate clusters kept in SQLite between dedupe runs.
+
+    Stores every indexed activity (by content hash) with its normalized name and description,
+    each distinct name's cluster and LSH band keys, and the merged output of each cluster.
+    `update` diffs the current activities against the index, so LSH lookups and similarity
+    checks only run for added or removed activities; clusters are the connected components
+    of duplicate name pairs, exactly as `cluster_activities` computes them from scratch.
+    """
+
+    def __init__(self, path=CLUSTER_INDEX_FILE, names_similar=None, descriptions_similar=None):
+        self.path = path
+        self.judge = DuplicateJudge(names_similar, descriptions_similar)
+        self.hasher = MinHasher()
+        self.pending_changed = set()  # Clusters changed by `add` since the last `update`
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(
+            "CREATE TABLE IF NOT EXISTS activities ("
+            "key TEXT PRIMARY KEY, name TEXT NOT NULL, description TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS activities_name ON activities (name);"
+            "CREATE TABLE IF NOT EXISTS names (name TEXT PRIMARY KEY, cluster INTEGER NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS names_cluster ON names (cluster);"
+            "CREATE TABLE IF NOT EXISTS name_bands (band TEXT NOT NULL, name TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS name_bands_band ON name_bands (band);"
+            "CREATE INDEX IF NOT EXISTS name_bands_name ON name_bands (name);"
+            "CREATE TABLE IF NOT EXISTS merged (cluster INTEGER PRIMARY KEY, members TEXT NOT NULL, data TEXT NOT NULL);"
+        )
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != BAND_KEY_VERSION:
+            # Band keys written in another format would never match new ones
+            names = [row[0] for row in self.conn.execute("SELECT name FROM names")]
+            self.conn.execute("DELETE FROM name_bands")
+            self.conn.executemany("INSERT INTO name_bands (band, name) VALUES (?, ?)",
+                                  [(band, name) for name in names for band in self._bands(name)])
+            self.conn.execute(f"PRAGMA user_version = {BAND_KEY_VERSION}")
+        self.conn.commit()
+
+    def _bands(self, name):
+        return [band_digest(band, rows) for band, rows in band_keys(self.hasher.signature(name_grams(name)))]
+
+    def _next_cluster(self):
+        return (self.conn.execute("SELECT MAX(cluster) FROM names").fetchone()[0] or 0) + 1
+
+    def _cluster(self, name):
+        return self.conn.execute("SELECT cluster FROM names WHERE name = ?", (name,)).fetchone()[0]
+
+    def _descriptions(self, name):
+        return {row[0] for row in self.conn.execute("SELECT DISTINCT description FROM activities WHERE name = ?",
+                                                    (name,))}
+
+    def _add_name(self, name, cluster):
+        self.conn.execute("INSERT INTO names (name, cluster) VALUES (?, ?)", (name, cluster))
+        self.conn.executemany("INSERT INTO name_bands (band, name) VALUES (?, ?)",
+                              [(band, name) for band in self._bands(name)])
+
+    def _candidates(self, name):
+        bands = self._bands(name)
+        rows = self.conn.execute(
+            f"SELECT DISTINCT name FROM name_bands WHERE band IN ({','.join('?' * len(bands))})", bands
+        )
+        grams = name_grams(name)
+        return [row[0] for row in rows if row[0] != name and grams_close(grams, name_grams(row[0]))]
+
+    def _merge_clusters(self, cluster1, cluster2, changed):
+        keep, drop = min(cluster1, cluster2), max(cluster1, cluster2)
+        self.conn.execute("UPDATE names SET cluster = ? WHERE cluster = ?", (keep, drop))
+        changed.discard(drop)
+        changed.add(keep)
+        return keep
+
+    def _build(self, records, changed):
+        """Indexes everything at once when the index is empty; much faster than one name at a time."""
+        descriptions_by_name = {}
+        for key, name, description in records:
+            descriptions_by_name.setdefault(name, set()).add(description)
+        self.conn.executemany("INSERT INTO activities (key, name, description) VALUES (?, ?, ?)", records)
+        for cluster, names in enumerate(name_components(descriptions_by_name, self.judge), 1):
+            for name in names:
+                self._add_name(name, cluster)
+            changed.add(cluster)
+
+    def _split(self, cluster, changed):
+        """Re-derives the components of a cluster that lost activities; it may fall apart."""
+        names = [row[0] for row in self.conn.execute("SELECT name FROM names WHERE cluster = ?", (cluster,))]
+        components = name_components({name: self._descriptions(name) for name in names}, self.judge)
+        next_cluster = self._next_cluster()
+        for offset, component in enumerate(components[1:]):
+            self.conn.executemany("UPDATE names SET cluster = ? WHERE name = ?",
+                                  [(next_cluster + offset, name) for name in component])
+            changed.add(next_cluster + offset)
+        changed.add(cluster)
+
+    def _link(self, name, descriptions, changed):
+        """Joins `name`'s cluster with every candidate name that is a duplicate given `descriptions`."""
+        cluster = self._cluster(name)
+        for other in self._candidates(name):
+            other_cluster = self._cluster(other)
+            if other_cluster == cluster:
+                continue
+            verdict = self.judge.name_verdict(name, other)
+            if verdict is None:
+                verdict = self.judge.descriptions_match(descriptions, self._descriptions(other))
+            if verdict:
+                cluster = self._merge_clusters(cluster, other_cluster, changed)
+
+    def _insert(self, added, changed):
+        """Indexes (key, name, description) records that are not in the index yet."""
+        known_descriptions = {name: self._descriptions(name) for _, name, _ in added}
+        new_descriptions = {}
+        for key, name, description in added:
+            if description not in known_descriptions[name]:
+                new_descriptions.setdefault(name, set()).add(description)
+            self.conn.execute("INSERT INTO activities (key, name, description) VALUES (?, ?, ?)",
+                              (key, name, description))
+            if not self.conn.execute("SELECT 1 FROM names WHERE name = ?", (name,)).fetchone():
+                cluster = self._next_cluster()
+                self._add_name(name, cluster)
+                changed.add(cluster)
+        for name, descriptions in new_descriptions.items():
+            # New names compare all their descriptions; known names only the ones they gained
+            self._link(name, descriptions, changed)
+
+    def add(self, activities):
+        """Indexes activities ahead of `update`, e.g. while the rest are still being extracted.
+
+        Nothing is removed; the next `update` still diffs against the complete list, and
+        reports the clusters changed here as changed.
+        """
+        records = {}
+        for activity in activities:
+            name = normalize_name(activity.get("name") or "")
+            if name:
+                key = activity_key(activity)
+                records[key] = (key, name, activity.get("description") or "")
+        if not records:
+            return
+        keys = list(records)
+        indexed = {row[0] for row in self.conn.execute(
+            f"SELECT key FROM activities WHERE key IN ({','.join('?' * len(keys))})", keys)}
+        added = [record for key, record in records.items() if key not in indexed]
+        if not self.conn.execute("SELECT 1 FROM activities LIMIT 1").fetchone():
+            self._build(added, self.pending_changed)
+        else:
+            self._insert(added, self.pending_changed)
+        self.conn.commit()
+
+    def update(self, activities):
+        """Brings the index in line with `activities`.
+
+        Returns (groups, keys, changed): groups is a list of (cluster, indices into
+        `activities`) in order of first appearance, with cluster None for unnamed activities,
+        which are never merged; keys are the activities' content hashes (None when unnamed);
+        changed is the set of clusters whose membership changed.
+        """
+        keys, records = [], {}
+        for activity in activities:
+            name = normalize_name(activity.get("name") or "")
+            key = activity_key(activity) if name else None
+            keys.append(key)
+            if key:
+                records[key] = (key, name, activity.get("description") or "")
+
+        changed, self.pending_changed = self.pending_changed, set()
+        indexed = {row[0] for row in self.conn.execute("SELECT key FROM activities")}
+        if not indexed:
+            self._build(list(records.values()), changed)
+        else:
+            removed = indexed - records.keys()
+            added = [records[key] for key in records.keys() - indexed]
+
+            dirty = set()
+            for key in removed:
+                name = self.conn.execute("SELECT name FROM activities WHERE key = ?", (key,)).fetchone()[0]
+                self.conn.execute("DELETE FROM activities WHERE key = ?", (key,))
+                dirty.add(self._cluster(name))
+                if not self.conn.execute("SELECT 1 FROM activities WHERE name = ?", (name,)).fetchone():
+                    self.conn.execute("DELETE FROM names WHERE name = ?", (name,))
+                    self.conn.execute("DELETE FROM name_bands WHERE name = ?", (name,))
+            for cluster in dirty:
+                self._split(cluster, changed)
+
+            self._insert(added, changed)
+
+        cluster_of = dict(self.conn.execute("SELECT name, cluster FROM names"))
+        groups = {}
+        for index, key in enumerate(keys):
+            group = cluster_of[records[key][1]] if key else ("unnamed", index)
+            groups.setdefault(group, []).append(index)
+        self.conn.execute("DELETE FROM merged WHERE cluster NOT IN (SELECT cluster FROM names)")
+        self.conn.commit()
+        return [(group if isinstance(group, int) else None, indices) for group, indices in groups.items()], keys, changed
+
+    def merged(self, cluster, member_keys):
+        """The stored merge of `cluster` if it was made from exactly `member_keys`, else None."""
+        row = self.conn.execute("SELECT members, data FROM merged WHERE cluster = ?", (cluster,)).fetchone()
+        if row and json.loads(row[0]) == member_keys:
+            return json.loads(row[1])
+        return None
+
+    def save_merged(self, cluster, member_keys, item):
+        self.conn.execute("INSERT OR REPLACE INTO merged (cluster, members, data) VALUES (?, ?, ?)",
+                          (cluster, json.dumps(member_keys), json.dumps(item, ensure_ascii=False)))
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
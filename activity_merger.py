@@ -1,60 +1,293 @@
+import argparse
+import difflib
 import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+import time
+from urllib.parse import urlparse
+from geo import EARTH_RADIUS, distance_meters
+import metrics
+from metrics import METRICS
+from place_store import PlaceStore
 
+MATCH_TOLERANCE = float(os.getenv("MATCH_TOLERANCE", "50"))  # Meters between an activity and its place
+MIN_CELL_SIZE = 1.0  # Meters; grid cells never shrink below this, so a tolerance of 0 matches exact coordinates
 
-def merge_activities_with_places():
+
+def website_host(url):
+    host = urlparse(url or "").netloc.lower()
+    return host[4:] if host.startswith("www.") else host
+
+
+class PlaceIndex:
+    """Looks up places by place_id, or by location within `tolerance` meters.
+
+    Places are bucketed on a lat/lng grid with cells at least `tolerance` wide, so a
+    location lookup only measures the places in the 3x3 cells around it. A tolerance of 0
+    only matches places at exactly the activity's coordinates.
+    """
+
+    def __init__(self, places, tolerance=MATCH_TOLERANCE):
+        if tolerance < 0:
+            raise ValueError(f"Match tolerance must be 0 or more meters, got {tolerance}")
+        self.tolerance = tolerance
+        # Cell height in degrees of latitude
+        self.cell = math.degrees(max(tolerance, MIN_CELL_SIZE) / EARTH_RADIUS)
+        self.by_id = {}
+        self.cells = {}
+        for place in places:
+            if place.get("place_id"):
+                self.by_id[place["place_id"]] = place
+            if place.get("latitude") is not None and place.get("longitude") is not None:
+                self.cells.setdefault(self._cell(place["latitude"], place["longitude"]), []).append(place)
+
+    def _column(self, row, lng):
+        # Longitude cells widen towards the poles so they stay at least `tolerance` across;
+        # every cell in a row uses the width at the row's edge nearest the pole
+        edge_lat = min(max(abs(row), abs(row + 1)) * self.cell, 89.0)
+        return math.floor(lng * math.cos(math.radians(edge_lat)) / self.cell)
+
+    def _cell(self, lat, lng):
+        row = math.floor(lat / self.cell)
+        return row, self._column(row, lng)
+
+    def nearby(self, lat, lng):
+        """Places within the tolerance of a location, as (distance, place) pairs."""
+        row = math.floor(lat / self.cell)
+        matches = []
+        for cell_row in (row - 1, row, row + 1):
+            column = self._column(cell_row, lng)
+            for cell_column in (column - 1, column, column + 1):
+                for place in self.cells.get((cell_row, cell_column), ()):
+                    distance = distance_meters(lat, lng, place["latitude"], place["longitude"])
+                    if distance <= self.tolerance:
+                        matches.append((distance, place))
+        return matches
+
+    def match(self, activity):
+        """Returns (place, how) where how is "id", "location" or None when nothing matched.
+
+        Several places near the activity are ranked by website host matching the activity's
+        source_url, then by name similarity, then by distance.
+        """
+        place = self.by_id.get(activity.get("place_id"))
+        if place:
+            return place, "id"
+        if activity.get("latitude") is None or activity.get("longitude") is None:
+            return None, None
+        candidates = self.nearby(activity["latitude"], activity["longitude"])
+        if not candidates:
+            return None, None
+        host = website_host(activity.get("source_url"))
+        name = (activity.get("name") or "").lower()
+
+        def rank(candidate):
+            distance, place = candidate
+            same_site = bool(host) and website_host(place.get("website")) == host
+            similarity = difflib.SequenceMatcher(None, name, (place.get("name") or "").lower()).ratio()
+            return -same_site, -similarity, distance
+
+        return min(candidates, key=rank)[1], "location"
+
+
+def iter_json_array(f, read_size=1 << 16):
+    """Yields the items of a top-level JSON array from an open text file, reading `read_size` characters at a time."""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    while not buffer:
+        more = f.read(read_size)
+        buffer = more.lstrip()
+        if not more:
+            break
+    if not buffer.startswith("["):
+        raise ValueError("expected a JSON array")
+    pos = 1
+    eof = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            end = None
+        # An item that ends exactly at the buffer's end may be cut off, e.g. a number
+        if end is None or (end == len(buffer) and not eof):
+            if eof:
+                raise ValueError("truncated JSON array")
+            more = f.read(read_size)
+            eof = not more
+            buffer = buffer[pos:] + more
+            pos = 0
+            continue
+        yield item
+        pos = end
+
+
+def iter_activities(path):
+    """Streams activities from a JSON array, or from JSONL such as the extraction checkpoint log."""
+    with open(path, "r", encoding="utf-8") as f:
+        if not path.endswith(".jsonl"):
+            yield from iter_json_array(f)
+            return
+        for line in f:
+            if not line.endswith("\n"):
+                break  # Partial line from a crash mid-write
+            record = json.loads(line)
+            if record.get("type") == "chunk":
+                yield from record.get("activities", [])
+            elif "type" not in record:
+                yield record
+
+
+def enrich_activity(activity, place):
+    """Combines an activity with the place it belongs to."""
+    return {
+        # Place information
+        "place_name": place.get("name"),
+        "place_id": place.get("place_id"),
+        "types": place.get("types", []),
+        "rating": place.get("rating"),
+        "user_ratings_total": place.get("user_ratings_total"),
+        "website": place.get("website"),
+        # Activity information
+        "activity_name": activity.get("name"),
+        "description": activity.get("description"),
+        # Common fields
+        "latitude": activity.get("latitude"),
+        "longitude": activity.get("longitude")
+    }
+
+
+def merge_stream(activities, place_index, output_file):
+    """Writes each activity, enriched when it matches a place, to `output_file` as it is read.
+
+    Only the place index is held in memory. The output is a JSON array with one record
+    per line, written to a temporary file and moved into place once complete. Returns
+    the match counts keyed by "id", "location" and None.
+    """
+    matched = {"id": 0, "location": 0, None: 0}
+    start = time.perf_counter()
+    with open(output_file + ".tmp", "w", encoding="utf-8") as out:
+        out.write("[")
+        for count, activity in enumerate(activities):
+            place, how = place_index.match(activity)
+            matched[how] += 1
+            # If no matching business is found, keep the original activity
+            record = enrich_activity(activity, place) if place else activity
+            out.write(",\n" if count else "\n")
+            out.write(json.dumps(record, ensure_ascii=False))
+        out.write("\n]\n")
+    os.replace(output_file + ".tmp", output_file)
+    METRICS.stage_done("merge", time.perf_counter() - start, sum(matched.values()))
+    return matched
+
+
+def merge_activities_with_places(activities_file="activities.json", output_file="merged_data.json",
+                                 tolerance=MATCH_TOLERANCE):
     """Merges place data into each activity without grouping activities"""
     print("Merging place data into activities...")
 
-    # Load files
-    with open("activities.json", "r") as f:
-        activities = json.load(f)
-
-    with open("places.json", "r") as f:
-        places = json.load(f)
-
-    # Create a place lookup dictionary by coordinates
-    place_lookup = {}
-    for place in places:
-        key = f"{place['latitude']},{place['longitude']}"
-        place_lookup[key] = place
-
-    # Merge place data into each activity
-    enriched_activities = []
-    for activity in activities:
-        key = f"{activity['latitude']},{activity['longitude']}"
-
-        # Found matching place
-        if key in place_lookup:
-            place = place_lookup[key]
-
-            # Create a new enriched activity with both activity and place data
-            enriched_activity = {
-                # Place information
-                "place_name": place["name"],
-                "place_id": place.get("place_id"),
-                "types": place.get("types", []),
-                "rating": place.get("rating"),
-                "user_ratings_total": place.get("user_ratings_total"),
-                "website": place.get("website"),
-                # Activity information
-                "activity_name": activity["name"],
-                "description": activity["description"],
-                # Common fields
-                "latitude": activity["latitude"],
-                "longitude": activity["longitude"]
+    store = PlaceStore()
+    place_index = PlaceIndex(store.iter_places(), tolerance)
+    store.close()
+
+    matched = merge_stream(iter_activities(activities_file), place_index, output_file)
+
+    print(f"Matched {matched['id']} activities by place_id, {matched['location']} by location "
+          f"(within {place_index.tolerance:g} m), {matched[None]} unmatched")
+    print(f"Enhanced {sum(matched.values())} activities saved to {output_file}")
+
+
+def synthetic_places(count, seed=1):
+    rng = random.Random(seed)
+    return [{"place_id": f"place-{i}", "name": f"Escape Room {i}", "website": f"https://escape{i}.example",
+             "latitude": 43.65 + rng.uniform(-0.2, 0.2), "longitude": -79.38 + rng.uniform(-0.3, 0.3)}
+            for i in range(count)]
+
+
+def write_synthetic_activities(path, places, count, seed=1):
+    """Writes `count` activities near random `places` to a JSON array file, one at a time."""
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[")
+        for i in range(count):
+            place = rng.choice(places)
+            activity = {
+                "name": f"Room {i}", "description": "Find the clues before the hour runs out. " * 5,
+                "latitude": place["latitude"] + rng.uniform(-1e-4, 1e-4),
+                "longitude": place["longitude"] + rng.uniform(-1e-4, 1e-4),
+                "source_url": place["website"] + "/rooms",
             }
-            enriched_activities.append(enriched_activity)
-        else:
-            # If no matching business found, keep original activity
-            enriched_activities.append(activity)
+            if rng.random() < 0.5:
+                activity["place_id"] = place["place_id"]
+            f.write(",\n" if i else "\n")
+            f.write(json.dumps(activity, indent=2))
+        f.write("\n]")
+
+
+def _measure_merge(activities_file, output_file, places, streaming, results):
+    start = time.perf_counter()
+    place_index = PlaceIndex(places)
+    if streaming:
+        merge_stream(iter_activities(activities_file), place_index, output_file)
+    else:
+        # The previous approach: load everything, enrich into a list, pretty-print it all at once
+        with open(activities_file, "r") as f:
+            activities = json.load(f)
+        enriched = []
+        for activity in activities:
+            place, _ = place_index.match(activity)
+            enriched.append(enrich_activity(activity, place) if place else activity)
+        with open(output_file, "w") as f:
+            json.dump(enriched, f, indent=4)
+    # ru_maxrss is in kilobytes on Linux
+    results.put((time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def benchmark_merge(sizes=(20000, 200000), place_count=10000):
+    """Reports time and peak RSS of the streaming and in-memory merges, each in a fresh process."""
+    places = synthetic_places(place_count)
+    context = multiprocessing.get_context("fork")
+    with tempfile.TemporaryDirectory() as directory:
+        activities_file = os.path.join(directory, "activities.json")
+        output_file = os.path.join(directory, "merged_data.json")
+        for size in sizes:
+            write_synthetic_activities(activities_file, places, size)
+            line = f"{size} activities ({os.path.getsize(activities_file) / 2 ** 20:.0f} MB):"
+            for label, streaming in (("streaming", True), ("in-memory", False)):
+                results = context.Queue()
+                process = context.Process(target=_measure_merge,
+                                          args=(activities_file, output_file, places, streaming, results))
+                process.start()
+                elapsed, peak_mb = results.get()
+                process.join()
+                line += f" {label} {elapsed:.1f}s, peak RSS {peak_mb:.0f} MB;"
+            print(line.rstrip(";"))
 
-    # Save merged data
-    # Save merged data
-    with open("merged_data.json", "w") as f:
-        json.dump(enriched_activities, f, indent=4)
 
-    print(f"Enhanced {len(enriched_activities)} activities saved to merged_data.json")
+def main():
+    parser = argparse.ArgumentParser(description="Merge place data into extracted activities.")
+    parser.add_argument("activities", nargs="?", default="activities.json",
+                        help="Activities as a JSON array, or a JSONL file such as activities.jsonl")
+    parser.add_argument("--output", default="merged_data.json")
+    parser.add_argument("--tolerance", type=float, default=MATCH_TOLERANCE,
+                        help="Meters an activity may be from a place and still match it by location")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Compare peak memory of the streaming merge with loading everything at once")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark_merge()
+        return
+    metrics.start()
+    merge_activities_with_places(args.activities, args.output, args.tolerance)
+    metrics.finish()
 
 
 if __name__ == "__main__":
-    merge_activities_with_places()
\ No newline at end of file
+    main()
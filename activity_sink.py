@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import time
+
+ACTIVITIES_LOG_FILE = "activities.jsonl"
+
+
+def chunk_key(task):
+    """Identifies a chunk task across runs as (business_id, page url, chunk index, content digest).
+
+    The digest is of the chunk text, so a page that changed between an interrupted run and
+    its resume is extracted again instead of matching the old chunks. Reused pages have no
+    text; they use index -1 and the page's content hash.
+    """
+    business = task["business"]
+    business_id = business.get("business_id") or business.get("place_id") or business.get("name")
+    if "text" in task:
+        digest = hashlib.sha1(task["text"].encode("utf-8")).hexdigest()
+    else:
+        digest = task["page"].get("content_hash")
+    return business_id, task["page"].get("url"), task.get("index", -1), digest
+
+
+class ActivitySink:
+    """Checkpointed log of extracted activities, written as one JSONL record per finished chunk.
+
+    Each record is {"type": "chunk", "key": [...], "activities": [...]}, so a chunk's
+    activities and its completion are a single line and a crash can only lose a partial
+    last line. Writes are buffered and fsynced every `sync_every` records or `sync_interval`
+    seconds. `finalize` writes the JSON array output atomically and ends the log with a
+    "run_done" record, so the next run starts fresh instead of resuming. Only chunks written
+    or kept (resumed) in the current run reach the output, so records of a page that changed
+    since the interrupted run are left behind.
+    """
+
+    def __init__(self, path=ACTIVITIES_LOG_FILE, sync_every=50, sync_interval=5.0):
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.file = None
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.current = set()  # Keys written or resumed in this run
+
+    def _records(self):
+        """Yields (end offset, record) for every complete line of the log."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # Partial line from a crash mid-write
+                offset += len(line)
+                try:
+                    yield offset, json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+    def start(self):
+        """Opens the log and returns the keys of chunks finished by an interrupted previous run.
+
+        A log that is empty or ends with "run_done" belongs to a completed run and is cleared.
+        """
+        completed = set()
+        last_type = None
+        end = 0
+        for end, record in self._records():
+            if record.get("type") == "chunk":
+                completed.add(tuple(record["key"]))
+            last_type = record.get("type")
+        fresh = last_type is None or last_type == "run_done"
+        self.file = open(self.path, "w" if fresh else "a", encoding="utf-8")
+        if not fresh:
+            # Drop a partial last line so the next record starts on its own line
+            self.file.truncate(end)
+        return set() if fresh else completed
+
+    def keep(self, key):
+        """Marks a chunk checkpointed by the interrupted run as still part of this run's output."""
+        self.current.add(tuple(key))
+
+    def write(self, key, activities):
+        self.current.add(tuple(key))
+        self.file.write(json.dumps({"type": "chunk", "key": key, "activities": activities}, ensure_ascii=False) + "\n")
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def finalize(self, output_file):
+        """Writes the activities of this run's chunks, in chunk order, to `output_file` as a JSON array.
+
+        Returns the count. A chunk logged more than once contributes its last record.
+        """
+        self.sync()
+        last = {}
+        for offset, record in self._records():
+            if record.get("type") == "chunk" and tuple(record["key"]) in self.current:
+                last[tuple(record["key"])] = offset
+        emit = set(last.values())
+        count = 0
+        with open(output_file + ".tmp", "w", encoding="utf-8") as out:
+            out.write("[")
+            for offset, record in self._records():
+                if offset not in emit:
+                    continue
+                for activity in record.get("activities", []):
+                    out.write(",\n" if count else "\n")
+                    out.write(json.dumps(activity, ensure_ascii=False, indent=2))
+                    count += 1
+            out.write("\n]")
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(output_file + ".tmp", output_file)
+        self.file.write(json.dumps({"type": "run_done"}) + "\n")
+        self.close()
+        return count
+
+    def close(self):
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.file = None
@@ -0,0 +1,259 @@
+import argparse
+import json
+import math
+import os
+import re
+from collections import Counter
+from activity_sink import chunk_key
+
+# Signals that a chunk describes bookable activities, and signals that it is boilerplate
+ACTIVITY_PATTERNS = [
+    (re.compile(r"\b\d{2,3}\s*(?:-\s*)?(?:min|mins|minutes)\b", re.I), 3),
+    (re.compile(r"\b\d{1,2}\s*(?:-|–|to)\s*\d{1,2}\s*(?:players|people|guests|persons)\b", re.I), 4),
+    (re.compile(r"\b(?:players|per person|per player|group size)\b", re.I), 2),
+    (re.compile(r"(?:[$€£]\s?\d+|\b\d+(?:\.\d{2})?\s?(?:\$|usd|cad|eur)\b)", re.I), 2),
+    (re.compile(r"\b(?:difficulty|difficult|beginner|expert|\d\s*/\s*(?:5|10))\b|[★☆]", re.I), 3),
+    (re.compile(r"\b(?:escape rooms?|escape games?|puzzles?|mission|clues?|adventure)\b", re.I), 1),
+    (re.compile(r"\b(?:book now|book (?:a|your) (?:room|game)|age(?:s|d)? \d+\+?)\b", re.I), 1),
+]
+BOILERPLATE_PATTERNS = [
+    (re.compile(r"\b(?:privacy policy|cookies?|terms (?:of|and) (?:service|conditions)|gdpr)\b", re.I), -3),
+    (re.compile(r"\b(?:careers|job openings?|apply now|we(?:'re| are) hiring|resume)\b", re.I), -4),
+    (re.compile(r"\b(?:gift cards?|newsletter|subscribe)\b", re.I), -1),
+]
+BOILERPLATE_CAP = 3.0  # Most the boilerplate patterns together can take off a chunk's score
+BOILERPLATE_FADE = 6.0  # Keyword score at which boilerplate stops counting against a chunk
+FILTER_THRESHOLD = 1.0  # Chunks scoring below this skip the LLM once enforced; check it with calibrate()
+CALIBRATION_THRESHOLDS = (0.0, 1.0, 2.0, 3.0, 4.0, 5.0)
+CLASSIFIER_WEIGHT = 1.0  # How much the trained classifier's log-odds move the keyword score
+SHADOW_LOG_FILE = "filter_shadow.jsonl"
+SHADOW_LOG_MAX_RECORDS = 50000  # Chunks logged across all shadow runs; later chunks are only counted
+CLASSIFIER_FILE = "filter_model.json"
+
+
+def keyword_score(text):
+    """Weighted count of activity patterns, each counted at most 3 times, less a boilerplate penalty.
+
+    Each boilerplate pattern counts once and the penalty is capped at `BOILERPLATE_CAP`. It
+    shrinks as the activity signal grows and is gone at `BOILERPLATE_FADE`, so a cookie
+    banner on a page full of room descriptions doesn't hide the rooms.
+    """
+    score = 0.0
+    for pattern, weight in ACTIVITY_PATTERNS:
+        score += weight * min(len(pattern.findall(text)), 3)
+    penalty = sum(weight for pattern, weight in BOILERPLATE_PATTERNS if pattern.search(text))
+    return score + max(penalty, -BOILERPLATE_CAP) * max(0.0, 1 - score / BOILERPLATE_FADE)
+
+
+def words(text):
+    return re.findall(r"[a-z]+", text.lower())
+
+
+class ChunkClassifier:
+    """Multinomial naive Bayes over words, trained on chunks labelled by whether the LLM found activities."""
+
+    def __init__(self, word_log_odds=None, prior_log_odds=0.0):
+        self.word_log_odds = word_log_odds or {}
+        self.prior_log_odds = prior_log_odds
+
+    @classmethod
+    def fit(cls, texts, labels, min_count=2):
+        counts = {True: Counter(), False: Counter()}
+        for text, label in zip(texts, labels):
+            counts[bool(label)].update(words(text))
+        vocabulary = {word for word, n in (counts[True] + counts[False]).items() if n >= min_count}
+        totals = {label: sum(counts[label][word] for word in vocabulary) + len(vocabulary) for label in counts}
+        word_log_odds = {
+            word: math.log((counts[True][word] + 1) / totals[True]) - math.log((counts[False][word] + 1) / totals[False])
+            for word in vocabulary
+        }
+        positives = sum(1 for label in labels if label)
+        prior_log_odds = math.log((positives + 1) / (len(labels) - positives + 1))
+        return cls(word_log_odds, prior_log_odds)
+
+    def log_odds(self, text):
+        chunk_words = words(text)
+        if not chunk_words:
+            return self.prior_log_odds
+        # Averaged per word so long chunks don't swamp the keyword score
+        evidence = sum(self.word_log_odds.get(word, 0.0) for word in chunk_words) / len(chunk_words)
+        return self.prior_log_odds + evidence * min(len(chunk_words), 50)
+
+    def save(self, path=CLASSIFIER_FILE):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"prior_log_odds": self.prior_log_odds, "word_log_odds": self.word_log_odds}, f)
+
+    @classmethod
+    def load(cls, path=CLASSIFIER_FILE):
+        """Loads a saved classifier, or returns None when none has been trained yet."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return cls(data["word_log_odds"], data["prior_log_odds"])
+
+
+class ChunkFilter:
+    """Decides which chunks are worth an LLM call.
+
+    Shadow mode is the default until a threshold has been checked against your own pages
+    (see `calibrate`). In shadow mode nothing is skipped; chunks that would have been skipped are still
+    extracted and every decision is logged to `shadow_log` with how many activities the
+    LLM found, so the threshold can be checked for lost recall and the classifier trained.
+    Each chunk key is logged once across runs, up to `SHADOW_LOG_MAX_RECORDS` records.
+    """
+
+    def __init__(self, threshold=FILTER_THRESHOLD, classifier=None, shadow=True, shadow_log=SHADOW_LOG_FILE):
+        self.threshold = threshold
+        self.classifier = classifier
+        self.shadow = shadow
+        self.shadow_log = shadow_log
+        self.stats = {"kept": 0, "skipped": 0, "missed": 0}
+        self.logged = None  # Chunk keys already in the shadow log, read on first use
+        self.log_records = 0
+
+    def score(self, text):
+        score = keyword_score(text)
+        if self.classifier:
+            score += CLASSIFIER_WEIGHT * self.classifier.log_odds(text)
+        return score
+
+    def is_relevant(self, score):
+        return score >= self.threshold
+
+    def record(self, task, activities):
+        """Counts a finished chunk and, in shadow mode, logs it for review and training.
+
+        Chunks whose LLM call failed (`activities` None) are left out: they would count as
+        chunks without activities.
+        """
+        if activities is None:
+            return
+        relevant = self.is_relevant(task["relevance"])
+        self.stats["kept" if relevant else "skipped"] += 1
+        if not self.shadow:
+            return
+        if not relevant and activities:
+            self.stats["missed"] += 1
+            print(f"Filter would have missed {len(activities)} activities in {task['page'].get('url')} "
+                  f"chunk {task['index']} (score {task['relevance']:.1f})")
+        self._log(task, activities)
+
+    def _log(self, task, activities):
+        if self.logged is None:
+            self.logged = set()
+            if os.path.exists(self.shadow_log):
+                with open(self.shadow_log, "r", encoding="utf-8") as f:
+                    for line in f:
+                        self.log_records += 1
+                        key = json.loads(line).get("key")
+                        if key:
+                            self.logged.add(tuple(key))
+        key = chunk_key(task)
+        if key in self.logged:
+            return  # Cached chunks come round again on every run
+        if self.log_records >= SHADOW_LOG_MAX_RECORDS:
+            if self.log_records == SHADOW_LOG_MAX_RECORDS:
+                print(f"{self.shadow_log} holds {SHADOW_LOG_MAX_RECORDS} chunks; no more are logged")
+                self.log_records += 1
+            return
+        self.logged.add(key)
+        self.log_records += 1
+        with open(self.shadow_log, "a", encoding="utf-8") as f:
+            f.write(json.dumps({
+                "key": key, "url": task["page"].get("url"), "index": task["index"], "score": task["relevance"],
+                "activities": len(activities), "text": task["text"],
+            }, ensure_ascii=False) + "\n")
+
+    def summary(self):
+        verb = "would skip" if self.shadow else "skipped"
+        line = f"{verb} {self.stats['skipped']} of {self.stats['kept'] + self.stats['skipped']} chunks"
+        if self.shadow:
+            line += f", losing activities in {self.stats['missed']}"
+        return line
+
+
+def train_from_shadow_log(path=SHADOW_LOG_FILE, output=CLASSIFIER_FILE):
+    """Trains the classifier on chunks from shadow runs, labelled by whether the LLM found activities."""
+    texts, labels = [], []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            texts.append(record["text"])
+            labels.append(record["activities"] > 0)
+    classifier = ChunkClassifier.fit(texts, labels)
+    classifier.save(output)
+    print(f"Trained on {len(texts)} chunks ({sum(labels)} with activities); saved to {output}")
+
+
+def calibrate(shadow_log=SHADOW_LOG_FILE, pages_file=None, activities_file="activities.json",
+              thresholds=CALIBRATION_THRESHOLDS, classifier=None):
+    """Prints the recall of each threshold on real chunk text, and the share of chunks it skips.
+
+    Chunks in `shadow_log` are labelled by whether the LLM found activities in them. With
+    `pages_file` (the crawl's JSONL pages), every page is chunked as extraction would chunk
+    it and counts as positive when `activities_file` has activities from its URL; a page is
+    kept when any of its chunks scores at or above the threshold.
+    Returns {source: {threshold: recall}}.
+    """
+    chunk_filter = ChunkFilter(classifier=classifier)
+    recalls = {}
+
+    if shadow_log and os.path.exists(shadow_log):
+        with open(shadow_log, "r", encoding="utf-8") as f:
+            records = [json.loads(line) for line in f]
+        scores = [(chunk_filter.score(record["text"]), record["activities"] > 0) for record in records]
+        positives = sum(1 for _, positive in scores if positive)
+        print(f"{len(records)} chunks in {shadow_log}, {positives} with activities")
+        recalls["chunks"] = {}
+        for threshold in thresholds:
+            recall = sum(score >= threshold for score, positive in scores if positive) / max(positives, 1)
+            skipped = sum(score < threshold for score, _ in scores) / max(len(scores), 1)
+            recalls["chunks"][threshold] = recall
+            print(f"  threshold {threshold:4.1f}: recall {recall:.1%}, skips {skipped:.1%} of chunks")
+
+    if pages_file and os.path.exists(pages_file) and os.path.exists(activities_file):
+        from chunking import chunk_text
+        from extract_activities import CHUNK_OVERLAP, page_chunk_budget
+        from scrape_output import iter_records
+        with open(activities_file, "r", encoding="utf-8") as f:
+            source_urls = {activity.get("source_url") for activity in json.load(f)}
+        contents = {record["url"]: record.get("content", "") for _, record in iter_records(pages_file)
+                    if record.get("type") == "page"}
+        max_tokens = page_chunk_budget()
+        pages = []  # (chunk scores, has activities)
+        for url, content in contents.items():
+            if len(content) >= 100:
+                chunks = chunk_text(content, max_tokens, overlap=CHUNK_OVERLAP)
+                pages.append(([chunk_filter.score(chunk) for chunk in chunks], url in source_urls))
+        positives = sum(1 for _, positive in pages if positive)
+        chunks = sum(len(scores) for scores, _ in pages)
+        print(f"{len(pages)} pages in {pages_file}, {positives} with activities in {activities_file}")
+        recalls["pages"] = {}
+        for threshold in thresholds:
+            recall = sum(max(scores) >= threshold for scores, positive in pages if positive) / max(positives, 1)
+            skipped = sum(score < threshold for scores, _ in pages for score in scores) / max(chunks, 1)
+            recalls["pages"][threshold] = recall
+            print(f"  threshold {threshold:4.1f}: recall {recall:.1%} of pages, skips {skipped:.1%} of chunks")
+
+    if not recalls:
+        print(f"Nothing to calibrate on: run extraction in shadow mode to fill {shadow_log}, or pass the pages file")
+    return recalls
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train or calibrate the chunk relevance filter.")
+    parser.add_argument("shadow_log", nargs="?", default=SHADOW_LOG_FILE)
+    parser.add_argument("model", nargs="?", default=CLASSIFIER_FILE)
+    parser.add_argument("--calibrate", action="store_true",
+                        help="Print the recall of several thresholds on the shadow log instead of training")
+    parser.add_argument("--pages", metavar="PAGES_FILE",
+                        help="With --calibrate, also measure page recall on the crawl's pages file")
+    parser.add_argument("--activities", default="activities.json",
+                        help="Activities whose source_url marks the pages in PAGES_FILE that have activities")
+    args = parser.parse_args()
+    if args.calibrate:
+        calibrate(args.shadow_log, args.pages, args.activities, classifier=ChunkClassifier.load(args.model))
+    else:
+        train_from_shadow_log(args.shadow_log, args.model)
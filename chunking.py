@@ -0,0 +1,85 @@
+import re
+
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+CHARS_PER_TOKEN = 4  # Rough average for English text with Llama/Mistral-style tokenizers
+
+
+def estimate_tokens(text):
+    """Fast token estimate used when no real tokenizer is configured."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def chunk_budget(num_ctx, prompt_tokens, share=0.5):
+    """Tokens of page text that fit in one call.
+
+    Only `share` of the context window is given to the prompt and page text; the rest
+    is left for the model's answer, which can quote descriptions verbatim.
+    """
+    return max(int(num_ctx * share) - prompt_tokens, 1)
+
+
+def _split_oversized(sentence, max_tokens, count_tokens):
+    """Breaks a sentence longer than `max_tokens` on word boundaries."""
+    pieces, current = [], []
+    for word in sentence.split():
+        if current and count_tokens(" ".join(current + [word])) > max_tokens:
+            pieces.append(" ".join(current))
+            current = []
+        current.append(word)
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+
+def _units(text, max_tokens, count_tokens):
+    """Yields (sentence, starts_paragraph) pairs, each at most `max_tokens` long."""
+    for paragraph in text.split("\n"):
+        first = True
+        for sentence in SENTENCE_END.split(paragraph.strip()):
+            if not sentence:
+                continue
+            pieces = [sentence]
+            if count_tokens(sentence) > max_tokens:
+                pieces = _split_oversized(sentence, max_tokens, count_tokens)
+            for piece in pieces:
+                yield piece, first
+                first = False
+
+
+def chunk_text(text, max_tokens, count_tokens=estimate_tokens, overlap=0):
+    """Packs text into as few chunks of at most `max_tokens` tokens as possible.
+
+    Chunks end on sentence boundaries and keep paragraph breaks; a sentence longer than
+    the budget is split between words. With `overlap`, each chunk repeats up to that many
+    tokens of trailing sentences from the previous one so an activity cut at a boundary
+    is still seen whole. Never returns empty chunks.
+    """
+    chunks = []
+    current = []  # (sentence, starts_paragraph, tokens)
+    current_tokens = 0
+
+    def joined(units):
+        chunk = ""
+        for sentence, starts_paragraph, _ in units:
+            if chunk:
+                chunk += "\n" if starts_paragraph else " "
+            chunk += sentence
+        return chunk
+
+    for sentence, starts_paragraph in _units(text, max_tokens, count_tokens):
+        tokens = count_tokens(sentence) + 1  # Separator
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(joined(current))
+            carried, carried_tokens = [], 0
+            for unit in reversed(current):
+                if carried_tokens + unit[2] > overlap or carried_tokens + unit[2] + tokens > max_tokens:
+                    break
+                carried.insert(0, unit)
+                carried_tokens += unit[2]
+            current, current_tokens = carried, carried_tokens
+        current.append((sentence, starts_paragraph, tokens))
+        current_tokens += tokens
+
+    if current:
+        chunks.append(joined(current))
+    return chunks
@@ -0,0 +1,137 @@
+import hashlib
+import sqlite3
+import time
+import zlib
+from scrapy.http import HtmlResponse, TextResponse
+
+CRAWL_CACHE_FILE = "crawl_cache.db"
+
+# Totals for the current process, printed at the end of a crawl
+CRAWL_REPORT = {
+    "pages_revalidated": 0,  # 304 Not Modified, served from the cache
+    "bytes_saved": 0,  # Body bytes we didn't have to download
+    "pages_unchanged": 0,  # Same normalized content as the previous crawl
+    "pages_changed": 0,  # New pages or pages whose content changed
+}
+
+
+def content_hash(text):
+    """Hash of whitespace- and case-normalized page text."""
+    normalized = " ".join(text.split()).lower()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class CrawlCache:
+    """Per-URL validators, bodies and content hashes from previous crawls."""
+
+    def __init__(self, path=CRAWL_CACHE_FILE):
+        # Crawl worker processes share the cache; WAL lets them read while another one writes
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, body BLOB, encoding TEXT, "
+            "content_hash TEXT, fetched_at REAL)"
+        )
+        self.conn.commit()
+
+    def get(self, url):
+        row = self.conn.execute(
+            "SELECT etag, last_modified, body, encoding, content_hash FROM pages WHERE url = ?", (url,)
+        ).fetchone()
+        if not row:
+            return None
+        return {
+            "etag": row[0],
+            "last_modified": row[1],
+            "body": zlib.decompress(row[2]) if row[2] else None,
+            "encoding": row[3],
+            "content_hash": row[4],
+        }
+
+    def store_response(self, url, etag, last_modified, body, encoding):
+        """Remembers the validators and body of a 200 response for the next conditional request."""
+        self.conn.execute(
+            "INSERT INTO pages (url, etag, last_modified, body, encoding, fetched_at) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(url) DO UPDATE SET etag = excluded.etag, last_modified = excluded.last_modified, "
+            "body = excluded.body, encoding = excluded.encoding, fetched_at = excluded.fetched_at",
+            (url, etag, last_modified, zlib.compress(body), encoding, time.time())
+        )
+        self.conn.commit()
+
+    def record_hash(self, url, new_hash):
+        """Stores the content hash for `url` and returns True when it matches the previous crawl."""
+        row = self.conn.execute("SELECT content_hash FROM pages WHERE url = ?", (url,)).fetchone()
+        unchanged = bool(row) and row[0] == new_hash
+        self.conn.execute(
+            "INSERT INTO pages (url, content_hash, fetched_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(url) DO UPDATE SET content_hash = excluded.content_hash",
+            (url, new_hash, time.time())
+        )
+        self.conn.commit()
+        CRAWL_REPORT["pages_unchanged" if unchanged else "pages_changed"] += 1
+        return unchanged
+
+    def close(self):
+        self.conn.close()
+
+
+class ConditionalRequestMiddleware:
+    """Downloader middleware that revalidates pages with ETag/Last-Modified from the spider's crawl cache.
+
+    A 304 answer is turned back into a normal 200 response from the cached body, so the
+    spider parses and follows links exactly as before without downloading the page again.
+    """
+
+    def process_request(self, request, spider):
+        cache = getattr(spider, "crawl_cache", None)
+        if not cache or request.method != "GET":
+            return None
+        entry = cache.get(request.url)
+        if entry and entry["body"] is not None:
+            if entry["etag"]:
+                request.headers.setdefault("If-None-Match", entry["etag"])
+            if entry["last_modified"]:
+                request.headers.setdefault("If-Modified-Since", entry["last_modified"])
+        return None
+
+    def process_response(self, request, response, spider):
+        cache = getattr(spider, "crawl_cache", None)
+        if not cache or request.method != "GET":
+            return response
+
+        if response.status == 304:
+            entry = cache.get(request.url)
+            if not entry or entry["body"] is None:
+                return response
+            CRAWL_REPORT["pages_revalidated"] += 1
+            CRAWL_REPORT["bytes_saved"] += len(entry["body"])
+            return response.replace(
+                cls=HtmlResponse,
+                status=200,
+                body=entry["body"],
+                encoding=entry["encoding"] or "utf-8",
+                flags=response.flags + ["revalidated"],
+            )
+
+        if response.status == 200 and isinstance(response, TextResponse):
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if etag or last_modified:
+                cache.store_response(
+                    request.url,
+                    etag.decode("latin-1") if etag else None,
+                    last_modified.decode("latin-1") if last_modified else None,
+                    response.body,
+                    response.encoding,
+                )
+        return response
+
+
+def print_crawl_report():
+    """Prints what the crawl cache saved in this run."""
+    print(
+        f"Crawl cache: {CRAWL_REPORT['pages_revalidated']} pages revalidated "
+        f"({CRAWL_REPORT['bytes_saved'] / 1024:.1f} KiB not downloaded), "
+        f"{CRAWL_REPORT['pages_unchanged']} unchanged and {CRAWL_REPORT['pages_changed']} new or changed pages"
+    )
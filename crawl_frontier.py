@@ -0,0 +1,38 @@
+import re
+from urllib.parse import urlparse
+
+# Words in anchor text or URL path that point towards (or away from) activity pages
+LINK_TERM_WEIGHTS = {
+    "activities": 3, "activity": 3, "adventure": 2, "adventures": 2, "book": 2, "booking": 2, "escape": 3,
+    "experience": 3, "experiences": 3, "game": 3, "games": 3, "mission": 2, "missions": 2, "price": 2,
+    "prices": 2, "pricing": 2, "puzzle": 2, "quest": 2, "rates": 2, "room": 3, "rooms": 3, "theme": 2,
+    "themes": 2, "tickets": 1,
+    "about": -1, "account": -4, "blog": -2, "careers": -5, "cart": -4, "category": -1, "checkout": -4,
+    "contact": -2, "cookie": -5, "faq": -2, "feed": -4, "franchise": -3, "jobs": -5, "login": -5,
+    "news": -2, "policy": -4, "press": -3, "privacy": -5, "sitemap": -3, "tag": -2, "terms": -5,
+}
+SKIPPED_EXTENSIONS = (".pdf", ".jpg", ".jpeg", ".png", ".gif", ".webp", ".svg", ".zip", ".mp4", ".mp3", ".ics")
+DEPTH_PENALTY = 1.0
+PATH_SEGMENT_PENALTY = 0.5
+
+
+def link_terms(text):
+    return set(re.findall(r"[a-z]+", text.lower()))
+
+
+def score_link(url, anchor_text="", depth=1):
+    """Scores how likely a link leads to activity pages; None for links that are never worth crawling."""
+    path = urlparse(url).path.lower()
+    if path.endswith(SKIPPED_EXTENSIONS):
+        return None
+
+    score = 0.0
+    for terms in (link_terms(anchor_text), link_terms(path)):
+        score += sum(LINK_TERM_WEIGHTS.get(term, 0) for term in terms)
+    segments = [segment for segment in path.split("/") if segment]
+    return score - DEPTH_PENALTY * depth - PATH_SEGMENT_PENALTY * max(0, len(segments) - 1)
+
+
+def request_priority(score):
+    """Scrapy request priority for a link score; higher scores are fetched first."""
+    return int(round(score * 10))
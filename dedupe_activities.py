@@ -1,6 +1,14 @@
+import argparse
 import json
 import difflib
-from collections import defaultdict
+import os
+import random
+import time
+from collections import Counter, defaultdict
+from functools import lru_cache
+import metrics
+from activity_clusters import CLUSTER_INDEX_FILE, ClusterIndex, cluster_activities
+from metrics import METRICS
 
 
 def load_json_data(file_path):
@@ -50,14 +58,93 @@ def merge_items(items):
                 merged[key] = value
 
     # Add all source URLs
-    merged['source_urls'] = list(sources)
+    merged['source_urls'] = sorted(sources)
     if 'source_url' in merged:
         del merged['source_url']
 
     return merged
 
 
+def names_similar(name1, name2, name_threshold=0.8):
+    """True when two normalized names match, None when descriptions have to decide, else False."""
+    matcher = difflib.SequenceMatcher(None, name1, name2)
+    if matcher.real_quick_ratio() <= 0.6 or matcher.quick_ratio() <= 0.6:
+        return False
+    name_similarity = matcher.ratio()
+    if name_similarity > name_threshold:
+        return True
+    return None if name_similarity > 0.6 else False
+
+
+@lru_cache(maxsize=65536)
+def description_words(description):
+    return Counter(description.lower().split())
+
+
+def descriptions_similar(desc1, desc2, desc_threshold=0.7, min_word_overlap=0.4):
+    # Texts sharing few words are practically never 70% matching blocks; skip difflib for them
+    words1, words2 = description_words(desc1), description_words(desc2)
+    overlap = 2 * sum((words1 & words2).values()) / max(sum(words1.values()) + sum(words2.values()), 1)
+    if overlap < min_word_overlap:
+        return False
+    matcher = difflib.SequenceMatcher(None, desc1, desc2)
+    return matcher.real_quick_ratio() > desc_threshold and matcher.quick_ratio() > desc_threshold \
+        and matcher.ratio() > desc_threshold
+
+
 def deduplicate_activities(data):
+    """Merges duplicate activities; each merged item lists every source URL in `source_urls`.
+
+    Candidates come from MinHash LSH over name trigrams (see activity_clusters) and are
+    verified with the same name/description thresholds as `is_similar`, with names compared
+    case-insensitively. Duplicates are grouped transitively.
+    """
+    with METRICS.stage("dedupe") as stage:
+        stage.add(len(data))
+        return [merge_cluster([data[index] for index in cluster])
+                for cluster in cluster_activities(data, names_similar, descriptions_similar)]
+
+
+def merge_cluster(items):
+    if len(items) == 1:
+        item_copy = items[0].copy()
+        if 'source_url' in item_copy:
+            item_copy['source_urls'] = [item_copy.pop('source_url')]
+        return item_copy
+    return merge_items(items)
+
+
+def deduplicate_incrementally(data, index):
+    """Same result as `deduplicate_activities`, reusing the clusters and merges stored in `index`.
+
+    Only clusters whose members changed since the last run are merged again.
+    """
+    start = time.perf_counter()
+    groups, keys, changed = index.update(data)
+    merged_items = []
+    remerged = reused = 0
+    for cluster, indices in groups:
+        items = [data[index] for index in indices]
+        if cluster is None:
+            merged_items.append(merge_cluster(items))
+            continue
+        member_keys = [keys[index] for index in indices]
+        merged = None if cluster in changed else index.merged(cluster, member_keys)
+        if merged is None:
+            merged = merge_cluster(items)
+            index.save_merged(cluster, member_keys, merged)
+            remerged += 1
+        else:
+            reused += 1
+        merged_items.append(merged)
+    index.commit()
+    METRICS.stage_done("dedupe", time.perf_counter() - start, len(data))
+    print(f"Merged {remerged} changed clusters, reused {reused} from {index.path}")
+    return merged_items
+
+
+def deduplicate_activities_bucketed(data):
+    """The previous first-word bucketing with pairwise difflib, kept as the benchmark baseline."""
     # Group potentially similar items
     name_groups = defaultdict(list)
     for item in data:
@@ -104,13 +191,62 @@ def deduplicate_activities(data):
     return merged_items
 
 
+def synthetic_activities(data, count, seed=1):
+    """Scales `data` up to `count` activities: new made-up names plus typo'd and exact duplicates."""
+    rng = random.Random(seed)
+    syllables = [consonant + vowel for consonant in 'bcdfghjklmnprstvwz' for vowel in 'aeiou']
+    activities = []
+    while len(activities) < count:
+        roll = rng.random()
+        if roll < 0.6 or not activities:
+            item = dict(rng.choice(data))
+            words = [''.join(rng.choices(syllables, k=rng.randint(2, 3))) for _ in range(rng.randint(1, 3))]
+            item['name'] = ' '.join(words).title()
+        else:
+            item = dict(rng.choice(activities))
+            if roll < 0.8 and len(item['name']) > 4:
+                position = rng.randrange(len(item['name']))
+                item['name'] = item['name'][:position] + item['name'][position + 1:]
+        activities.append(item)
+    return activities
+
+
+def benchmark_dedupe(data, sizes=(10000, 100000), baseline_limit=10000):
+    """Times the LSH engine against the bucketed pairwise baseline on `data` and larger synthetic sets."""
+    for label, activities in [('activities.json', data)] + [
+            (f'synthetic {size}', synthetic_activities(data, size)) for size in sizes]:
+        start = time.perf_counter()
+        unique = len(deduplicate_activities(activities))
+        line = f"{label} ({len(activities)}): lsh {time.perf_counter() - start:.2f}s -> {unique}"
+        if len(activities) <= baseline_limit:
+            start = time.perf_counter()
+            unique = len(deduplicate_activities_bucketed(activities))
+            line += f", bucketed {time.perf_counter() - start:.2f}s -> {unique}"
+        print(line)
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Merge duplicate activities from activities.json.")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Time the deduplication engine against the previous implementation")
+    parser.add_argument("--rebuild", action="store_true",
+                        help=f"Discard {CLUSTER_INDEX_FILE} and cluster every activity from scratch")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark_dedupe(load_json_data('activities.json'))
+        return
+
+    metrics.start()
     try:
         # Load the data
         data = load_json_data('activities.json')
 
-        # Deduplicate activities
-        deduplicated_data = deduplicate_activities(data)
+        # Deduplicate activities, reusing clusters from previous runs
+        if args.rebuild and os.path.exists(CLUSTER_INDEX_FILE):
+            os.remove(CLUSTER_INDEX_FILE)
+        index = ClusterIndex(CLUSTER_INDEX_FILE, names_similar, descriptions_similar)
+        deduplicated_data = deduplicate_incrementally(data, index)
+        index.close()
 
         # Save deduplicated data
         save_json_data(deduplicated_data, 'deduplicated_activities.json')
@@ -118,6 +254,7 @@ def main():
         print(f"Successfully deduplicated {len(data)} activities into {len(deduplicated_data)} unique activities.")
     except Exception as e:
         print(f"Error processing data: {e}")
+    metrics.finish()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,200 @@
+import inspect
+import time
+from urllib.parse import urlparse
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler
+from scrapy.exceptions import IgnoreRequest
+from scrapy.utils.defer import maybe_deferred_to_future
+from twisted.internet.defer import DeferredSemaphore
+from twisted.internet.error import (
+    ConnectionRefusedError,
+    DNSLookupError,
+    TCPTimedOutError,
+    TimeoutError as ConnectTimeoutError,
+)
+
+try:
+    # Scrapy >= 2.13 wraps Twisted's connection errors in its own exceptions
+    from scrapy.exceptions import CannotResolveHostError, DownloadConnectionRefusedError, DownloadTimeoutError
+except ImportError:
+    CannotResolveHostError, DownloadConnectionRefusedError = DNSLookupError, ConnectionRefusedError
+    DownloadTimeoutError = ConnectTimeoutError
+
+# Per-domain timings for the current process, printed at the end of a crawl
+DOMAIN_STATS = {}
+
+# Shared by every crawler in the process so the global cap holds across business spiders
+_global_slots = None
+
+UNREACHABLE_ERRORS = (
+    DownloadTimeoutError, ConnectTimeoutError, TCPTimedOutError, DNSLookupError, ConnectionRefusedError,
+    CannotResolveHostError, DownloadConnectionRefusedError,
+)
+THROTTLE_STATUSES = (429, 503)
+
+
+def global_slots(settings):
+    """The process-wide semaphore capping downloads in flight across every crawler."""
+    global _global_slots
+    if _global_slots is None:
+        _global_slots = DeferredSemaphore(settings.getint("ADAPTIVE_THROTTLE_GLOBAL_CONCURRENCY", 32))
+    return _global_slots
+
+
+class GlobalSlotDownloadHandler(HTTP11DownloadHandler):
+    """HTTP(S) download handler that holds a global slot only while a response is transferred.
+
+    The downloader calls it once a request has waited out its domain's delay and got one of
+    the domain's transfer slots, so requests queued behind a slow domain don't take slots
+    that other domains could be using.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        handler = super().from_crawler(crawler)
+        handler.slots = global_slots(crawler.settings)
+        return handler
+
+    if inspect.iscoroutinefunction(HTTP11DownloadHandler.download_request):
+        async def download_request(self, request):
+            await maybe_deferred_to_future(self.slots.acquire())
+            try:
+                return await super().download_request(request)
+            finally:
+                self.slots.release()
+    else:
+        # Older Scrapy handlers take the spider and return a Deferred
+        def download_request(self, request, spider):
+            return self.slots.run(super().download_request, request, spider)
+
+
+def domain_stats(domain):
+    return DOMAIN_STATS.setdefault(domain, {
+        "requests": 0,
+        "errors": 0,
+        "timeouts": 0,
+        "consecutive_failures": 0,
+        "latency_total": 0.0,
+        "latency_max": 0.0,
+        "latency_ewma": None,
+        "first_request": None,
+        "last_response": None,
+        "delay": None,
+        "concurrency": None,
+        "failed": False,
+    })
+
+
+class AdaptiveDomainThrottle:
+    """Downloader middleware that tunes each domain's delay and parallelism from what it observes.
+
+    Successful responses pull the delay towards the domain's average latency divided by its
+    concurrency, and concurrency grows by one after a streak of fast responses. Errors,
+    429s and 503s double the delay and halve concurrency. A domain whose requests keep
+    timing out is abandoned. The global in-flight cap shared by all crawlers in the process
+    is enforced by GlobalSlotDownloadHandler.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.min_delay = settings.getfloat("ADAPTIVE_THROTTLE_MIN_DELAY", 0.25)
+        self.max_delay = settings.getfloat("ADAPTIVE_THROTTLE_MAX_DELAY", 10.0)
+        self.max_concurrency = settings.getint("ADAPTIVE_THROTTLE_MAX_CONCURRENCY", 4)
+        self.max_failures = settings.getint("ADAPTIVE_THROTTLE_MAX_FAILURES", 3)
+        self.ramp_up_after = settings.getint("ADAPTIVE_THROTTLE_RAMP_UP_AFTER", 5)
+        self.streaks = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def process_request(self, request, spider):
+        domain = urlparse(request.url).netloc
+        stats = domain_stats(domain)
+        if stats["failed"]:
+            raise IgnoreRequest(f"Skipping {request.url}: {domain} keeps timing out")
+        stats["requests"] += 1
+        if stats["first_request"] is None:
+            stats["first_request"] = time.monotonic()
+        return None
+
+    def _slot(self, request):
+        key = request.meta.get("download_slot")
+        return self.crawler.engine.downloader.slots.get(key) if key else None
+
+    def process_response(self, request, response, spider):
+        stats = domain_stats(urlparse(request.url).netloc)
+        stats["last_response"] = time.monotonic()
+        latency = request.meta.get("download_latency")
+        if latency is not None:
+            stats["latency_total"] += latency
+            stats["latency_max"] = max(stats["latency_max"], latency)
+            ewma = stats["latency_ewma"]
+            stats["latency_ewma"] = latency if ewma is None else 0.7 * ewma + 0.3 * latency
+
+        if response.status >= 500 or response.status in THROTTLE_STATUSES:
+            stats["errors"] += 1
+            self._back_off(request, stats)
+        else:
+            stats["consecutive_failures"] = 0
+            self._speed_up(request, stats)
+        return response
+
+    def process_exception(self, request, exception, spider):
+        if isinstance(exception, IgnoreRequest):
+            return None
+        stats = domain_stats(urlparse(request.url).netloc)
+        stats["errors"] += 1
+        stats["last_response"] = time.monotonic()
+        if isinstance(exception, UNREACHABLE_ERRORS):
+            stats["timeouts"] += 1
+            stats["consecutive_failures"] += 1
+            if stats["consecutive_failures"] >= self.max_failures and not stats["failed"]:
+                stats["failed"] = True
+                print(f"Giving up on {urlparse(request.url).netloc} after {stats['consecutive_failures']} failures in a row")
+        self._back_off(request, stats)
+        return None
+
+    def _speed_up(self, request, stats):
+        slot = self._slot(request)
+        if slot is None or stats["latency_ewma"] is None:
+            return
+        target = stats["latency_ewma"] / max(slot.concurrency, 1)
+        slot.delay = min(self.max_delay, max(self.min_delay, (slot.delay + target) / 2))
+
+        streak = self.streaks.get(slot, 0) + 1
+        if streak >= self.ramp_up_after and slot.concurrency < self.max_concurrency:
+            slot.concurrency += 1
+            streak = 0
+        self.streaks[slot] = streak
+        stats["delay"], stats["concurrency"] = slot.delay, slot.concurrency
+
+    def _back_off(self, request, stats):
+        slot = self._slot(request)
+        if slot is None:
+            return
+        slot.delay = min(self.max_delay, max(self.min_delay, slot.delay * 2))
+        slot.concurrency = max(1, slot.concurrency // 2)
+        self.streaks[slot] = 0
+        stats["delay"], stats["concurrency"] = slot.delay, slot.concurrency
+
+
+def print_domain_stats():
+    """Prints per-domain request counts, latencies and final throttle settings, slowest first."""
+    if not DOMAIN_STATS:
+        return
+    print(f"{'Domain':<40} {'Reqs':>5} {'Errs':>5} {'Avg s':>6} {'Max s':>6} {'Total s':>8} {'Delay':>6} {'Conc':>4}")
+
+    def elapsed(stats):
+        if stats["first_request"] is None or stats["last_response"] is None:
+            return 0.0
+        return stats["last_response"] - stats["first_request"]
+
+    for domain, stats in sorted(DOMAIN_STATS.items(), key=lambda item: elapsed(item[1]), reverse=True):
+        answered = stats["requests"] - stats["timeouts"]
+        average = stats["latency_total"] / answered if answered > 0 else 0.0
+        delay = f"{stats['delay']:.2f}" if stats["delay"] is not None else "-"
+        concurrency = stats["concurrency"] if stats["concurrency"] is not None else "-"
+        status = " (gave up)" if stats["failed"] else ""
+        print(f"{domain[:40]:<40} {stats['requests']:>5} {stats['errors']:>5} {average:>6.2f} "
+              f"{stats['latency_max']:>6.2f} {elapsed(stats):>8.1f} {delay:>6} {concurrency:>4}{status}")
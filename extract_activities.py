@@ -1,37 +1,45 @@
+import argparse
+import hashlib
 import json
+import os
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
 import ollama  # Assumes Mistral 7B is set up locally
-
-
-def chunk_text(text, max_tokens=3000):
-    """Splits text into smaller chunks within the token limit."""
-    sentences = text.split('. ')
-    chunks = []
-    current_chunk = ""
-
-    for sentence in sentences:
-        if len(current_chunk) + len(sentence) < max_tokens:
-            current_chunk += sentence + ". "
-        else:
-            chunks.append(current_chunk.strip())
-            current_chunk = sentence + ". "
-
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-
-    return chunks
-
-
-def extract_with_llm(text):
-    """Uses a local LLM (Mistral 7B) to extract structured activity data."""
-    prompt = f"""
-        Extract structured escape room activity information from the text below.
-
-        # Input Text
-        {text}
+from activity_sink import ACTIVITIES_LOG_FILE, ActivitySink, chunk_key
+from chunk_filter import FILTER_THRESHOLD, ChunkClassifier, ChunkFilter
+from chunking import chunk_budget, chunk_text, estimate_tokens
+import metrics
+from metrics import METRICS
+from llm_stream import LLM_STREAM_REPORT, ActivityStreamParser, record_stream, stream_report
+from sqlite_cache import SQLiteCache, cache_key
+
+EXTRACTED_PAGES_FILE = "extracted_pages.json"  # url -> content hash of the last extracted version
+# Chunks in flight at once; match OLLAMA_NUM_PARALLEL on the server to keep it busy
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "4"))
+LLM_MODEL = "mistral-nemo:12b-instruct-2407-q4_K_M"
+LLM_NUM_CTX = int(os.getenv("LLM_NUM_CTX", "8192"))  # Context window requested from Ollama
+CHUNK_CONTEXT_SHARE = 0.5  # Share of the context window for prompt + page text; the rest is for the answer
+CHUNK_OVERLAP = 50  # Tokens of trailing sentences repeated at the start of the next chunk
+LLM_MAX_OUTPUT_TOKENS = 2048  # Longer answers are almost always a generation loop
+LLM_JSON_OUTPUT = os.getenv("LLM_JSON_OUTPUT", "1") == "1"  # Needs Ollama 0.5+ for schema-constrained output
+LLM_CACHE_FILE = "llm_cache.db"
+LLM_CACHE_MAX_ENTRIES = 20000  # Least recently used chunks are evicted past this
+
+LLM_BATCH = os.getenv("LLM_BATCH", "1") == "1"  # Pack several short chunks of one business into one call
+SEGMENT_OVERHEAD_TOKENS = 8  # "### Segment N" header and blank line around each packed chunk
+
+# Sent as the system message ahead of the page text, so it is an identical prefix on every call
+# and the server can reuse its KV cache instead of re-processing it per chunk
+EXTRACTION_PROMPT = """
+        Extract structured escape room activity information from the text segments in the user message.
+        Each segment starts with a line "### Segment <number>" and may come from a different web page.
 
         # Output Format
         Provide a JSON array of objects. Each object should represent one escape room activity, and contain ONLY the following fields (include a field ONLY if the information is explicitly present in the text):
 
+        -   **segment**: The number of the segment the activity was found in.
         -   **name**: The exact name of the activity.
         -   **description**: The FULL description of the activity, copied VERBATIM from the text. Do not summarize or rephrase.
         -   **duration**: The duration of the activity (e.g., "60 minutes").
@@ -57,72 +65,122 @@ def extract_with_llm(text):
             - Job postings or recruitment
         9.  **STRICT EXTRACTION ONLY**: Only extract information that is explicitly stated in the input text. Do not fabricate or generate any descriptions or details.
         10. **HIGH CONFIDENCE MATCHES ONLY**: Only include an activity if you are highly confident that all information is directly from the text.
+        11. **ONE SEGMENT PER ACTIVITY**: Take every field of an activity from the segment named in its "segment" field.
     """
-    print("Extracting activities with LLM...")
-    response = ollama.chat(model='mistral-nemo:12b-instruct-2407-q4_K_M', messages=[{"role": "user", "content": prompt}])
-    print("LLM extraction completed.")
-
-    content = response['message']['content']
+# Output schema the server constrains generation to when LLM_JSON_OUTPUT is on
+ACTIVITY_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "segment": {"type": "integer"},
+            **{field: {"type": "string"} for field in ("name", "description", "duration", "difficulty", "location", "price")},
+        },
+        "required": ["segment", "name"],
+    },
+}
+# Changes whenever the prompt or output format does, so cached extractions from an older prompt are never reused
+PROMPT_VERSION = hashlib.sha256(
+    json.dumps([EXTRACTION_PROMPT, ACTIVITY_SCHEMA if LLM_JSON_OUTPUT else None]).encode("utf-8")
+).hexdigest()[:16]
+
+
+def page_chunk_budget(count_tokens=estimate_tokens, num_ctx=LLM_NUM_CTX):
+    """Tokens of page text per LLM call once the prompt itself is accounted for."""
+    return chunk_budget(num_ctx, count_tokens(EXTRACTION_PROMPT) + SEGMENT_OVERHEAD_TOKENS, CHUNK_CONTEXT_SHARE)
+
+
+def activity_segment(activity, texts):
+    """Index of the text an activity came from, by its "segment" number or else the text that names it."""
+    segment = activity.pop("segment", None)
+    if not isinstance(segment, int) or not 1 <= segment <= len(texts):
+        name = str(activity.get("name", ""))
+        segment = next((i + 1 for i, text in enumerate(texts) if name and name in text), 1)
+    return segment - 1
+
+
+def stream_activities(texts, max_output_tokens=LLM_MAX_OUTPUT_TOKENS):
+    """Uses a local LLM (Mistral 7B) to extract structured activity data from one or more text segments.
+
+    Yields (text index, activity) as each activity object closes in the streamed response.
+    Generation is stopped early once it loops, turns into prose or passes `max_output_tokens`,
+    keeping the activities already closed. Output metrics are recorded once the stream ends.
+    """
+    segments = "\n\n".join(f"### Segment {i}\n{text}" for i, text in enumerate(texts, 1))
+    print(f"Extracting activities with LLM from {len(texts)} segments...")
+    call_start = time.perf_counter()
+    stream = ollama.chat(model=LLM_MODEL, stream=True,
+                         messages=[{"role": "system", "content": EXTRACTION_PROMPT},
+                                   {"role": "user", "content": segments}],
+                         format=ACTIVITY_SCHEMA if LLM_JSON_OUTPUT else None,
+                         options={"num_ctx": LLM_NUM_CTX, "num_predict": max_output_tokens})
+
+    parser = ActivityStreamParser()
+    found = 0
+    tokens = tokens_used = prompt_tokens = 0
+    abort_reason = None
     try:
-        return json.loads(content)
-    except json.JSONDecodeError:
-        import re
-        json_pattern = r'\[.*\]'
-        json_match = re.search(json_pattern, content, re.DOTALL)
-        if json_match:
-            try:
-                return json.loads(json_match.group())
-            except json.JSONDecodeError:
-                pass
+        for part in stream:
+            tokens = part.get("eval_count") or tokens + 1
+            prompt_tokens = part.get("prompt_eval_count") or prompt_tokens
+            for activity in parser.feed(part["message"]["content"]):
+                found += 1
+                tokens_used = tokens
+                yield activity_segment(activity, texts), activity
+            abort_reason = parser.degenerate() or ("output token budget" if tokens >= max_output_tokens else None)
+            if abort_reason:
+                break
+        if not found:
+            for activity in parser.finish():
+                found += 1
+                tokens_used = tokens
+                yield activity_segment(activity, texts), activity
+    finally:
+        stream.close()
+        METRICS.observe("llm_call_seconds", time.perf_counter() - call_start, model=LLM_MODEL)
+
+    record_stream(tokens, tokens - tokens_used, parser.parse_failures, abort_reason is not None,
+                  prompt_tokens, found, chunks=len(texts))
+    if abort_reason:
+        print(f"Stopped LLM generation after {tokens} tokens: {abort_reason}")
+    elif not found and parser.parse_failures:
         print("Warning: Could not extract valid JSON from LLM response.")
-        return []
-
-
-def initialize_output_file(output_file):
-    """Initialize the output file with an empty JSON array."""
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write('[\n]')
-
-
-def append_activity_to_file(activity, output_file, is_first=False):
-    """Append an activity to the JSON file while maintaining valid JSON structure."""
-    with open(output_file, 'r+', encoding='utf-8') as f:
-        # Move to right before the closing bracket
-        f.seek(0, 2)  # Go to end of file
-        pos = f.tell() - 2  # Position right before the closing bracket
-        if pos < 0:  # If file is too small, start at beginning
-            pos = 0
-        f.seek(pos)
+    print("LLM extraction completed.")
 
-        # Add comma if not the first item
-        if not is_first:
-            f.write(',\n')
-        else:
-            f.write('\n')
 
-        # Add the new activity and close the array
-        json_activity = json.dumps(activity, ensure_ascii=False, indent=2)
-        f.write(json_activity)
-        f.write('\n]')
+def extract_with_llm(texts, max_output_tokens=LLM_MAX_OUTPUT_TOKENS):
+    """Collects `stream_activities` into one activity list per text."""
+    by_segment = [[] for _ in texts]
+    for index, activity in stream_activities(texts, max_output_tokens):
+        by_segment[index].append(activity)
+    return by_segment
 
 
-if __name__ == "__main__":
-    # Load scraped data from the scraper output
+def load_previous_run(output_file, pages_file=EXTRACTED_PAGES_FILE):
+    """Loads last run's activities grouped by source URL and the content hashes they came from."""
+    activities_by_url = defaultdict(list)
+    extracted_pages = {}
     try:
-        with open("scraped_data.json", "r", encoding="utf-8") as f:
-            scraped_data = json.load(f)
-            print(f"Loaded data for {len(scraped_data)} businesses from scraped_data.json")
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        print(f"Error loading scraped_data.json: {str(e)}")
-        exit(1)
-
-    output_file = "activities.json"
-    initialize_output_file(output_file)
-
-    is_first_activity = True
-    total_activities = 0
-
-    # Process each business from the scraped data
+        with open(output_file, "r", encoding="utf-8") as f:
+            for activity in json.load(f):
+                activities_by_url[activity.get("source_url")].append(activity)
+        with open(pages_file, "r", encoding="utf-8") as f:
+            extracted_pages = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+    return activities_by_url, extracted_pages
+
+
+def iter_extraction_tasks(scraped_data, previous_activities, extracted_pages, count_tokens=estimate_tokens,
+                          chunk_filter=None):
+    """Yields one task per chunk in business/page/chunk order.
+
+    Pages the crawler marked unchanged yield a single task carrying last run's activities
+    instead of chunks, so they skip the LLM. `count_tokens` can be swapped for the model's
+    real tokenizer; the default is a fast character-based estimate. With a `chunk_filter`,
+    chunks scoring below its threshold are marked `filtered` (unless it is in shadow mode).
+    """
+    max_tokens = page_chunk_budget(count_tokens)
     for business in scraped_data:
         business_name = business.get("name", "Unknown")
         business_website = business.get("website", "No website")
@@ -132,32 +190,276 @@ if __name__ == "__main__":
             print(f"No pages found for {business_name} ({business_website})")
             continue
 
-        print(f"Processing business: {business_name} - {len(pages)} pages")
+        print(f"Queueing business: {business_name} - {len(pages)} pages")
 
-        # Process each page for this business
         for page in pages:
             page_content = page.get("content", "")
             if len(page_content) < 100:
                 continue
 
-            # Split content into manageable chunks
-            chunks = chunk_text(page_content)
+            page_url = page.get("url")
+            if page.get("unchanged") and extracted_pages.get(page_url) == page.get("content_hash"):
+                yield {"business": business, "page": page, "reused": previous_activities.get(page_url, [])}
+                continue
 
-            for chunk in chunks:
-                activities = extract_with_llm(chunk)
+            # Split content into manageable chunks
+            chunks = chunk_text(page_content, max_tokens, count_tokens, CHUNK_OVERLAP)
+            for index, chunk in enumerate(chunks):
+                task = {
+                    "business": business,
+                    "page": page,
+                    "index": index,
+                    "text": chunk,
+                    "last_chunk": index == len(chunks) - 1,
+                }
+                if chunk_filter:
+                    task["relevance"] = chunk_filter.score(chunk)
+                    task["filtered"] = not chunk_filter.shadow and not chunk_filter.is_relevant(task["relevance"])
+                yield task
+
+
+def mark_resumed(tasks, completed):
+    """Marks tasks whose chunk was checkpointed by an interrupted run; they resolve without extraction."""
+    for task in tasks:
+        if completed and chunk_key(task) in completed:
+            task["resumed"] = True
+        yield task
+
+
+def extraction_cache_key(text):
+    """Cache key for a chunk's extraction; whitespace-only differences map to the same key."""
+    return cache_key("extraction", LLM_MODEL, PROMPT_VERSION, " ".join(text.split()))
+
+
+def run_batch(batch, extract=extract_with_llm, cache=None):
+    """Extracts a batch of chunk tasks in one call and caches each chunk's result.
+
+    Returns one activity list per task, or None if the LLM call failed.
+    """
+    try:
+        results = extract([task["text"] for task in batch])
+    except Exception as e:
+        chunks = ", ".join(f"{task['page'].get('url')} chunk {task['index']}" for task in batch)
+        print(f"LLM extraction failed for {chunks}: {e}")
+        return None
+    if cache:
+        for task, activities in zip(batch, results):
+            cache.set(extraction_cache_key(task["text"]), activities)
+    return results
+
+
+def extract_concurrently(tasks, extract=extract_with_llm, concurrency=LLM_CONCURRENCY, max_pending=None, cache=None,
+                         batch_tokens=None):
+    """Runs chunk tasks on `concurrency` threads and yields (task, activities) in task order.
+
+    At most `max_pending` tasks (default twice the concurrency) are read ahead of the oldest
+    unfinished one, so a slow chunk applies backpressure instead of queueing the whole corpus.
+    Filtered chunks and chunks found in `cache` resolve immediately without touching the LLM.
+    With `batch_tokens`, consecutive chunks of the same business are packed into one call
+    of up to that many tokens; activities is None for every chunk of a failed call.
+    """
+    max_pending = max_pending or concurrency * 2
+    pending = deque()  # (task, future, index of the task's result in its batch or None)
+    batch, batch_size = [], 0
+
+    def submit_batch():
+        nonlocal batch, batch_size
+        if batch:
+            future = executor.submit(run_batch, batch, extract, cache)
+            pending.extend((task, future, index) for index, task in enumerate(batch))
+        batch, batch_size = [], 0
+
+    def drain(limit):
+        while len(pending) > limit:
+            done_task, done_future, index = pending.popleft()
+            results = done_future.result()
+            yield done_task, results if index is None or results is None else results[index]
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for task in tasks:
+            cached = None
+            if task.get("resumed"):
+                cached = []
+            elif "reused" in task:
+                cached = task["reused"]
+            elif task.get("filtered"):
+                cached = []
+            elif cache:
+                cached = cache.get(extraction_cache_key(task["text"]))
+
+            if cached is None:
+                size = estimate_tokens(task["text"]) + SEGMENT_OVERHEAD_TOKENS
+                if batch and (not batch_tokens or batch[0]["business"] is not task["business"]
+                              or batch_size + size > batch_tokens):
+                    submit_batch()
+                batch.append(task)
+                batch_size += size
+                if not batch_tokens:
+                    submit_batch()
+            else:
+                # Results come out in task order, so an open batch goes ahead of this task
+                submit_batch()
+                future = Future()
+                future.set_result(cached)
+                pending.append((task, future, None))
+            if len(pending) >= max_pending:
+                submit_batch()
+                yield from drain(max_pending - 1)
+        submit_batch()
+        yield from drain(0)
+
+
+def extract_activities(scraped_data, output_file="activities.json", concurrency=LLM_CONCURRENCY, cache=None,
+                       chunk_filter=None, log_file=ACTIVITIES_LOG_FILE, on_activities=None):
+    """Extracts activities from every scraped page into `output_file`.
+
+    Finished chunks are checkpointed to `log_file` as they complete, so an interrupted run
+    resumes at the first unfinished chunk; `output_file` is only replaced once all are done.
+    `scraped_data` may be a generator that yields businesses as their crawls finish, and
+    `on_activities` is called with each finished chunk's activities as it is checkpointed.
+    """
+    previous_activities, extracted_pages = load_previous_run(output_file)
+    sink = ActivitySink(log_file)
+    completed = sink.start()
+    if completed:
+        print(f"Resuming: {len(completed)} chunks already extracted in {log_file}")
+
+    reused_pages = 0
+    resumed_chunks = 0
+    failed_pages = set()
+    chunks_done = 0
+    start = time.perf_counter()
+
+    tasks = iter_extraction_tasks(scraped_data, previous_activities, extracted_pages, chunk_filter=chunk_filter)
+    try:
+        batch_tokens = page_chunk_budget() if LLM_BATCH else None
+        for task, activities in extract_concurrently(mark_resumed(tasks, completed), concurrency=concurrency,
+                                                     cache=cache, batch_tokens=batch_tokens):
+            business, page = task["business"], task["page"]
+            page_url = page.get("url")
+
+            if task.get("resumed"):
+                resumed_chunks += 1
+                sink.keep(chunk_key(task))
+            elif "reused" in task:
+                # Pages the crawler marked unchanged keep last run's activities as they were
+                sink.write(chunk_key(task), activities)
+                if on_activities:
+                    on_activities(activities)
+                reused_pages += 1
+                continue
+            else:
+                chunks_done += 1
+                if chunk_filter:
+                    chunk_filter.record(task, activities)
+                if activities is None:
+                    # Left out of the checkpoint so the chunk is retried next run
+                    failed_pages.add(page_url)
+                else:
+                    for activity in activities:
+                        # Add business metadata to each activity
+                        activity["latitude"] = business.get("latitude")
+                        activity["longitude"] = business.get("longitude")
+                        activity["place_id"] = business.get("place_id")
+
+                        # Note the source URL
+                        activity["source_url"] = page_url
+                        print(f"Added activity: {activity.get('name', 'Unnamed activity')}")
+                    sink.write(chunk_key(task), activities)
+                    if on_activities:
+                        on_activities(activities)
+
+            # A page counts as extracted once all of its chunks succeeded
+            if task.get("last_chunk") and page.get("content_hash") and page_url not in failed_pages:
+                extracted_pages[page_url] = page["content_hash"]
+    except BaseException:
+        # Flush what finished so a restart resumes from here
+        sink.close()
+        raise
+
+    if failed_pages:
+        # Keep the checkpoint open so the next run only retries the failed chunks
+        sink.close()
+        print(f"Extraction failed for chunks on {len(failed_pages)} pages; rerun to retry them. "
+              f"{output_file} was left unchanged")
+        total_activities = None
+    else:
+        total_activities = sink.finalize(output_file)
+
+    with open(EXTRACTED_PAGES_FILE, "w", encoding="utf-8") as f:
+        json.dump(extracted_pages, f)
+
+    elapsed = time.perf_counter() - start
+    METRICS.stage_done("extract", elapsed, chunks_done)
+    print(f"Reused activities from {reused_pages} unchanged pages")
+    if resumed_chunks:
+        print(f"Skipped {resumed_chunks} chunks finished before the restart")
+    print(f"Extracted {chunks_done} chunks in {elapsed:.1f}s ({chunks_done / elapsed if elapsed else 0:.2f} chunks/s) "
+          f"with concurrency {concurrency}")
+    if cache:
+        print(f"LLM cache: {cache.summary()}")
+    if chunk_filter:
+        print(f"Relevance filter: {chunk_filter.summary()}")
+    print(f"LLM output: {stream_report()}")
+    if total_activities is not None:
+        print(f"Extraction complete. Added {total_activities} activities to {output_file}")
+    return total_activities
+
+
+def benchmark_concurrency(scraped_data, levels=(1, 2, 4, 8), sample=32):
+    """Measures chunks/s and prompt tokens per activity against the configured Ollama server (OLLAMA_HOST).
+
+    Each concurrency level runs once with one chunk per call and once with batching.
+    """
+    tasks = list(islice(iter_extraction_tasks(scraped_data, {}, {}), sample))
+    tasks = [task for task in tasks if "reused" not in task]
+    for concurrency in levels:
+        for batch_tokens in (None, page_chunk_budget()):
+            before = dict(LLM_STREAM_REPORT)
+            start = time.perf_counter()
+            for _ in extract_concurrently(iter(tasks), concurrency=concurrency, batch_tokens=batch_tokens):
+                pass
+            elapsed = time.perf_counter() - start
+            prompt_tokens = LLM_STREAM_REPORT["prompt_tokens"] - before["prompt_tokens"]
+            activities = LLM_STREAM_REPORT["activities"] - before["activities"]
+            print(f"concurrency {concurrency:>2}, {'batched' if batch_tokens else 'single '}: "
+                  f"{len(tasks) / elapsed:6.2f} chunks/s, {LLM_STREAM_REPORT['calls'] - before['calls']} calls, "
+                  f"{prompt_tokens / max(activities, 1):.0f} prompt tokens per activity")
 
-                for activity in activities:
-                    # Add business metadata to each activity
-                    activity["latitude"] = business.get("latitude")
-                    activity["longitude"] = business.get("longitude")
 
-                    # Note the source URL
-                    activity["source_url"] = page.get("url")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract activities from scraped_data.json with a local LLM.")
+    parser.add_argument("--concurrency", type=int, default=LLM_CONCURRENCY,
+                        help="Chunks sent to the LLM server at the same time")
+    parser.add_argument("--filter-threshold", type=float, default=FILTER_THRESHOLD,
+                        help="Chunks scoring below this relevance skip the LLM")
+    parser.add_argument("--filter-enforce", action="store_true",
+                        help="Skip chunks below the threshold; by default every chunk is extracted and the "
+                             "filter's decisions are only logged")
+    parser.add_argument("--no-filter", action="store_true", help="Send every chunk to the LLM")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Measure chunks/s at several concurrency levels instead of extracting")
+    args = parser.parse_args()
 
-                    # Add all activities without checking for duplicates
-                    append_activity_to_file(activity, output_file, is_first_activity)
-                    is_first_activity = False
-                    total_activities += 1
-                    print(f"Added activity: {activity.get('name', 'Unnamed activity')}")
+    # Load scraped data from the scraper output
+    try:
+        with open("scraped_data.json", "r", encoding="utf-8") as f:
+            scraped_data = json.load(f)
+            print(f"Loaded data for {len(scraped_data)} businesses from scraped_data.json")
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        print(f"Error loading scraped_data.json: {str(e)}")
+        exit(1)
 
-    print(f"Extraction complete. Added {total_activities} activities to {output_file}")
\ No newline at end of file
+    metrics.start()
+    if args.benchmark:
+        benchmark_concurrency(scraped_data)
+    else:
+        cache = SQLiteCache(LLM_CACHE_FILE, max_entries=LLM_CACHE_MAX_ENTRIES,
+                            bypass=os.getenv("LLM_CACHE_BYPASS") == "1")
+        chunk_filter = None
+        if not args.no_filter:
+            chunk_filter = ChunkFilter(args.filter_threshold, ChunkClassifier.load(), shadow=not args.filter_enforce)
+        extract_activities(scraped_data, "activities.json", concurrency=args.concurrency, cache=cache,
+                           chunk_filter=chunk_filter)
+        cache.close()
+    metrics.finish()
@@ -1,27 +1,145 @@
 import requests
-import json
+import heapq
+import itertools
+import math
+import random
+import threading
 import time
 import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+import metrics
+from metrics import METRICS
+from geo import distance_meters
+from place_store import PlaceStore
+from sqlite_cache import SQLiteCache, cache_key
 
 load_dotenv()
-def get_place_details(api_key, place_id):
+
+PLACES_API_URL = os.getenv("PLACES_API_URL", "https://maps.googleapis.com/maps/api/place")
+DETAILS_WORKERS = 8  # Concurrent Place Details requests
+PLACES_QPS = 10  # Stay under the Places API per-second quota
+MAX_RETRIES = 4
+RETRY_BACKOFF = 0.5  # Seconds, doubled on every retry
+PAGE_TOKEN_DELAY = 2  # Seconds before a next_page_token becomes valid
+
+PLACES_CACHE_FILE = "places_cache.db"
+NEARBY_CACHE_TTL = 24 * 3600  # Search results shift as places open and close
+DETAILS_CACHE_TTL = 30 * 24 * 3600
+CACHEABLE_STATUSES = ("OK", "ZERO_RESULTS")
+
+SWEEP_WORKERS = 4  # Tiles searched concurrently in sweep mode
+NEARBY_RESULT_CAP = 60  # Nearby search never returns more than 3 pages of 20
+MIN_TILE_RADIUS = 250  # Meters; dense tiles are not split below this
+MAX_TILE_RADIUS = 50000  # Meters; the largest radius nearby search accepts
+TILE_RETRIES = 2  # Extra attempts for a tile page that failed after the request's own retries
+
+
+class TokenBucket:
+    """Thread-safe token bucket that limits callers to `rate` acquisitions per second."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and consumes it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def create_session(pool_size=DETAILS_WORKERS):
+    """Creates a keep-alive session whose connection pool fits `pool_size` workers."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def places_cache_key(endpoint, params):
+    """Cache key for a Places API request; the API key is left out so it can be rotated."""
+    return cache_key(endpoint, {name: value for name, value in params.items() if name != "key"})
+
+
+def request_places_api(session, endpoint, params, limiter=None, max_retries=MAX_RETRIES, cache=None, ttl=None):
+    """Calls a Places API endpoint, retrying with backoff on OVER_QUERY_LIMIT and 5xx errors.
+
+    When a cache is given, responses are served from it and successful ones are stored with `ttl`.
+    """
+    if cache:
+        key = places_cache_key(endpoint, params)
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    url = f"{PLACES_API_URL}/{endpoint}/json"
+    error = None
+    for attempt in range(max_retries + 1):
+        if limiter:
+            limiter.acquire()
+        try:
+            with METRICS.timer("http_request_seconds", stage="places", endpoint=endpoint):
+                response = session.get(url, params=params, timeout=15)
+            if response.status_code >= 500:
+                error = f"HTTP {response.status_code}"
+            else:
+                data = response.json()
+                if data.get("status") != "OVER_QUERY_LIMIT":
+                    if cache and data.get("status") in CACHEABLE_STATUSES:
+                        cache.set(key, data, ttl)
+                    return data
+                error = "OVER_QUERY_LIMIT"
+        except (requests.RequestException, ValueError) as e:
+            error = str(e)
+
+        if attempt < max_retries:
+            METRICS.count("http_retries_total", stage="places")
+            time.sleep(RETRY_BACKOFF * (2 ** attempt) * (1 + random.random()))
+
+    print(f"Giving up on {endpoint} request after {max_retries + 1} attempts: {error}")
+    return {}
+
+
+def get_place_details(api_key, place_id, session=None, limiter=None, cache=None):
     """Gets detailed information for a place using Google Place Details API."""
-    url = "https://maps.googleapis.com/maps/api/place/details/json"
     params = {
         "place_id": place_id,
         "fields": "website",
         "key": api_key
     }
-    response = requests.get(url, params=params)
-    details = response.json().get("result", {})
+    data = request_places_api(session or requests, "details", params, limiter, cache=cache, ttl=DETAILS_CACHE_TTL)
+    details = data.get("result", {})
     return details.get("website")
 
 
-def get_places(api_key, location, keyword, radius=10000, max_results=200):
-    """Finds businesses offering activities using Google Places API."""
-    print(f"Fetching places related to '{keyword}' from Google Places API...")
-    url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
+def get_places_details(api_key, place_ids, workers=DETAILS_WORKERS, qps=PLACES_QPS, cache=None):
+    """Fetches websites for many places concurrently, returned in the order of `place_ids`."""
+    session = create_session(workers)
+    limiter = TokenBucket(qps)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(
+                lambda place_id: get_place_details(api_key, place_id, session, limiter, cache), place_ids
+            ))
+    finally:
+        session.close()
+
+
+def search_nearby(api_key, location, keyword, radius=10000, max_results=200, cache=None):
+    """Runs one nearby search around `location`, following next_page_token up to `max_results`."""
     params = {
         "location": location,  # Format: "latitude,longitude"
         "radius": radius,
@@ -29,24 +147,170 @@ def get_places(api_key, location, keyword, radius=10000, max_results=200):
         "key": api_key
     }
 
+    session = create_session()
     businesses = []
     while len(businesses) < max_results:
-        response = requests.get(url, params=params)
-        places = response.json().get("results", [])
+        data = request_places_api(session, "nearbysearch", params, cache=cache, ttl=NEARBY_CACHE_TTL)
+        places = data.get("results", [])
         print(f"Found {len(places)} places.")
         businesses.extend(places)
 
-        next_page_token = response.json().get("next_page_token")
+        next_page_token = data.get("next_page_token")
         if not next_page_token:
             break
 
         params["pagetoken"] = next_page_token
-        time.sleep(2)  # Delay to ensure the next page token is valid
+        if not cache or places_cache_key("nearbysearch", params) not in cache:
+            time.sleep(PAGE_TOKEN_DELAY)  # Delay to ensure the next page token is valid
+    session.close()
+
+    return businesses[:max_results]  # Limit to max_results
+
 
-    businesses = businesses[:max_results]  # Limit to max_results
+def tile_center_and_radius(tile):
+    """Center "lat,lng" of a (south, west, north, east) tile and the radius that covers its corners."""
+    south, west, north, east = tile
+    lat, lng = (south + north) / 2, (west + east) / 2
+    return f"{lat},{lng}", math.ceil(distance_meters(lat, lng, north, east))
 
+
+def split_tile(tile):
+    """Splits a (south, west, north, east) tile into four quadrants."""
+    south, west, north, east = tile
+    mid_lat, mid_lng = (south + north) / 2, (west + east) / 2
+    return [
+        (south, west, mid_lat, mid_lng),
+        (south, mid_lng, mid_lat, east),
+        (mid_lat, west, north, mid_lng),
+        (mid_lat, mid_lng, north, east),
+    ]
+
+
+def initial_tiles(bounds, max_radius=MAX_TILE_RADIUS):
+    """Splits a (south, west, north, east) box into quadrants until every tile fits in `max_radius`."""
+    tiles, fitting = [tuple(bounds)], []
+    while tiles:
+        tile = tiles.pop()
+        if tile_center_and_radius(tile)[1] > max_radius:
+            tiles.extend(split_tile(tile))
+        else:
+            fitting.append(tile)
+    return fitting
+
+
+def sweep_places(api_key, bounds, keyword, workers=SWEEP_WORKERS, min_radius=MIN_TILE_RADIUS, cache=None):
+    """Covers a (south, west, north, east) bounding box with adaptive nearby-search tiles.
+
+    The box is first split into tiles the API's 50 km radius can cover. Tiles that hit the
+    60-result cap are split into quadrants until they are smaller than `min_radius`. Pages
+    from all tiles are fetched concurrently; a tile waiting for its next_page_token is
+    parked on a timer instead of holding a worker. A page whose status is neither OK nor
+    ZERO_RESULTS is retried `TILE_RETRIES` times, then the tile is reported as failed
+    rather than searched. Places are yielded as soon as they are found, deduplicated by place_id.
+    """
+    session = create_session(workers)
+    limiter = TokenBucket(PLACES_QPS)
+    seen_ids = set()
+    sequence = itertools.count()
+    # (ready_at, seq, tile, pagetoken, results_so_far, failed_attempts)
+    pending = [(0, next(sequence), tile, None, 0, 0) for tile in initial_tiles(bounds)]
+    heapq.heapify(pending)
+    in_flight = {}
+    tiles_searched = 0
+    failed_tiles = []
+
+    def fetch_page(tile, pagetoken):
+        location, radius = tile_center_and_radius(tile)
+        params = {"location": location, "radius": radius, "keyword": keyword, "key": api_key}
+        if pagetoken:
+            params["pagetoken"] = pagetoken
+        return request_places_api(session, "nearbysearch", params, limiter, cache=cache, ttl=NEARBY_CACHE_TTL)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while pending or in_flight:
+                now = time.monotonic()
+                while pending and pending[0][0] <= now and len(in_flight) < workers:
+                    _, _, tile, pagetoken, count, failures = heapq.heappop(pending)
+                    in_flight[executor.submit(fetch_page, tile, pagetoken)] = (tile, pagetoken, count, failures)
+
+                # A full pool can't take the next tile until a fetch finishes, however soon it is ready
+                timeout = max(0, pending[0][0] - now) if pending and len(in_flight) < workers else None
+                if not in_flight:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    tile, pagetoken, count, failures = in_flight.pop(future)
+                    data = future.result()
+                    status = data.get("status")
+                    if status not in CACHEABLE_STATUSES:
+                        if failures < TILE_RETRIES:
+                            METRICS.count("sweep_tile_retries_total")
+                            ready_at = time.monotonic() + PAGE_TOKEN_DELAY * (2 ** failures)
+                            heapq.heappush(pending, (ready_at, next(sequence), tile, pagetoken, count, failures + 1))
+                        else:
+                            METRICS.count("sweep_tiles_failed_total")
+                            failed_tiles.append(tile)
+                            print(f"Tile {tile} failed with status {status or 'no response'}: "
+                                  f"{data.get('error_message', 'request gave up')}")
+                        continue
+                    places = data.get("results", [])
+                    count += len(places)
+                    for place in places:
+                        place_id = place.get("place_id")
+                        if place_id not in seen_ids:
+                            seen_ids.add(place_id)
+                            yield place
+
+                    next_page_token = data.get("next_page_token")
+                    if next_page_token:
+                        ready_at = time.monotonic() + PAGE_TOKEN_DELAY
+                        heapq.heappush(pending, (ready_at, next(sequence), tile, next_page_token, count, 0))
+                        continue
+
+                    tiles_searched += 1
+                    if count >= NEARBY_RESULT_CAP and tile_center_and_radius(tile)[1] > min_radius:
+                        for sub_tile in split_tile(tile):
+                            heapq.heappush(pending, (0, next(sequence), sub_tile, None, 0, 0))
+    finally:
+        for future in in_flight:
+            future.cancel()
+        session.close()
+        print(f"Swept {tiles_searched} tiles, found {len(seen_ids)} unique places.")
+        if failed_tiles:
+            print(f"{len(failed_tiles)} tiles failed and were not searched; their places may be missing.")
+
+
+def get_places(api_key, location, keyword, radius=10000, max_results=200, workers=DETAILS_WORKERS, cache=None,
+               bounds=None, store=None, export_json=False):
+    """Finds businesses offering activities using Google Places API.
+
+    With `bounds` (south, west, north, east) the whole box is swept tile by tile instead of
+    searching around `location`; `max_results=None` then removes the result limit.
+    New places are upserted into `store`; `export_json` also rewrites the legacy places.json.
+    Returns how many places were looked up in detail.
+    """
+    print(f"Fetching places related to '{keyword}' from Google Places API...")
+    store = store or PlaceStore()
+
+    if bounds:
+        businesses = []
+        for place in sweep_places(api_key, bounds, keyword, cache=cache):
+            businesses.append(place)
+            if max_results and len(businesses) >= max_results:
+                break
+    else:
+        businesses = search_nearby(api_key, location, keyword, radius, max_results, cache)
+
+    # Places we already know are skipped before any details request goes out
     detailed_businesses = []
+    seen_ids = store.known_ids([place.get("place_id") for place in businesses])
     for place in businesses:
+        if place.get("place_id") in seen_ids:
+            continue
+        seen_ids.add(place.get("place_id"))
         business = {
             "name": place["name"],
             "place_id": place.get("place_id"),
@@ -56,40 +320,39 @@ def get_places(api_key, location, keyword, radius=10000, max_results=200):
             "rating": place.get("rating"),
             "user_ratings_total": place.get("user_ratings_total")
         }
-
-        # Get website via Place Details API
-        if business["place_id"]:
-            print(f"Fetching website for {business['name']}...")
-            website = get_place_details(api_key, business["place_id"])
-            if website:
-                business["website"] = website
-
         detailed_businesses.append(business)
 
-    # Check if places.json exists and load existing data
-    existing_data = []
-    try:
-        with open("places.json", "r") as f:
-            existing_data = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        # File doesn't exist or is invalid, starting with empty list
-        pass
-
-    # Check for duplicates and append new places
-    existing_ids = {place.get("place_id") for place in existing_data}
-    new_places = [place for place in detailed_businesses if place.get("place_id") not in existing_ids]
-
-    # Combine existing and new data
-    combined_data = existing_data + new_places
+    # Get websites via Place Details API
+    to_fetch = [business for business in detailed_businesses if business["place_id"]]
+    print(f"Fetching websites for {len(to_fetch)} places with {workers} workers...")
+    websites = get_places_details(api_key, [business["place_id"] for business in to_fetch], workers=workers, cache=cache)
+    for business, website in zip(to_fetch, websites):
+        if website:
+            business["website"] = website
 
-    with open("places.json", "w") as f:
-        json.dump(combined_data, f, indent=4)
+    print(f"Skipped {len(businesses) - len(detailed_businesses)} places already in {store.path}")
 
-    print(f"Added {len(new_places)} new places to places.json (total: {len(combined_data)})")
+    added = store.upsert_many(detailed_businesses)
+    print(f"Added {added} new places to {store.path} (total: {len(store)})")
+    if export_json:
+        exported = store.export_json()
+        print(f"Exported {exported} places to places.json")
+    if cache:
+        print(f"Places API cache: {cache.summary()}")
+    return len(detailed_businesses)
 
 
 if __name__ == "__main__":
     api_key = os.getenv("PLACE_API_KEY") # Replace with your actual API key
     location = "43.6532,-79.3832"  # Example: toronto
     keyword = input("Enter activity to search for (e.g., archery, escape room): ")
-    get_places(api_key, location, keyword, 10000)
\ No newline at end of file
+    # Optional sweep area as "south,west,north,east", e.g. "43.58,-79.64,43.86,-79.11" for Toronto
+    sweep_bounds = os.getenv("SWEEP_BOUNDS")
+    bounds = tuple(float(value) for value in sweep_bounds.split(",")) if sweep_bounds else None
+    cache = SQLiteCache(PLACES_CACHE_FILE, bypass=os.getenv("PLACES_CACHE_BYPASS") == "1")
+    metrics.start()
+    with METRICS.stage("places") as stage:
+        stage.add(get_places(api_key, location, keyword, 10000, max_results=None if bounds else 200, cache=cache,
+                             bounds=bounds, export_json=os.getenv("PLACES_EXPORT_JSON") == "1"))
+    cache.close()
+    metrics.finish()
@@ -0,0 +1,12 @@
+import math
+
+EARTH_RADIUS = 6371000  # Meters
+
+
+def distance_meters(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two coordinates."""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
@@ -0,0 +1,143 @@
+import json
+import threading
+from metrics import METRICS
+
+# Totals for the current process, printed at the end of an extraction run
+LLM_STREAM_REPORT = {
+    "calls": 0, "chunks": 0, "prompt_tokens": 0, "output_tokens": 0, "wasted_tokens": 0, "parse_failures": 0, "aborted": 0,
+    "activities": 0,
+}
+REPORT_LOCK = threading.Lock()
+
+PROSE_LIMIT = 200  # Characters of output allowed before the first '[' or '{'
+REPEAT_WINDOW = 80  # Tail length compared against earlier output
+REPEAT_LIMIT = 3  # Earlier copies of the tail that count as a generation loop
+DUPLICATE_OBJECT_LIMIT = 3  # Identical activity objects that count as a generation loop
+
+
+class ActivityStreamParser:
+    """Incrementally parses streamed LLM output and returns activity objects as they close.
+
+    Objects directly inside the first JSON array are activities, so both a bare array and a
+    wrapper such as {"activities": [...]} work. Text outside strings is scanned one character
+    at a time; each closed object is decoded on its own, so a broken object costs only itself.
+    """
+
+    def __init__(self):
+        self.buffer = []
+        self.length = 0
+        self.depth = 0
+        self.array_depth = None  # Depth of the activity array once it opens
+        self.object_start = None
+        self.in_string = False
+        self.escaped = False
+        self.started = False
+        self.parse_failures = 0
+        self.seen = {}
+        self.next_repeat_check = REPEAT_WINDOW * (REPEAT_LIMIT + 1)
+
+    def text(self):
+        return "".join(self.buffer)
+
+    def feed(self, piece):
+        """Consumes a piece of output; returns the activities completed by it."""
+        activities = []
+        for char in piece:
+            self.buffer.append(char)
+            self.length += 1
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+            if char == '"':
+                self.in_string = True
+            elif char in "[{":
+                self.started = True
+                self.depth += 1
+                if char == "[" and self.array_depth is None:
+                    self.array_depth = self.depth
+                elif char == "{" and self.array_depth is not None and self.depth == self.array_depth + 1:
+                    self.object_start = self.length - 1
+            elif char in "]}":
+                if char == "}" and self.object_start is not None and self.depth == self.array_depth + 1:
+                    activity = self._decode("".join(self.buffer[self.object_start:]))
+                    self.object_start = None
+                    if activity is not None:
+                        activities.append(activity)
+                self.depth -= 1
+        return activities
+
+    def _decode(self, raw):
+        try:
+            activity = json.loads(raw)
+        except json.JSONDecodeError:
+            self.parse_failures += 1
+            return None
+        key = json.dumps(activity, sort_keys=True)
+        self.seen[key] = self.seen.get(key, 0) + 1
+        return activity if self.seen[key] == 1 else None
+
+    def degenerate(self):
+        """Reason the generation should be stopped, or None while it still looks healthy."""
+        if not self.started and self.length > PROSE_LIMIT:
+            return "prose instead of JSON"
+        if self.seen and max(self.seen.values()) >= DUPLICATE_OBJECT_LIMIT:
+            return "repeated activity"
+        if self.length >= self.next_repeat_check:
+            self.next_repeat_check = self.length + REPEAT_WINDOW
+            text = self.text()
+            if text.count(text[-REPEAT_WINDOW:]) > REPEAT_LIMIT:
+                return "repeating text"
+        return None
+
+    def finish(self):
+        """Activities from a response that never produced a well-formed array, e.g. a single object."""
+        if self.array_depth is not None:
+            return []
+        text = self.text()
+        start = text.find("{")
+        if start < 0:
+            return []
+        try:
+            value = json.loads(text[start:text.rfind("}") + 1])
+        except json.JSONDecodeError:
+            self.parse_failures += 1
+            return []
+        return [value] if isinstance(value, dict) and value.get("name") else []
+
+
+def record_stream(output_tokens, wasted_tokens, parse_failures, aborted, prompt_tokens=0, activities=0, chunks=1):
+    """Adds one LLM call over `chunks` packed chunks to the report.
+
+    `prompt_tokens` are those the server evaluated, after prefix-cache reuse.
+    """
+    with REPORT_LOCK:
+        LLM_STREAM_REPORT["calls"] += 1
+        LLM_STREAM_REPORT["chunks"] += chunks
+        LLM_STREAM_REPORT["prompt_tokens"] += prompt_tokens
+        LLM_STREAM_REPORT["activities"] += activities
+        LLM_STREAM_REPORT["output_tokens"] += output_tokens
+        LLM_STREAM_REPORT["wasted_tokens"] += wasted_tokens
+        LLM_STREAM_REPORT["parse_failures"] += parse_failures
+        LLM_STREAM_REPORT["aborted"] += 1 if aborted else 0
+    METRICS.count("llm_prompt_tokens_total", prompt_tokens)
+    METRICS.count("llm_completion_tokens_total", output_tokens)
+    METRICS.count("llm_wasted_tokens_total", wasted_tokens)
+    METRICS.count("llm_parse_failures_total", parse_failures)
+    METRICS.count("llm_chunks_total", chunks)
+
+
+def stream_report():
+    report = LLM_STREAM_REPORT
+    if not report["calls"]:
+        return "no LLM calls"
+    chunks = max(report["chunks"], 1)
+    return (f"{report['output_tokens']} output tokens over {report['calls']} calls for {report['chunks']} chunks, "
+            f"{report['wasted_tokens']} wasted ({report['wasted_tokens'] / chunks:.0f} per chunk), "
+            f"{report['parse_failures']} parse failures ({report['parse_failures'] / chunks:.2f} per chunk), "
+            f"{report['aborted']} generations aborted, "
+            f"{report['prompt_tokens'] / max(report['activities'], 1):.0f} prompt tokens per activity")
@@ -0,0 +1,257 @@
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_REPORT = os.getenv("METRICS_REPORT")  # Path of the JSON run report; metrics are off unless this or the port is set
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Serves Prometheus text format on this port during the run
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)  # Seconds
+NULL_CONTEXT = nullcontext()
+
+
+class Stage:
+    """Times one run of a stage and counts the items it processed."""
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.items = 0
+        self.start = None
+
+    def add(self, items=1):
+        self.items += items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.stage_done(self.name, time.perf_counter() - self.start, self.items)
+        return False
+
+
+class NullStage:
+    def add(self, items=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Metrics:
+    """Counters, latency histograms and stage timings for one run.
+
+    Every recording method returns immediately when disabled, so instrumented code costs
+    one attribute check per call. Labels are keyword arguments, as in Prometheus.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [count per bucket (+inf last), sum, count]
+        self.stages = {}  # name -> {"seconds": ..., "items": ..., "runs": ...}
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0])
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def timer(self, name, **labels):
+        """Context manager that observes how long its block took."""
+        if not self.enabled:
+            return NULL_CONTEXT
+        return _Timer(self, name, labels)
+
+    def stage(self, name):
+        """Context manager timing a stage; call `add` on it for every item processed."""
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name)
+
+    def stage_done(self, name, seconds, items):
+        """Records a stage run timed by the caller."""
+        if not self.enabled:
+            return
+        with self.lock:
+            stage = self.stages.setdefault(name, {"seconds": 0.0, "items": 0, "runs": 0})
+            stage["seconds"] += seconds
+            stage["items"] += items
+            stage["runs"] += 1
+
+    def value(self, name, **labels):
+        """Sum of a counter over every label set that includes `labels`."""
+        wanted = set(labels.items())
+        return sum(value for (counter, key), value in self.counters.items()
+                   if counter == name and wanted <= set(key))
+
+    def snapshot(self):
+        """Picklable copy of everything recorded, for merging another process's metrics."""
+        with self.lock:
+            return {
+                "counters": [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                "histograms": [[name, list(labels), [list(histogram[0]), histogram[1], histogram[2]]]
+                               for (name, labels), histogram in self.histograms.items()],
+                "stages": {name: dict(stage) for name, stage in self.stages.items()},
+            }
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, labels, value in snapshot["counters"]:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, (buckets, total, count) in snapshot["histograms"]:
+                key = (name, tuple(tuple(pair) for pair in labels))
+                histogram = self.histograms.setdefault(key, [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                histogram[1] += total
+                histogram[2] += count
+            for name, stage in snapshot["stages"].items():
+                totals = self.stages.setdefault(name, {"seconds": 0.0, "items": 0, "runs": 0})
+                for field in totals:
+                    totals[field] += stage[field]
+
+    def report(self):
+        """The run report: stage timings and rates, counters, latency percentiles and cache hit rates."""
+        snapshot = self.snapshot()
+        histograms = []
+        for name, labels, (buckets, total, count) in snapshot["histograms"]:
+            bounds = list(LATENCY_BUCKETS) + [float("inf")]
+
+            def percentile(q):
+                # Upper bound of the bucket holding the q-th observation
+                seen = 0
+                for bound, bucket_count in zip(bounds, buckets):
+                    seen += bucket_count
+                    if seen >= q * count:
+                        return bound
+                return bounds[-1]
+
+            histograms.append({
+                "name": name, "labels": dict(labels), "count": count, "sum_seconds": round(total, 6),
+                "mean_seconds": round(total / count, 6) if count else None,
+                "p50_seconds": percentile(0.5), "p90_seconds": percentile(0.9), "p99_seconds": percentile(0.99),
+            })
+        caches = {}
+        for name, labels, value in snapshot["counters"]:
+            if name == "cache_lookups_total":
+                labels = dict(labels)
+                counts = caches.setdefault(labels["namespace"], {"hits": 0, "misses": 0})
+                counts[labels["outcome"]] += value
+        for counts in caches.values():
+            lookups = counts["hits"] + counts["misses"]
+            counts["hit_rate"] = round(counts["hits"] / lookups, 4) if lookups else None
+        return {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+            "elapsed_seconds": round(time.time() - self.started_at, 3),
+            "stages": {
+                name: {**stage, "seconds": round(stage["seconds"], 3),
+                       "items_per_second": round(stage["items"] / stage["seconds"], 3) if stage["seconds"] else None}
+                for name, stage in snapshot["stages"].items()
+            },
+            "counters": [{"name": name, "labels": dict(labels), "value": value}
+                         for name, labels, value in snapshot["counters"]],
+            "histograms": histograms,
+            "caches": caches,
+        }
+
+    def prometheus_text(self):
+        """Everything recorded so far in the Prometheus text exposition format."""
+        def series(name, labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return name
+            return name + "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+        snapshot = self.snapshot()
+        lines = []
+        for name, labels, value in sorted(snapshot["counters"]):
+            lines.append(f"{series(name, labels)} {value}")
+        for name, labels, (buckets, total, count) in sorted(snapshot["histograms"]):
+            cumulative = 0
+            for bound, bucket_count in zip(list(LATENCY_BUCKETS) + ["+Inf"], buckets):
+                cumulative += bucket_count
+                lines.append(f"{series(name + '_bucket', labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{series(name + '_sum', labels)} {total}")
+            lines.append(f"{series(name + '_count', labels)} {count}")
+        for name, stage in sorted(snapshot["stages"].items()):
+            lines.append(f'stage_seconds{{stage="{name}"}} {stage["seconds"]}')
+            lines.append(f'stage_items_total{{stage="{name}"}} {stage["items"]}')
+        return "\n".join(lines) + "\n"
+
+
+class _Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+METRICS = Metrics(enabled=bool(METRICS_REPORT or METRICS_PORT))
+
+
+def start(port=METRICS_PORT):
+    """Serves /metrics in Prometheus text format on `port` in a background thread, when a port is set."""
+    if not port:
+        return None
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = METRICS.prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+    return server
+
+
+def finish(path=METRICS_REPORT):
+    """Writes the JSON run report to `path` and prints the per-stage summary; does nothing when disabled."""
+    if not METRICS.enabled:
+        return
+    report = METRICS.report()
+    for name, stage in report["stages"].items():
+        print(f"Stage {name}: {stage['seconds']:.1f}s, {stage['items']} items ({stage['items_per_second'] or 0:.2f}/s)")
+    if path:
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        os.replace(path + ".tmp", path)
+        print(f"Run report saved to {path}")
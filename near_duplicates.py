@@ -0,0 +1,81 @@
+import hashlib
+import re
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+# Query parameters that only track where a visitor came from
+IGNORED_QUERY_PARAMS = {"ref", "source", "fbclid", "gclid", "msclkid", "mc_cid", "mc_eid", "igshid", "_ga", "_gl"}
+DEFAULT_PORTS = {"http": ":80", "https": ":443"}
+
+# Totals for the current process, printed at the end of a crawl
+NEAR_DUPLICATE_REPORT = {"pages_suppressed": 0, "chars_suppressed": 0}
+
+
+def canonicalize_url(url):
+    """Normalizes a URL so trivially different links to the same page compare equal.
+
+    Lowercases scheme and host, drops default ports, fragments, tracking parameters
+    (utm_*, ref, fbclid, ...) and trailing slashes, and sorts the remaining query.
+    """
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if netloc.endswith(DEFAULT_PORTS.get(scheme, "\0")):
+        netloc = netloc.rsplit(":", 1)[0]
+    path = parts.path.rstrip("/") or "/"
+    query = sorted(
+        (name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if name.lower() not in IGNORED_QUERY_PARAMS and not name.lower().startswith("utm_")
+    )
+    return urlunsplit((scheme, netloc, path, urlencode(query), ""))
+
+
+def simhash(text, shingle_size=3):
+    """64-bit SimHash of a text's word shingles."""
+    words = re.findall(r"\w+", text.lower())
+    shingles = {" ".join(words[i:i + shingle_size]) for i in range(max(1, len(words) - shingle_size + 1))}
+    weights = [0] * 64
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+class SimHashIndex:
+    """Finds stored fingerprints within `max_distance` bits of a new one.
+
+    Fingerprints are split into max_distance + 1 bands; two fingerprints that differ in at
+    most max_distance bits must agree on at least one band, so only band matches are compared.
+    """
+
+    def __init__(self, max_distance=6):
+        self.max_distance = max_distance
+        self.band_bits = 64 // (max_distance + 1)
+        self.bands = {}
+
+    def _band_keys(self, fingerprint):
+        mask = (1 << self.band_bits) - 1
+        return [(band, fingerprint >> (band * self.band_bits) & mask) for band in range(self.max_distance + 1)]
+
+    def find(self, fingerprint):
+        """Returns the key of a stored near-duplicate, or None."""
+        for band_key in self._band_keys(fingerprint):
+            for other, key in self.bands.get(band_key, ()):
+                if bin(fingerprint ^ other).count("1") <= self.max_distance:
+                    return key
+        return None
+
+    def add(self, fingerprint, key):
+        for band_key in self._band_keys(fingerprint):
+            self.bands.setdefault(band_key, []).append((fingerprint, key))
+
+
+# Shared by every business crawl in the process when NEAR_DUPLICATE_SCOPE is 'global'
+GLOBAL_INDEX = SimHashIndex()
+
+
+def print_near_duplicate_report():
+    print(
+        f"Near-duplicates: {NEAR_DUPLICATE_REPORT['pages_suppressed']} pages "
+        f"({NEAR_DUPLICATE_REPORT['chars_suppressed']} characters) suppressed"
+    )
@@ -0,0 +1,274 @@
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+from activity_clusters import CLUSTER_INDEX_FILE, ClusterIndex
+from activity_merger import MATCH_TOLERANCE, PlaceIndex, iter_activities, merge_stream
+from chunk_filter import FILTER_THRESHOLD, ChunkClassifier, ChunkFilter
+from dedupe_activities import deduplicate_incrementally, descriptions_similar, names_similar, save_json_data
+from extract_activities import LLM_CACHE_FILE, LLM_CACHE_MAX_ENTRIES, LLM_CONCURRENCY, LLM_MODEL, PROMPT_VERSION, \
+    extract_activities
+import metrics
+from metrics import METRICS
+from place_store import PlaceStore
+from scrape_output import SCRAPED_PAGES_FILE, export_scraped_data, iter_records, read_new_records, run_finished, \
+    start_run
+from scrapy_website_scraper import business_record, scrape_with_scrapy
+from sqlite_cache import SQLiteCache
+
+PIPELINE_STATE_FILE = "pipeline_state.json"  # Input fingerprint of each stage's last complete run
+STAGES = ("crawl", "extract", "merge")
+CRAWL_POLL_INTERVAL = 1.0  # Seconds between reads of the pages file while the crawl runs
+MAX_DEPTH = 3
+MAX_PAGES = 25
+ACTIVITIES_FILE = "activities.json"
+MERGED_FILE = "merged_data.json"
+CRAWL_METRICS_FILE = "crawl_metrics.json"  # The crawl process's metrics, merged into this run's report
+
+
+def fingerprint(records):
+    """Hash of a sequence of JSON-serializable records, computed without holding them all."""
+    digest = hashlib.sha256()
+    for record in records:
+        digest.update(json.dumps(record, sort_keys=True, default=str).encode("utf-8") + b"\n")
+    return digest.hexdigest()
+
+
+def file_fingerprint(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class StageState:
+    """Input fingerprints of the last complete run of each stage, kept in `path`.
+
+    A stage is skipped when its inputs hash to the same fingerprint and its output still
+    exists. A stage's fingerprint is dropped as soon as it starts, so a run that dies
+    halfway never looks up to date.
+    """
+
+    def __init__(self, path=PIPELINE_STATE_FILE):
+        self.path = path
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                self.fingerprints = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.fingerprints = {}
+
+    def up_to_date(self, stage, value, output=None):
+        return self.fingerprints.get(stage) == value and (output is None or os.path.exists(output))
+
+    def _save(self):
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.fingerprints, f, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+
+    def start(self, stage):
+        self.fingerprints.pop(stage, None)
+        self._save()
+
+    def record(self, stage, value):
+        self.fingerprints[stage] = value
+        self._save()
+
+
+def iter_crawled_businesses(records, pages_file=SCRAPED_PAGES_FILE, crawl=None):
+    """Yields each business record with its pages as soon as its crawl finishes.
+
+    Follows `pages_file` while the `crawl` process is alive, or reads it once when there
+    is no crawl. Only pages of businesses still being crawled are held in memory.
+    Businesses that never finished are yielded with the pages they got once the crawl ends.
+    """
+    by_id = {record["business_id"]: record for record in records}
+    pages = defaultdict(dict)  # business_id -> url -> latest copy of the page
+    finished = set()
+
+    def add(record):
+        business_id = record.get("business_id")
+        if business_id not in by_id or business_id in finished:
+            return None
+        if record.get("type") == "page":
+            page = {key: value for key, value in record.items() if key not in ("type", "business_id")}
+            pages[business_id][page["url"]] = page
+        elif record.get("type") == "business_done":
+            finished.add(business_id)
+            return {**by_id[business_id], "pages": list(pages.pop(business_id, {}).values())}
+        return None
+
+    if crawl is None:
+        for _, record in iter_records(pages_file):
+            business = add(record)
+            if business:
+                yield business
+    else:
+        offset = 0
+        while True:
+            running = crawl.is_alive()
+            new_records, offset = read_new_records(pages_file, offset)
+            for record in new_records:
+                business = add(record)
+                if business:
+                    yield business
+            if not running:
+                break
+            if not new_records:
+                time.sleep(CRAWL_POLL_INTERVAL)
+
+    for business_id, business_pages in pages.items():
+        yield {**by_id[business_id], "pages": list(business_pages.values())}
+
+
+def crawl_process(businesses, options, metrics_file=CRAWL_METRICS_FILE):
+    """Entry point of the crawl child process; saves its metrics for the parent to merge."""
+    scrape_with_scrapy(businesses, **options)
+    if METRICS.enabled:
+        with open(metrics_file, "w", encoding="utf-8") as f:
+            json.dump(METRICS.snapshot(), f)
+
+
+def crawl_fingerprint(records):
+    return fingerprint([[record["business_id"], record["website"]] for record in records] + [MAX_DEPTH, MAX_PAGES])
+
+
+def extract_fingerprint(pages_file, chunk_filter):
+    pages = ([record["business_id"], record["url"], record.get("content_hash")]
+             for _, record in iter_records(pages_file) if record.get("type") == "page")
+    # A filter in shadow mode skips nothing, so its threshold doesn't change the output
+    enforced = chunk_filter is not None and not chunk_filter.shadow
+    settings = [LLM_MODEL, PROMPT_VERSION, chunk_filter.threshold if enforced else None]
+    return fingerprint(itertools.chain(pages, [settings]))
+
+
+def run_pipeline(force=(), legacy_files=False, concurrency=LLM_CONCURRENCY, chunk_filter=None,
+                 tolerance=MATCH_TOLERANCE, upload=False, pages_file=SCRAPED_PAGES_FILE):
+    """Crawls, extracts, dedupes and merges in one process, streaming records between the stages.
+
+    The crawl runs in a child process while extraction starts on each business as soon as
+    its crawl finishes; extracted activities go straight into the duplicate cluster index.
+    Stages whose inputs are unchanged since their last complete run are skipped unless
+    named in `force`. `legacy_files` also writes places.json, scraped_data.json and
+    deduplicated_activities.json for the standalone scripts.
+    """
+    state = StageState()
+    store = PlaceStore()
+    businesses = list(store.iter_places(has_website=True))
+    places_fingerprint = fingerprint(store.iter_places())
+    place_index = PlaceIndex(store.iter_places(), tolerance)
+    if legacy_files:
+        store.export_json()
+    store.close()
+    records = [business_record(business) for business in businesses]
+    print(f"Pipeline: {len(records)} businesses with websites, {len(place_index.by_id)} places")
+
+    # Crawl: skipped when the businesses and crawl settings match the last complete crawl
+    crawl = None
+    crawl_key = crawl_fingerprint(records)
+    crawl_skipped = ("crawl" not in force and state.up_to_date("crawl", crawl_key)
+                     and run_finished(pages_file))
+    if crawl_skipped:
+        print(f"Crawl: up to date, reading pages from {pages_file}")
+        if legacy_files:
+            export_scraped_data(records, pages_file)
+    else:
+        state.start("crawl")
+        # Clears the pages file of a completed run before anything reads it; the crawl resumes otherwise
+        start_run(pages_file)
+        crawl = multiprocessing.get_context("spawn").Process(target=crawl_process, args=(businesses, {
+            "max_depth": MAX_DEPTH, "max_pages": MAX_PAGES, "pages_file": pages_file,
+            "output_file": "scraped_data.json" if legacy_files else None, "workers": os.cpu_count() or 1,
+        }))
+        crawl.start()
+
+    # Extract: follows the crawl; only skippable when the pages are already final
+    index = ClusterIndex(CLUSTER_INDEX_FILE, names_similar, descriptions_similar)
+    extract_key = extract_fingerprint(pages_file, chunk_filter) if crawl_skipped else None
+    if ("extract" not in force and extract_key is not None
+            and state.up_to_date("extract", extract_key, ACTIVITIES_FILE)):
+        print(f"Extract: up to date, reading {ACTIVITIES_FILE}")
+        extracted = True
+    else:
+        state.start("extract")
+        cache = SQLiteCache(LLM_CACHE_FILE, max_entries=LLM_CACHE_MAX_ENTRIES,
+                            bypass=os.getenv("LLM_CACHE_BYPASS") == "1")
+        try:
+            total = extract_activities(iter_crawled_businesses(records, pages_file, crawl), ACTIVITIES_FILE,
+                                       concurrency=concurrency, cache=cache, chunk_filter=chunk_filter,
+                                       on_activities=index.add)
+        finally:
+            cache.close()
+            if crawl:
+                crawl.join()
+                if os.path.exists(CRAWL_METRICS_FILE):
+                    with open(CRAWL_METRICS_FILE, "r", encoding="utf-8") as f:
+                        METRICS.merge(json.load(f))
+                    os.remove(CRAWL_METRICS_FILE)
+        extracted = total is not None
+        crawl_complete = crawl is None or (crawl.exitcode == 0 and run_finished(pages_file))
+        if crawl and crawl_complete:
+            state.record("crawl", crawl_key)
+        if extracted and crawl_complete:
+            state.record("extract", extract_fingerprint(pages_file, chunk_filter))
+    if not extracted:
+        index.close()
+        print("Pipeline stopped: extraction did not finish; run again to resume")
+        return
+
+    # Dedupe and merge: skipped when the activities, places and tolerance are unchanged
+    merge_key = fingerprint([file_fingerprint(ACTIVITIES_FILE), places_fingerprint, tolerance])
+    if "merge" not in force and state.up_to_date("merge", merge_key, MERGED_FILE) and not legacy_files:
+        print(f"Dedupe and merge: up to date, {MERGED_FILE} unchanged")
+        index.close()
+    else:
+        state.start("merge")
+        activities = list(iter_activities(ACTIVITIES_FILE))
+        deduplicated = deduplicate_incrementally(activities, index)
+        index.close()
+        print(f"Deduplicated {len(activities)} activities into {len(deduplicated)}")
+        if legacy_files:
+            save_json_data(deduplicated, "deduplicated_activities.json")
+        matched = merge_stream(deduplicated, place_index, MERGED_FILE)
+        print(f"Matched {matched['id']} activities by place_id, {matched['location']} by location, "
+              f"{matched[None]} unmatched; saved to {MERGED_FILE}")
+        state.record("merge", merge_key)
+
+    if upload:
+        # Only uploads need firebase_admin
+        from store_to_firestore import store_activities
+        store_activities(MERGED_FILE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run crawl, extraction, dedupe and merge as one streaming pipeline.")
+    parser.add_argument("--force", nargs="*", choices=STAGES,
+                        help="Re-run these stages (all when none are named) even if their inputs are unchanged")
+    parser.add_argument("--legacy-files", action="store_true",
+                        help="Also write places.json, scraped_data.json and deduplicated_activities.json")
+    parser.add_argument("--concurrency", type=int, default=LLM_CONCURRENCY,
+                        help="Chunks sent to the LLM server at the same time")
+    parser.add_argument("--filter-threshold", type=float, default=FILTER_THRESHOLD,
+                        help="Chunks scoring below this relevance skip the LLM")
+    parser.add_argument("--filter-enforce", action="store_true",
+                        help="Skip chunks below the threshold; by default the filter's decisions are only logged")
+    parser.add_argument("--no-filter", action="store_true", help="Send every chunk to the LLM")
+    parser.add_argument("--tolerance", type=float, default=MATCH_TOLERANCE,
+                        help="Meters an activity may be from a place and still match it by location")
+    parser.add_argument("--upload", action="store_true", help=f"Upload {MERGED_FILE} to Firestore at the end")
+    args = parser.parse_args()
+
+    force = STAGES if args.force == [] else tuple(args.force or ())
+    chunk_filter = None if args.no_filter else ChunkFilter(args.filter_threshold, ChunkClassifier.load(),
+                                                              shadow=not args.filter_enforce)
+    metrics.start()
+    run_pipeline(force, args.legacy_files, args.concurrency, chunk_filter, args.tolerance, args.upload)
+    metrics.finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import sqlite3
+import textwrap
+import time
+
+PLACE_STORE_FILE = "places.db"
+LEGACY_PLACES_FILE = "places.json"
+
+
+class PlaceStore:
+    """Places keyed by place_id in SQLite.
+
+    Upserts touch only the rows they change, so a run costs as much as the places it adds
+    rather than the whole history. `export_json` still produces the legacy places.json.
+    """
+
+    def __init__(self, path=PLACE_STORE_FILE, legacy_file=LEGACY_PLACES_FILE):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS places ("
+            "place_id TEXT PRIMARY KEY, data TEXT NOT NULL, has_website INTEGER NOT NULL, "
+            "content_hash TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS places_website ON places (has_website)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS places_updated ON places (updated_at)")
+        self.conn.commit()
+
+        # One-time migration from the old whole-file format
+        if legacy_file and len(self) == 0 and os.path.exists(legacy_file):
+            imported = self.import_json(legacy_file)
+            print(f"Imported {imported} places from {legacy_file} into {path}")
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM places").fetchone()[0]
+
+    def __contains__(self, place_id):
+        return self.conn.execute("SELECT 1 FROM places WHERE place_id = ?", (place_id,)).fetchone() is not None
+
+    def known_ids(self, place_ids):
+        """Returns the subset of `place_ids` already in the store."""
+        place_ids = [place_id for place_id in place_ids if place_id]
+        known = set()
+        for start in range(0, len(place_ids), 500):
+            batch = place_ids[start:start + 500]
+            rows = self.conn.execute(
+                f"SELECT place_id FROM places WHERE place_id IN ({','.join('?' * len(batch))})", batch
+            )
+            known.update(row[0] for row in rows)
+        return known
+
+    def get(self, place_id):
+        row = self.conn.execute("SELECT data FROM places WHERE place_id = ?", (place_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def upsert(self, place, commit=True):
+        """Inserts or updates a place; returns True when it was new or its data changed."""
+        place_id = place.get("place_id")
+        if not place_id:
+            return False
+        data = json.dumps(place, ensure_ascii=False)
+        content_hash = hashlib.sha1(json.dumps(place, sort_keys=True).encode("utf-8")).hexdigest()
+        row = self.conn.execute("SELECT content_hash FROM places WHERE place_id = ?", (place_id,)).fetchone()
+        if row and row[0] == content_hash:
+            return False
+        self.conn.execute(
+            "INSERT OR REPLACE INTO places (place_id, data, has_website, content_hash, updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (place_id, data, int(bool(place.get("website"))), content_hash, time.time())
+        )
+        if commit:
+            self.conn.commit()
+        return True
+
+    def upsert_many(self, places):
+        """Upserts places in one transaction; returns how many were new or changed."""
+        changed = sum(self.upsert(place, commit=False) for place in places)
+        self.conn.commit()
+        return changed
+
+    def iter_places(self, has_website=None, changed_since=None):
+        """Yields stored places, optionally only those with(out) a website or updated after a timestamp."""
+        query = "SELECT data FROM places"
+        conditions, args = [], []
+        if has_website is not None:
+            conditions.append("has_website = ?")
+            args.append(int(has_website))
+        if changed_since is not None:
+            conditions.append("updated_at > ?")
+            args.append(changed_since)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        for row in self.conn.execute(query + " ORDER BY rowid", args):
+            yield json.loads(row[0])
+
+    def import_json(self, path=LEGACY_PLACES_FILE):
+        """Loads a legacy places.json list into the store."""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                places = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return 0
+        return self.upsert_many(places)
+
+    def export_json(self, path=LEGACY_PLACES_FILE):
+        """Writes every place to the legacy places.json format, one place at a time."""
+        count = 0
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write("[")
+            for place in self.iter_places():
+                f.write(",\n" if count else "\n")
+                f.write(textwrap.indent(json.dumps(place, indent=4), "    "))
+                count += 1
+            f.write("\n]" if count else "]")
+        os.replace(path + ".tmp", path)
+        return count
+
+    def close(self):
+        self.conn.close()
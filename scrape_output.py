@@ -0,0 +1,151 @@
+import json
+import os
+from collections import defaultdict
+from scrapy import signals
+
+SCRAPED_PAGES_FILE = "scraped_pages.jsonl"
+
+
+def append_record(fd, record):
+    """Appends one JSON line with a single write so concurrent writers never interleave."""
+    os.write(fd, (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+
+
+def iter_records(path=SCRAPED_PAGES_FILE):
+    """Yields (offset, record) for every complete line of the pages file."""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        offset = 0
+        for line in f:
+            start, offset = offset, offset + len(line)
+            if not line.endswith(b"\n"):
+                break  # Partial line from a crash mid-write
+            try:
+                yield start, json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def read_new_records(path, offset):
+    """Returns the complete records appended after `offset` and the offset to continue from."""
+    if not os.path.exists(path):
+        return [], offset
+    records = []
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break  # Still being written; picked up next time
+            offset += len(line)
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records, offset
+
+
+class PageStreamPipeline:
+    """Appends every scraped page to a JSONL file the moment it is parsed.
+
+    Each line is {"type": "page", "business_id": ..., "url": ..., ...}. A
+    {"type": "business_done"} line is written once a business crawl ends for any reason other
+    than a shutdown, so an interrupted run knows which businesses it still has to crawl.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.pages = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls(crawler.settings.get("SCRAPED_PAGES_FILE", SCRAPED_PAGES_FILE))
+        crawler.signals.connect(pipeline.spider_closed, signal=signals.spider_closed)
+        return pipeline
+
+    def open_spider(self, spider):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def process_item(self, item, spider):
+        append_record(self.fd, {"type": "page", **item})
+        self.pages += 1
+        return item
+
+    def spider_closed(self, spider, reason):
+        if reason != "shutdown":
+            append_record(self.fd, {
+                "type": "business_done",
+                "business_id": spider.business_id,
+                "pages": self.pages,
+                "suppressed_pages": getattr(spider, "suppressed_pages", 0),
+                "suppressed_chars": getattr(spider, "suppressed_chars", 0),
+            })
+        os.close(self.fd)
+
+
+def completed_businesses(path=SCRAPED_PAGES_FILE):
+    """Ids of businesses with a business_done record in the pages file."""
+    return {record["business_id"] for _, record in iter_records(path) if record.get("type") == "business_done"}
+
+
+def start_run(path=SCRAPED_PAGES_FILE):
+    """Returns the ids of businesses finished by an interrupted previous run, or None for a fresh run.
+
+    A pages file that ends with a "run_done" record belongs to a completed run and is
+    cleared so this run starts fresh.
+    """
+    completed = set()
+    last_type = None
+    for _, record in iter_records(path):
+        if record.get("type") == "business_done":
+            completed.add(record["business_id"])
+        last_type = record.get("type")
+    if last_type is None or last_type == "run_done":
+        open(path, "w").close()
+        return None
+    return completed
+
+
+def run_finished(path=SCRAPED_PAGES_FILE):
+    """True when the pages file ends with a "run_done" record, i.e. its crawl completed."""
+    if not os.path.exists(path):
+        return False
+    with open(path, "rb") as f:
+        f.seek(max(os.path.getsize(path) - 4096, 0))
+        lines = f.read().splitlines()
+    try:
+        return bool(lines) and json.loads(lines[-1]).get("type") == "run_done"
+    except json.JSONDecodeError:
+        return False
+
+
+def finish_run(path=SCRAPED_PAGES_FILE):
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    append_record(fd, {"type": "run_done"})
+    os.close(fd)
+
+
+def export_scraped_data(businesses, pages_file=SCRAPED_PAGES_FILE, output_file="scraped_data.json"):
+    """Writes the legacy scraped_data.json from the pages file, holding one business in memory at a time.
+
+    `businesses` are the business records without pages; each gets a "pages" list.
+    """
+    offsets = defaultdict(dict)  # business_id -> url -> offset of the latest copy of that page
+    for offset, record in iter_records(pages_file):
+        if record.get("type") == "page":
+            offsets[record["business_id"]][record["url"]] = offset
+
+    with open(pages_file, "ab+") as pages, open(output_file + ".tmp", "w", encoding="utf-8") as out:
+        out.write("[")
+        for i, business in enumerate(businesses):
+            page_list = []
+            for offset in offsets.get(business.get("business_id"), {}).values():
+                pages.seek(offset)
+                page = json.loads(pages.readline())
+                del page["type"], page["business_id"]
+                page_list.append(page)
+            out.write(",\n" if i else "\n")
+            out.write(json.dumps({**business, "pages": page_list}, ensure_ascii=False, indent=2))
+        out.write("\n]")
+    os.replace(output_file + ".tmp", output_file)
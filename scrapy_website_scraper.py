@@ -1,202 +1,418 @@
-import json
+import multiprocessing
 import os
+import queue
+import re
+import shutil
 from scrapy.crawler import CrawlerProcess
 from scrapy import Spider, Request, signals
+from scrapy.exceptions import CloseSpider
 from scrapy.utils.project import get_project_settings
 from urllib.parse import urlparse
+from crawl_cache import CRAWL_CACHE_FILE, CRAWL_REPORT, CrawlCache, content_hash, print_crawl_report
+from crawl_frontier import request_priority, score_link
+from domain_throttle import DOMAIN_STATS, print_domain_stats
+import metrics
+from metrics import METRICS
+from near_duplicates import GLOBAL_INDEX, NEAR_DUPLICATE_REPORT, SimHashIndex, canonicalize_url, simhash, \
+    print_near_duplicate_report
+from place_store import PlaceStore
+from scrape_output import SCRAPED_PAGES_FILE, completed_businesses, export_scraped_data, finish_run, \
+    read_new_records, start_run
+from text_extractor import DensityExtractor, extract_xpath_text
+
+JOB_DIR = "crawl_jobs"  # Per-business Scrapy scheduler state, so interrupted crawls can resume
 
 
 class BusinessSpider(Spider):
     name = 'business_spider'
 
-    def __init__(self, url=None, max_depth=2, business_data=None, *args, **kwargs):
+    def __init__(self, url=None, max_depth=2, business_id=None, extractor='xpath', max_pages=25, min_link_score=-3.0,
+                 max_links_per_page=10, *args, **kwargs):
         super(BusinessSpider, self).__init__(*args, **kwargs)
         self.start_urls = [url] if url else []
         self.max_depth = int(max_depth)
         self.visited_urls = set()
-        self.business_data = business_data or {}
-        self.page_contents = []
+        self.business_id = business_id or url
+        # Crawl budget: links are scored (crawl_frontier.score_link) and fetched best-first
+        self.max_pages = int(max_pages)
+        self.min_link_score = float(min_link_score)
+        self.max_links_per_page = int(max_links_per_page)
+        self.pages_crawled = 0
+        # 'xpath' keeps the original XPath chain; 'density' walks the DOM once and drops boilerplate
+        self.extractor = extractor
+        self.density_extractor = DensityExtractor()
+        self.crawl_cache = None
+        # Near-duplicate suppression: 'drop' skips the page, 'link' keeps an empty page pointing at
+        # the page it duplicates, 'off' disables it. Scope 'global' also compares across businesses.
+        self.near_duplicate_mode = 'drop'
+        self.near_duplicate_scope = 'business'
+        self.near_duplicates = SimHashIndex()
+        self.suppressed_pages = 0
+        self.suppressed_chars = 0
 
     @classmethod
     def from_crawler(cls, crawler, *args, **kwargs):
         spider = super(BusinessSpider, cls).from_crawler(crawler, *args, **kwargs)
+        cache_path = crawler.settings.get('CRAWL_CACHE_PATH')
+        if cache_path:
+            spider.crawl_cache = CrawlCache(cache_path)
+        spider.near_duplicate_mode = crawler.settings.get('NEAR_DUPLICATE_MODE', 'drop')
+        spider.near_duplicate_scope = crawler.settings.get('NEAR_DUPLICATE_SCOPE', 'business')
+        spider.near_duplicates = SimHashIndex(crawler.settings.getint('NEAR_DUPLICATE_DISTANCE', 6))
         crawler.signals.connect(spider.spider_closed, signal=signals.spider_closed)
         return spider
 
+    def find_near_duplicate(self, page_content, url):
+        """Returns the URL of an already kept page with near-identical text, indexing this one if new."""
+        fingerprint = simhash(page_content)
+        indexes = [self.near_duplicates]
+        if self.near_duplicate_scope == 'global':
+            indexes.append(GLOBAL_INDEX)
+        for index in indexes:
+            duplicate_of = index.find(fingerprint)
+            if duplicate_of:
+                return duplicate_of
+        for index in indexes:
+            index.add(fingerprint, url)
+        return None
+
     def parse(self, response, current_depth=0):
         # Skip if already visited
-        if response.url in self.visited_urls:
+        canonical_url = canonicalize_url(response.url)
+        if canonical_url in self.visited_urls:
             return
+        if self.pages_crawled >= self.max_pages:
+            return  # Budget spent; this response was already in flight when the spider started closing
 
-        self.visited_urls.add(response.url)
-
-        # Extract content intelligently
-        main_content = response.xpath(
-            '//*[self::main or self::article or self::section or self::div][contains(@class, "content") or contains(@class, "main") or contains(@class, "article") or contains(@class, "body")]')
+        self.visited_urls.add(canonical_url)
+        self.pages_crawled += 1
+        METRICS.count("pages_total", stage="crawl")
+        METRICS.observe("http_request_seconds", response.meta.get("download_latency", 0.0), stage="crawl")
 
-        if main_content:
-            text = ' '.join(main_content.xpath('.//text()').getall())
-            text = ' '.join(text.split())
-            if len(text) > 200:
-                page_content = text
+        # Extract content with the configured extractor
+        if self.extractor == 'density':
+            page_content = self.density_extractor.extract(response.selector.root)
         else:
-            # Fallback: get text from common content elements
-            content_elements = response.xpath(
-                '//*[self::p or self::li or self::h1 or self::h2 or self::h3 or self::h4 or self::h5 or self::span or self::div]/text()').getall()
-            text = ' '.join([el.strip() for el in content_elements if len(el.strip()) > 20])
-
-            # If still not enough content, get all text
-            if len(text) < 200:
-                text = ' '.join(response.xpath('//body//text()').getall())
-                text = ' '.join(text.split())
-
-            page_content = text
+            page_content = extract_xpath_text(response)
+
+        duplicate_of = None
+        if page_content and len(page_content) > 100 and self.near_duplicate_mode != 'off':
+            duplicate_of = self.find_near_duplicate(page_content, response.url)
+            if duplicate_of:
+                self.suppressed_pages += 1
+                self.suppressed_chars += len(page_content)
+                NEAR_DUPLICATE_REPORT["pages_suppressed"] += 1
+                NEAR_DUPLICATE_REPORT["chars_suppressed"] += len(page_content)
+                print(f"Skipping {response.url}: near-duplicate of {duplicate_of}")
+                if self.near_duplicate_mode == 'link':
+                    yield {
+                        "business_id": self.business_id,
+                        "url": response.url,
+                        "content": "",
+                        "depth": current_depth,
+                        "duplicate_of": duplicate_of
+                    }
 
         # Store page content with its URL
-        if page_content and len(page_content) > 100:  # Only store pages with sufficient content
-            self.page_contents.append({
+        if not duplicate_of and page_content and len(page_content) > 100:  # Only store pages with sufficient content
+            page_hash = content_hash(page_content)
+            # Unchanged pages can be skipped by extract_activities.py
+            unchanged = self.crawl_cache.record_hash(response.url, page_hash) if self.crawl_cache else False
+            # Pages are streamed out through PageStreamPipeline instead of kept in memory
+            yield {
+                "business_id": self.business_id,
                 "url": response.url,
                 "content": page_content,
-                "depth": current_depth
-            })
-            print(f"Scraped {len(page_content)} characters from {response.url} (depth: {current_depth})")
+                "depth": current_depth,
+                "content_hash": page_hash,
+                "unchanged": unchanged
+            }
+            status = "unchanged" if unchanged else "new/changed"
+            print(f"Scraped {len(page_content)} characters from {response.url} (depth: {current_depth}, {status})")
+
+        if self.pages_crawled >= self.max_pages:
+            print(f"Page budget of {self.max_pages} reached for {self.business_id}")
+            raise CloseSpider('page_budget')
 
         # Follow links if we haven't reached max depth
         if current_depth < self.max_depth:
-            links = response.css('a::attr(href)').getall()
-
-            # Filter to internal links
+            # Filter to internal links and score them by anchor text, path and depth
             base_domain = urlparse(response.url).netloc
-            internal_links = []
+            scored_links = {}  # canonical url -> (score, url as linked)
 
-            for link in links:
+            for anchor in response.css('a'):
+                link = anchor.attrib.get('href')
                 if link and not link.startswith(('#', 'javascript:', 'mailto:', 'tel:')):
+                    # Requested as linked: the site may redirect its canonical form (/rooms -> /rooms/),
+                    # and redirects are not followed. The canonical form only dedupes.
                     absolute_url = response.urljoin(link)
+                    canonical_url = canonicalize_url(absolute_url)
                     link_domain = urlparse(absolute_url).netloc
-                    if base_domain == link_domain and absolute_url not in self.visited_urls:
-                        internal_links.append(absolute_url)
-
-            # Remove duplicates and limit links
-            unique_links = list(set(internal_links))[:10]  # Follow max 10 links per page
-
-            for link in unique_links:
+                    if base_domain != link_domain or canonical_url in self.visited_urls:
+                        continue
+                    anchor_text = ' '.join(anchor.css('::text').getall() + [anchor.attrib.get('title', '')])
+                    score = score_link(absolute_url, anchor_text, current_depth + 1)
+                    if score is not None and score >= self.min_link_score:
+                        best_score, first_url = scored_links.get(canonical_url, (score, absolute_url))
+                        scored_links[canonical_url] = (max(score, best_score), first_url)
+
+            # Follow the best links on this page; low scorers are never scheduled
+            best_links = sorted(scored_links.values(), key=lambda item: item[0], reverse=True)
+            for score, link in best_links[:self.max_links_per_page]:
                 yield Request(
                     url=link,
                     callback=self.parse,
                     cb_kwargs={'current_depth': current_depth + 1},
                     meta={'dont_redirect': True},
+                    priority=request_priority(score),
                 )
 
     def spider_closed(self, spider):
-        """Called when spider closes - store the collected pages."""
-        # Update the business data with the collected pages
-        self.business_data["pages"] = self.page_contents
-        self.business_data["base_url"] = self.start_urls[0] if self.start_urls else None
-
-
-def scrape_with_scrapy(businesses, max_depth=2, output_file="scraped_data.json"):
-    """Scrape websites using Scrapy."""
-    # Set up a list to collect results
-    scraped_data = []
-
-    # Configure Scrapy settings
+        """Called when spider closes - release the crawl cache."""
+        if self.crawl_cache:
+            self.crawl_cache.close()
+
+
+def business_record(business, **extra):
+    """The per-business fields written to scraped_data.json (pages are added on export)."""
+    website = business.get("website")
+    return {
+        "business_id": business.get("place_id") or website,
+        "place_id": business.get("place_id"),
+        "name": business.get("name", ""),
+        "website": website,
+        "base_url": website,
+        "latitude": business.get("latitude"),
+        "longitude": business.get("longitude"),
+        **extra
+    }
+
+
+def crawl_settings(crawl_cache=CRAWL_CACHE_FILE, pages_file=SCRAPED_PAGES_FILE, global_concurrency=32):
+    """Scrapy settings shared by every business crawl."""
     settings = get_project_settings()
     settings.update({
         'ROBOTSTXT_OBEY': True,
-        'DOWNLOAD_DELAY': 1.5,
+        'DOWNLOAD_DELAY': 1.5,  # Starting delay; AdaptiveDomainThrottle tunes it per domain
+        'CONCURRENT_REQUESTS_PER_DOMAIN': 1,  # Raised per domain while it responds quickly
+        'ADAPTIVE_THROTTLE_MIN_DELAY': 0.25,
+        'ADAPTIVE_THROTTLE_MAX_DELAY': 10.0,
+        'ADAPTIVE_THROTTLE_MAX_CONCURRENCY': 4,
+        'ADAPTIVE_THROTTLE_MAX_FAILURES': 3,  # Consecutive timeouts before a domain is abandoned
+        'ADAPTIVE_THROTTLE_GLOBAL_CONCURRENCY': global_concurrency,
+        'NEAR_DUPLICATE_MODE': 'drop',
+        'NEAR_DUPLICATE_SCOPE': 'business',
+        'NEAR_DUPLICATE_DISTANCE': 6,  # Max differing SimHash bits
         'COOKIES_ENABLED': False,
         'USER_AGENT': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
         'LOG_LEVEL': 'WARNING',
+        'TELNETCONSOLE_ENABLED': False,  # Sharded workers would each open a console port
         'DEPTH_PRIORITY': 1,
         'SCHEDULER_DISK_QUEUE': 'scrapy.squeues.PickleFifoDiskQueue',
         'SCHEDULER_MEMORY_QUEUE': 'scrapy.squeues.FifoMemoryQueue',
         'DOWNLOAD_TIMEOUT': 15,
-        'RETRY_TIMES': 2
+        'RETRY_TIMES': 2,
+        'CRAWL_CACHE_PATH': crawl_cache,
+        'SCRAPED_PAGES_FILE': pages_file,
+        'ITEM_PIPELINES': {
+            'scrape_output.PageStreamPipeline': 300,
+        },
+        'DOWNLOADER_MIDDLEWARES': {
+            # Below HttpCompressionMiddleware so cached bodies are stored decompressed
+            'crawl_cache.ConditionalRequestMiddleware': 580,
+            # Close to the downloader so it sees raw latencies and timeouts before RetryMiddleware
+            'domain_throttle.AdaptiveDomainThrottle': 900,
+        },
+        # Takes the global slot when the transfer starts, after the domain's delay
+        'DOWNLOAD_HANDLERS': {
+            'http': 'domain_throttle.GlobalSlotDownloadHandler',
+            'https': 'domain_throttle.GlobalSlotDownloadHandler',
+        },
     })
+    return settings
 
+
+def run_crawl(records, settings, max_depth, job_dir, extractor, max_pages):
+    """Crawls the given business records in one CrawlerProcess and blocks until it finishes."""
     # Set up the Crawler Process
     process = CrawlerProcess(settings)
 
     # Add a spider for each business
-    for business in businesses:
-        website = business.get("website")
-        if not website:
-            print(f"No website found for {business.get('name', 'unknown business')}, skipping...")
-            # Add the business with empty pages to maintain consistency
-            scraped_data.append({
-                "name": business.get("name", ""),
-                "website": None,
-                "pages": [],
-                "latitude": business.get("latitude"),
-                "longitude": business.get("longitude")
-            })
-            continue
-
+    for record in records:
         try:
-            # Create business data to be updated by the spider
-            business_data = {
-                "name": business.get("name", ""),
-                "website": website,
-                "pages": [],
-                "latitude": business.get("latitude"),
-                "longitude": business.get("longitude")
-            }
-
+            # Each business gets its own job directory so its queue survives an interruption
+            business_job_dir = os.path.join(job_dir, re.sub(r'[^\w.-]', '_', record["business_id"]))
+            spider_cls = type('BusinessSpider', (BusinessSpider,), {
+                'custom_settings': {'JOBDIR': business_job_dir},
+            })
             process.crawl(
-                BusinessSpider,
-                url=website,
+                spider_cls,
+                url=record["website"],
                 max_depth=max_depth,
-                business_data=business_data
+                business_id=record["business_id"],
+                extractor=extractor,
+                max_pages=max_pages
             )
-
-            # Store the business data to retrieve after crawling
-            scraped_data.append(business_data)
-            print(f"Added spider for {website} with max depth {max_depth}")
+            print(f"Added spider for {record['website']} with max depth {max_depth}")
 
         except Exception as e:
-            print(f"Error processing {business.get('name', 'unknown business')}: {str(e)}")
+            print(f"Error processing {record['name'] or 'unknown business'}: {str(e)}")
             # Add the business with error information
-            scraped_data.append({
-                "name": business.get("name", ""),
-                "website": website,
-                "pages": [],
-                "latitude": business.get("latitude"),
-                "longitude": business.get("longitude"),
-                "error": str(e)
-            })
+            record["error"] = str(e)
 
     # Start the crawling process
     print("Starting the crawl process...")
     process.start()
     print("Crawl process completed.")
 
-    # Save the scraped data
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(scraped_data, f, ensure_ascii=False, indent=2)
 
-    print(f"Scraped data for {len(scraped_data)} businesses and saved to {output_file}")
+def crawl_shard(shard, records, crawl_cache, pages_file, global_concurrency, max_depth, job_dir, extractor,
+                max_pages, reports):
+    """Worker process entry point: crawls one shard of businesses with its own reactor."""
+    settings = crawl_settings(crawl_cache, pages_file, global_concurrency)
+    run_crawl(records, settings, max_depth, job_dir, extractor, max_pages)
+    errors = {record["business_id"]: record["error"] for record in records if "error" in record}
+    reports.put((shard, errors, DOMAIN_STATS, CRAWL_REPORT, NEAR_DUPLICATE_REPORT, METRICS.snapshot()))
+
+
+def run_sharded_crawl(records, workers, crawl_cache, pages_file, max_depth, job_dir, extractor, max_pages,
+                      global_concurrency=32):
+    """Splits the businesses across `workers` processes and merges their stats into this process.
+
+    Every worker appends to the same pages file, so results need no merging. A crashed
+    worker only loses its own unfinished businesses, which resume on the next run.
+    """
+    shards = [records[i::workers] for i in range(workers)]
+    context = multiprocessing.get_context("spawn")
+    reports = context.Queue()
+    processes = []
+    for shard, shard_records in enumerate(shards):
+        process = context.Process(
+            target=crawl_shard,
+            args=(shard, shard_records, crawl_cache, pages_file, max(1, global_concurrency // workers), max_depth,
+                  job_dir, extractor, max_pages, reports),
+        )
+        process.start()
+        processes.append(process)
+    print(f"Started {workers} crawl workers for {len(records)} businesses")
+
+    def collect(timeout):
+        try:
+            shard, errors, domain_stats, crawl_report, near_duplicate_report, metrics_snapshot = \
+                reports.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        for record in shards[shard]:
+            if record["business_id"] in errors:
+                record["error"] = errors[record["business_id"]]
+        DOMAIN_STATS.update(domain_stats)
+        METRICS.merge(metrics_snapshot)
+        for totals, counts in ((CRAWL_REPORT, crawl_report), (NEAR_DUPLICATE_REPORT, near_duplicate_report)):
+            for key, value in counts.items():
+                totals[key] += value
+        return True
+
+    # Report progress from the business_done records the workers append
+    offset, done, collected = os.path.getsize(pages_file) if os.path.exists(pages_file) else 0, 0, 0
+    while any(process.is_alive() for process in processes):
+        collected += collect(timeout=2)
+        records_since, offset = read_new_records(pages_file, offset)
+        finished = sum(1 for record in records_since if record.get("type") == "business_done")
+        if finished:
+            done += finished
+            print(f"Progress: {done}/{len(records)} businesses crawled")
+
+    expected = sum(1 for process in processes if process.exitcode == 0)
+    while collected < expected and collect(timeout=5):
+        collected += 1
+    for shard, process in enumerate(processes):
+        process.join()
+        if process.exitcode != 0:
+            print(f"Crawl worker {shard} exited with code {process.exitcode}; "
+                  f"its unfinished businesses will resume on the next run")
+
+
+def scrape_with_scrapy(businesses, max_depth=2, output_file="scraped_data.json", crawl_cache=CRAWL_CACHE_FILE,
+                       pages_file=SCRAPED_PAGES_FILE, job_dir=JOB_DIR, extractor='xpath', max_pages=25, workers=1):
+    """Scrape websites using Scrapy.
+
+    Pages are streamed to `pages_file` as they are parsed and `output_file` is written from it
+    once the crawl is over. If the previous run was interrupted, businesses it finished are
+    skipped and the others resume from their scheduler state in `job_dir`. Pages are
+    revalidated against `crawl_cache` (None disables it) and marked unchanged when their
+    content matches the previous crawl. `extractor` selects how page text is extracted
+    ('xpath' or 'density', see text_extractor.py). Each business crawl stops after `max_pages`
+    pages, fetching the most promising links first. With `workers` > 1 the businesses are
+    sharded across that many processes, each parsing on its own core. With `output_file` None
+    the pages are left in `pages_file` only.
+    """
+    # Business records without pages; pages live in pages_file
+    scraped_data = []
 
-    return scraped_data
+    completed = start_run(pages_file)
+    if completed is not None:
+        print(f"Resuming interrupted crawl: {len(completed)} businesses already done")
+    else:
+        completed = set()
+        shutil.rmtree(job_dir, ignore_errors=True)
 
+    pending = []
+    for business in businesses:
+        record = business_record(business)
+        scraped_data.append(record)
+        if not record["website"]:
+            print(f"No website found for {business.get('name', 'unknown business')}, skipping...")
+        elif record["business_id"] not in completed:
+            pending.append(record)
+
+    with METRICS.stage("crawl") as stage:
+        pages_before = METRICS.value("pages_total", stage="crawl")
+        if workers > 1 and len(pending) > 1:
+            run_sharded_crawl(pending, min(workers, len(pending)), crawl_cache, pages_file, max_depth, job_dir,
+                              extractor, max_pages)
+        else:
+            run_crawl(pending, crawl_settings(crawl_cache, pages_file), max_depth, job_dir, extractor, max_pages)
+        pages = METRICS.value("pages_total", stage="crawl") - pages_before
+        stage.add(pages)
+    if crawl_cache:
+        # A 304 revalidation is a crawl cache hit; every other fetched page a miss
+        METRICS.count("cache_lookups_total", CRAWL_REPORT["pages_revalidated"], namespace="crawl", outcome="hits")
+        METRICS.count("cache_lookups_total", max(pages - CRAWL_REPORT["pages_revalidated"], 0), namespace="crawl",
+                      outcome="misses")
+    print_domain_stats()
+    print_near_duplicate_report()
+    if crawl_cache:
+        print_crawl_report()
 
-if __name__ == "__main__":
-    places_file = "places.json"
+    # Save the scraped data
+    if output_file:
+        export_scraped_data(scraped_data, pages_file, output_file)
+    completed = completed_businesses(pages_file)
+    unfinished = [record for record in scraped_data if record["website"] and "error" not in record
+                  and record["business_id"] not in completed]
+    if unfinished:
+        print(f"Crawl interrupted with {len(unfinished)} businesses unfinished; run again to resume.")
+    else:
+        finish_run(pages_file)
+        shutil.rmtree(job_dir, ignore_errors=True)
+
+    print(f"Scraped data for {len(scraped_data)} businesses" + (f" and saved to {output_file}" if output_file else ""))
 
-    if not os.path.exists(places_file):
-        print(f"Error: {places_file} not found. Please run find_places.py first.")
-        exit(1)
+    return scraped_data
 
-    try:
-        with open(places_file, "r", encoding="utf-8") as f:
-            businesses = json.load(f)
-            print(f"Loaded {len(businesses)} businesses from {places_file}")
-    except (json.JSONDecodeError, UnicodeDecodeError) as e:
-        print(f"Error loading {places_file}: {str(e)}")
+
+if __name__ == "__main__":
+    store = PlaceStore()
+    if len(store) == 0:
+        print(f"Error: no places in {store.path}. Please run find_places.py first.")
         exit(1)
 
-    # Filter out businesses without websites
-    businesses_with_websites = [b for b in businesses if "website" in b and b["website"]]
-    print(f"Found {len(businesses_with_websites)} businesses with websites")
+    # Only businesses with websites can be scraped
+    businesses_with_websites = list(store.iter_places(has_website=True))
+    print(f"Found {len(businesses_with_websites)} businesses with websites in {store.path}")
+    store.close()
 
-    # Run the scraper
-    scraped_data = scrape_with_scrapy(businesses_with_websites, max_depth=3)
\ No newline at end of file
+    # Run the scraper, one crawl process per core
+    metrics.start()
+    scraped_data = scrape_with_scrapy(businesses_with_websites, max_depth=3, workers=os.cpu_count() or 1)
+    metrics.finish()
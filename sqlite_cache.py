@@ -0,0 +1,100 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from metrics import METRICS
+
+
+def cache_key(namespace, *parts):
+    """Builds a stable cache key from a namespace and any JSON-serializable parts."""
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return f"{namespace}:{digest}"
+
+
+class SQLiteCache:
+    """Persistent key/value cache with per-entry TTLs and least-recently-used eviction.
+
+    Keys are namespaced strings (see `cache_key`); hits and misses are counted per
+    namespace. With `bypass=True` lookups always miss but fresh values are still stored.
+    """
+
+    def __init__(self, path, max_entries=50000, bypass=False):
+        self.path = path
+        self.max_entries = max_entries
+        self.bypass = bypass
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+        self.conn.commit()
+
+    def _count(self, key, outcome):
+        namespace = key.split(":", 1)[0]
+        counts = self.stats.setdefault(namespace, {"hits": 0, "misses": 0})
+        counts[outcome] += 1
+        METRICS.count("cache_lookups_total", namespace=namespace, outcome=outcome)
+
+    def __contains__(self, key):
+        """True when a fresh entry exists for `key`; does not count towards the stats."""
+        with self.lock:
+            if self.bypass:
+                return False
+            row = self.conn.execute("SELECT expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+            return row is not None and (row[0] is None or row[0] >= time.time())
+
+    def get(self, key):
+        """Returns the cached value for `key`, or None when missing, expired or bypassed."""
+        with self.lock:
+            if self.bypass:
+                self._count(key, "misses")
+                return None
+            now = time.time()
+            row = self.conn.execute("SELECT value, expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < now):
+                self._count(key, "misses")
+                return None
+            self.conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self._count(key, "hits")
+            return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        """Stores `value` under `key`, expiring after `ttl` seconds (never when None)."""
+        with self.lock:
+            now = time.time()
+            expires_at = now + ttl if ttl is not None else None
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires_at, now)
+            )
+            self._evict(now)
+            self.conn.commit()
+
+    def _evict(self, now):
+        self.conn.execute("DELETE FROM entries WHERE expires_at IS NOT NULL AND expires_at < ?", (now,))
+        overflow = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.max_entries
+        if overflow > 0:
+            # Evict a little extra so we don't run this on every insert once full
+            overflow += self.max_entries // 10
+            self.conn.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY accessed_at LIMIT ?)",
+                (overflow,)
+            )
+
+    def summary(self):
+        """Returns a one-line hit/miss summary per namespace."""
+        if not self.stats:
+            return "no lookups"
+        return ", ".join(
+            f"{namespace}: {counts['hits']} hits / {counts['misses']} misses"
+            for namespace, counts in sorted(self.stats.items())
+        )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -1,23 +1,248 @@
+import argparse
+import hashlib
 import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.api_core import exceptions
+from activity_clusters import activity_key, normalize_name
+from activity_merger import iter_activities
+import metrics
+from metrics import METRICS
 
-cred = credentials.Certificate("your-firebase-key.json")  # Replace with actual Firebase key
-firebase_admin.initialize_app(cred)
-db = firestore.client()
+FIREBASE_KEY_FILE = os.getenv("FIREBASE_KEY_FILE", "your-firebase-key.json")  # Replace with actual Firebase key
+COLLECTION = "activities"
+UPLOAD_BATCH_SIZE = 500  # Firestore's limit on writes in one batch
+UPLOAD_WORKERS = 8  # Batches committed concurrently
+MAX_RETRIES = 4
+RETRY_BACKOFF = 0.5  # Seconds, doubled on every retry
+RETRYABLE_ERRORS = (exceptions.Aborted, exceptions.DeadlineExceeded, exceptions.InternalServerError,
+                    exceptions.ResourceExhausted, exceptions.ServiceUnavailable)
+UPLOAD_STATE_FILE = "firestore_uploads.db"
 
 
-def store_activities():
-    """Reads activities.json and stores the data in Firestore."""
-    print("Storing activities in Firestore...")
-    with open("activities.json", "r") as f:
-        activities = json.load(f)
+def firestore_client(key_file=FIREBASE_KEY_FILE):
+    """Connects to Firestore; set FIRESTORE_EMULATOR_HOST to use the local emulator instead."""
+    try:
+        firebase_admin.get_app()
+    except ValueError:  # No app initialized yet
+        if os.getenv("FIRESTORE_EMULATOR_HOST"):
+            firebase_admin.initialize_app(options={"projectId": os.getenv("GCLOUD_PROJECT", "demo-activities")})
+        else:
+            firebase_admin.initialize_app(credentials.Certificate(key_file))
+    return firestore.client()
+
+
+def document_id(activity):
+    """Deterministic id for an activity: its normalized name plus the place it belongs to.
+
+    Re-running an upload overwrites the same documents instead of adding copies, and an
+    edited description updates the existing document.
+    """
+    name = activity.get("activity_name") or activity.get("name") or ""
+    place = activity.get("place_id") or [activity.get("latitude"), activity.get("longitude")]
+    identity = json.dumps([normalize_name(name), place], ensure_ascii=False)
+    return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+
+class UploadState:
+    """Content hash of every document as last uploaded, so unchanged documents are skipped."""
+
+    def __init__(self, path=UPLOAD_STATE_FILE):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS uploads (collection TEXT NOT NULL, doc_id TEXT NOT NULL, "
+                          "content_hash TEXT NOT NULL, PRIMARY KEY (collection, doc_id))")
+        self.conn.commit()
+
+    def uploaded_hashes(self, collection):
+        return dict(self.conn.execute("SELECT doc_id, content_hash FROM uploads WHERE collection = ?",
+                                      (collection,)))
+
+    def record(self, collection, hashes):
+        self.conn.executemany("INSERT OR REPLACE INTO uploads (collection, doc_id, content_hash) VALUES (?, ?, ?)",
+                              [(collection, doc_id, content_hash) for doc_id, content_hash in hashes])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
 
+
+def commit_batch(db, collection, documents, max_retries=MAX_RETRIES):
+    """Writes (doc_id, activity) pairs as one batch, retrying with backoff on transient errors."""
+    for attempt in range(max_retries + 1):
+        batch = db.batch()
+        for doc_id, activity in documents:
+            batch.set(db.collection(collection).document(doc_id), activity)
+        try:
+            with METRICS.timer("firestore_commit_seconds"):
+                batch.commit()
+            return
+        except RETRYABLE_ERRORS:
+            if attempt == max_retries:
+                raise
+            METRICS.count("firestore_retries_total")
+            time.sleep(RETRY_BACKOFF * (2 ** attempt) * (1 + random.random()))
+
+
+def upload_activities(db, activities, collection=COLLECTION, state=None, batch_size=UPLOAD_BATCH_SIZE,
+                      workers=UPLOAD_WORKERS):
+    """Upserts activities under deterministic ids in concurrent batches; returns upload counts.
+
+    Documents whose content hash matches the one in `state` from the last upload are
+    skipped. Hashes are recorded only after their batch commits, so a failed run is
+    simply re-run. When two activities share an id, the later one wins.
+    """
+    uploaded = state.uploaded_hashes(collection) if state else {}
+    pending_docs = {}
+    total = 0
     for activity in activities:
-        db.collection("activities").add(activity)
-        print(f"Stored activity: {activity['name']}")
-    print("All activities saved to Firestore!")
+        total += 1
+        pending_docs[document_id(activity)] = activity
+    counts = {"activities": total, "duplicate_ids": total - len(pending_docs), "unchanged": 0,
+              "written": 0, "failed": 0}
+
+    batches, batch = [], []
+    for doc_id, activity in pending_docs.items():
+        content_hash = activity_key(activity)
+        if uploaded.get(doc_id) == content_hash:
+            counts["unchanged"] += 1
+            continue
+        batch.append((doc_id, activity, content_hash))
+        if len(batch) == batch_size:
+            batches.append(batch)
+            batch = []
+    if batch:
+        batches.append(batch)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(commit_batch, db, collection, [(doc_id, activity) for doc_id, activity, _ in b]): b
+                   for b in batches}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                b = futures.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    counts["failed"] += len(b)
+                    print(f"Failed to upload a batch of {len(b)} activities: {e}")
+                    continue
+                counts["written"] += len(b)
+                if state:
+                    state.record(collection, [(doc_id, content_hash) for doc_id, _, content_hash in b])
+    return counts
+
+
+class FakeFirestore:
+    """In-process stand-in for a Firestore client with a fixed round trip per commit, for benchmarks."""
+
+    def __init__(self, latency=0.02, failure_rate=0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.documents = {}
+        self.commits = 0
+        self.lock = threading.Lock()
+
+    def collection(self, name):
+        return FakeCollection(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def _commit(self, writes):
+        time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            raise exceptions.ServiceUnavailable("simulated outage")
+        with self.lock:
+            self.commits += 1
+            self.documents.update(writes)
+
+
+class FakeCollection:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def document(self, doc_id=None):
+        return self.db, self.name, doc_id or os.urandom(10).hex()
+
+    def add(self, data):
+        self.db._commit({self.document()[1:]: data})
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = {}
+
+    def set(self, ref, data):
+        self.writes[ref[1:]] = data
+
+    def commit(self):
+        self.db._commit(self.writes)
+
+
+def benchmark_upload(activities, latency=0.02):
+    """Compares one add() per activity with batched uploads against a fake client with `latency` per commit."""
+    sample = activities[:200]
+    db = FakeFirestore(latency)
+    start = time.perf_counter()
+    for activity in sample:
+        db.collection(COLLECTION).add(activity)
+    print(f"add() per activity: {len(sample) / (time.perf_counter() - start):.0f} docs/s")
+
+    db = FakeFirestore(latency, failure_rate=0.05)
+    with tempfile.TemporaryDirectory() as directory:
+        state = UploadState(os.path.join(directory, "uploads.db"))
+        for run in ("first upload", "re-run"):
+            start = time.perf_counter()
+            counts = upload_activities(db, activities, state=state)
+            elapsed = time.perf_counter() - start
+            print(f"batched {run}: {counts['written']} written, {counts['unchanged']} unchanged, "
+                  f"{counts['failed']} failed in {elapsed:.2f}s "
+                  f"({counts['written'] / elapsed:.0f} docs/s), {len(db.documents)} documents stored")
+        state.close()
+
+
+def store_activities(activities_file="activities.json", collection=COLLECTION):
+    """Reads activities and upserts them into Firestore, skipping those unchanged since the last upload."""
+    print("Storing activities in Firestore...")
+    db = firestore_client()
+    state = UploadState()
+    start = time.perf_counter()
+    counts = upload_activities(db, iter_activities(activities_file), collection, state)
+    elapsed = time.perf_counter() - start
+    METRICS.stage_done("upload", elapsed, counts["written"])
+    METRICS.count("firestore_documents_total", counts["unchanged"], outcome="unchanged")
+    METRICS.count("firestore_documents_total", counts["written"], outcome="written")
+    METRICS.count("firestore_documents_total", counts["failed"], outcome="failed")
+    state.close()
+    print(f"Uploaded {counts['written']} of {counts['activities']} activities to {collection} "
+          f"({counts['unchanged']} unchanged, {counts['duplicate_ids']} sharing an id, {counts['failed']} failed) "
+          f"in {elapsed:.1f}s, {counts['written'] / max(elapsed, 1e-9):.0f} docs/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload activities to Firestore.")
+    parser.add_argument("activities", nargs="?", default="activities.json",
+                        help="Activities as a JSON array, or a JSONL file such as activities.jsonl")
+    parser.add_argument("--collection", default=COLLECTION)
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Measure upload throughput against an in-process fake Firestore")
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark_upload(list(iter_activities(args.activities)))
+        return
+    metrics.start()
+    store_activities(args.activities, args.collection)
+    metrics.finish()
 
 
 if __name__ == "__main__":
-    store_activities()
+    main()
@@ -0,0 +1,193 @@
+"""Local stand-ins for many small business websites, for crawl tests and benchmarks.
+
+Each site gets its own loopback address (127.0.0.2, 127.0.0.3, ...) so Scrapy treats it as a
+separate domain with its own download slot. Run this file to time a crawl against them, or
+with --workers to time sharded crawls of the HTML fixtures.
+"""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ("escape", "room", "puzzle", "mystery", "clue", "team", "vault", "heist", "pirate", "lab", "curse",
+         "tomb", "detective", "agent", "bunker", "castle", "jungle", "prison", "train", "museum")
+
+
+def host_address(index):
+    return f"127.0.{index // 250}.{index % 250 + 2}"
+
+
+def generated_page(site, page, pages):
+    """A small page about one room; the home page links to every room."""
+    rng = random.Random(f"{site}/{page}")
+    text = " ".join(rng.choice(WORDS) for _ in range(120))
+    links = "".join(f'<li><a href="/rooms/room-{k}">Escape room {k}</a></li>' for k in range(1, pages)) if page == 0 else ""
+    return (f"<html><body><h1>Site {site} room {page}</h1><p>{rng.randint(45, 90)} minutes, "
+            f"{rng.randint(2, 4)}-{rng.randint(5, 10)} players. {text}</p><ul>{links}</ul></body></html>").encode()
+
+
+class StubSites:
+    """Serves `hosts` websites of `pages` pages each, answering every request after `latency` seconds.
+
+    Counts requests and the most that were in flight at once across all hosts. `bodies`, a
+    list of HTML documents, replaces the generated room pages (the home page still links to them).
+    """
+
+    def __init__(self, hosts=50, pages=5, latency=0.05, bodies=None):
+        self.hosts = hosts
+        self.pages = pages
+        self.latency = latency
+        self.bodies = bodies
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self.servers = []
+
+    def _handler(self, site):
+        sites = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/robots.txt":
+                    self.send_error(404)
+                    return
+                with sites.lock:
+                    sites.requests += 1
+                    sites.in_flight += 1
+                    sites.max_in_flight = max(sites.max_in_flight, sites.in_flight)
+                try:
+                    time.sleep(sites.latency)
+                    page = int(self.path.rsplit("-", 1)[1]) if self.path.startswith("/rooms/room-") else 0
+                    if sites.bodies and page:
+                        body = sites.bodies[(site * sites.pages + page) % len(sites.bodies)]
+                    else:
+                        body = generated_page(site, page, sites.pages)
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/html; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                finally:
+                    with sites.lock:
+                        sites.in_flight -= 1
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        for site in range(self.hosts):
+            server = ThreadingHTTPServer((host_address(site), 0), self._handler(site))
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+        return self
+
+    def stop(self):
+        # shutdown() waits out a poll interval, so stop every server at once
+        stopping = [threading.Thread(target=server.shutdown) for server in self.servers]
+        for thread in stopping:
+            thread.start()
+        for thread, server in zip(stopping, self.servers):
+            thread.join()
+            server.server_close()
+        self.servers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    @property
+    def urls(self):
+        return [f"http://{server.server_address[0]}:{server.server_address[1]}/" for server in self.servers]
+
+
+def load_fixtures(fixture_dir):
+    """The .html files in `fixture_dir`, as bytes."""
+    bodies = []
+    for name in sorted(os.listdir(fixture_dir)):
+        if name.endswith((".html", ".htm")):
+            with open(os.path.join(fixture_dir, name), "rb") as f:
+                bodies.append(f.read())
+    return bodies
+
+
+def site_records(urls):
+    return [{"business_id": f"site-{i}", "website": url, "name": url} for i, url in enumerate(urls)]
+
+
+def crawl_sites(urls, pages_file, job_dir, global_concurrency, extractor="xpath", max_depth=1, max_pages=25):
+    """Crawls `urls` with the project's crawl settings in this process; run it in a child process."""
+    from scrapy_website_scraper import crawl_settings, run_crawl
+    settings = crawl_settings(None, pages_file, global_concurrency)
+    run_crawl(site_records(urls), settings, max_depth, job_dir, extractor, max_pages)
+
+
+def timed_crawl(sites, global_concurrency, pages_file=None, **options):
+    """Crawls every stub site in a child process; returns the wall-clock seconds it took.
+
+    Pages go to `pages_file`, or to a temporary file that is discarded.
+    """
+    import multiprocessing
+    with tempfile.TemporaryDirectory() as directory:
+        process = multiprocessing.get_context("spawn").Process(target=crawl_sites, args=(
+            sites.urls, pages_file or os.path.join(directory, "pages.jsonl"), os.path.join(directory, "jobs"),
+            global_concurrency,
+        ), kwargs=options)
+        start = time.perf_counter()
+        process.start()
+        process.join()
+        elapsed = time.perf_counter() - start
+        if process.exitcode != 0:
+            raise RuntimeError(f"crawl exited with code {process.exitcode}")
+    return elapsed
+
+
+def timed_sharded_crawl(sites, workers, global_concurrency=32, extractor="density"):
+    """Crawls every stub site with run_sharded_crawl; returns the seconds taken and the pages stored."""
+    from scrape_output import iter_records
+    from scrapy_website_scraper import run_sharded_crawl
+    with tempfile.TemporaryDirectory() as directory:
+        pages_file = os.path.join(directory, "pages.jsonl")
+        start = time.perf_counter()
+        run_sharded_crawl(site_records(sites.urls), workers, None, pages_file, 1, os.path.join(directory, "jobs"),
+                          extractor, 25, global_concurrency)
+        elapsed = time.perf_counter() - start
+        pages = sum(1 for _, record in iter_records(pages_file) if record.get("type") == "page")
+    return elapsed, pages
+
+
+if __name__ == "__main__":
+    import sys
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser = argparse.ArgumentParser(description="Time a crawl of many local stub sites.")
+    parser.add_argument("--hosts", type=int, default=100)
+    parser.add_argument("--pages", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--global-concurrency", type=int, default=16)
+    parser.add_argument("--workers", type=int, nargs="+",
+                        help="Time run_sharded_crawl with each of these worker counts on the fixture pages")
+    parser.add_argument("--fixtures", default="html_fixtures", help="Pages served by --workers runs")
+    args = parser.parse_args()
+    if args.workers:
+        with StubSites(args.hosts, args.pages, args.latency, load_fixtures(args.fixtures)) as sites:
+            for workers in args.workers:
+                requests_before = sites.requests
+                elapsed, pages = timed_sharded_crawl(sites, workers, args.global_concurrency)
+                fetched = sites.requests - requests_before
+                print(f"{workers:>3} workers: {fetched} pages fetched, {pages} stored in {elapsed:.1f}s "
+                      f"({fetched / elapsed:.1f} pages/s)")
+        sys.exit(0)
+    with StubSites(args.hosts, args.pages, args.latency) as sites:
+        elapsed = timed_crawl(sites, args.global_concurrency)
+        print(f"{sites.requests} pages from {args.hosts} hosts in {elapsed:.1f}s "
+              f"({sites.requests / elapsed:.1f} pages/s), at most {sites.max_in_flight} in flight "
+              f"(cap {args.global_concurrency})")
@@ -0,0 +1,31 @@
+import pytest
+
+from activity_merger import PlaceIndex
+
+PLACES = [
+    {"place_id": "a", "name": "Enigma Room", "latitude": 43.655663, "longitude": -79.3846061},
+    {"place_id": "b", "name": "Lockdown", "latitude": 43.6557, "longitude": -79.3846061},  # About 4 m north
+]
+
+
+def located(lat, lng, name="Room"):
+    return {"name": name, "latitude": lat, "longitude": lng}
+
+
+def test_location_match_within_tolerance():
+    index = PlaceIndex(PLACES, tolerance=50)
+    place, how = index.match(located(43.65567, -79.38461, "Enigma Room"))
+    assert (place["place_id"], how) == ("a", "location")
+    assert index.match(located(43.66, -79.38)) == (None, None)
+
+
+def test_zero_tolerance_matches_exact_coordinates_only():
+    index = PlaceIndex(PLACES, tolerance=0)
+    place, how = index.match(located(43.6557, -79.3846061))
+    assert (place["place_id"], how) == ("b", "location")
+    assert index.match(located(43.65568, -79.3846061)) == (None, None)
+
+
+def test_negative_tolerance_is_rejected():
+    with pytest.raises(ValueError):
+        PlaceIndex(PLACES, tolerance=-1)
@@ -0,0 +1,50 @@
+import json
+
+from activity_sink import ActivitySink, chunk_key
+
+BUSINESS = {"business_id": "b1"}
+
+
+def chunk(text, index=0):
+    return {"business": BUSINESS, "page": {"url": "https://example.com/rooms", "content_hash": "h"},
+            "index": index, "text": text}
+
+
+def names(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [activity["name"] for activity in json.load(f)]
+
+
+def test_resume_after_page_change_drops_stale_chunks(tmp_path):
+    log, output = str(tmp_path / "activities.jsonl"), str(tmp_path / "activities.json")
+    old, other = chunk("Old room text"), chunk("Unchanged second chunk", index=1)
+
+    sink = ActivitySink(log)
+    sink.start()
+    sink.write(chunk_key(old), [{"name": "OldRoom"}])
+    sink.write(chunk_key(other), [{"name": "OtherRoom"}])
+    sink.close()  # Interrupted before finalize
+
+    new = chunk("New room text")
+    sink = ActivitySink(log)
+    completed = sink.start()
+    assert chunk_key(new) not in completed
+    assert chunk_key(other) in completed
+    sink.write(chunk_key(new), [{"name": "NewRoom"}])
+    sink.keep(chunk_key(other))
+    assert sink.finalize(output) == 2
+    assert names(output) == ["OtherRoom", "NewRoom"]
+
+
+def test_completed_run_starts_fresh(tmp_path):
+    log, output = str(tmp_path / "activities.jsonl"), str(tmp_path / "activities.json")
+    sink = ActivitySink(log)
+    sink.start()
+    sink.write(chunk_key(chunk("a")), [{"name": "A"}])
+    sink.finalize(output)
+
+    sink = ActivitySink(log)
+    assert sink.start() == set()
+    sink.write(chunk_key(chunk("b")), [{"name": "B"}])
+    sink.finalize(output)
+    assert names(output) == ["B"]
@@ -0,0 +1,57 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from scrape_output import iter_records
+from stub_sites import generated_page, timed_crawl
+
+HOME = (b'<html><body><h1>Escape rooms</h1><p>' + b'Four escape rooms, 60 minutes each, for 2-6 players. ' * 4 +
+        b'</p><a href="/rooms/">Our rooms</a> <a href="/games/?sort=new&amp;city=toronto">Games</a></body></html>')
+
+
+class SlashSite:
+    """A site whose pages live at paths ending in "/" and that redirects the slashless form."""
+
+    def __init__(self):
+        self.paths = []
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                site.paths.append(self.path)
+                path, _, query = self.path.partition("?")
+                if path == "/robots.txt":
+                    self.send_error(404)
+                elif path in ("/rooms", "/games"):
+                    self.send_response(301)
+                    self.send_header("Location", path + "/" + ("?" + query if query else ""))
+                    self.end_headers()
+                else:
+                    body = HOME if path == "/" else generated_page(path, 1, 2)
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/html")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.urls = [f"http://127.0.0.1:{self.server.server_port}/"]
+
+
+def test_links_are_requested_as_written(tmp_path):
+    site = SlashSite()
+    threading.Thread(target=site.server.serve_forever, daemon=True).start()
+    pages_file = str(tmp_path / "pages.jsonl")
+    try:
+        timed_crawl(site, 4, pages_file=pages_file)
+    finally:
+        site.server.shutdown()
+        site.server.server_close()
+
+    assert "/rooms/" in site.paths
+    assert "/games/?sort=new&city=toronto" in site.paths
+    assert "/rooms" not in site.paths
+    urls = {record["url"] for _, record in iter_records(pages_file) if record.get("type") == "page"}
+    assert len(urls) == 3
@@ -0,0 +1,60 @@
+import json
+
+import chunk_filter
+from chunk_filter import ChunkFilter, calibrate, keyword_score
+
+ROOMS = "Jungle Safari: 60 min, 2-6 players, $30 per person, difficulty 4/5. Book now!"
+COOKIES = " We use cookies; see our privacy policy and cookie settings."
+
+
+def task(text, index=0):
+    return {"business": {"business_id": "b1"}, "page": {"url": "https://example.com/rooms"}, "index": index,
+            "text": text, "relevance": keyword_score(text)}
+
+
+def logged(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_cookie_banner_does_not_hide_activities():
+    assert keyword_score(ROOMS + COOKIES) == keyword_score(ROOMS)
+    assert keyword_score("Careers: we are hiring, apply now" + COOKIES) < 0
+
+
+def test_failed_calls_are_not_logged_as_negatives(tmp_path):
+    shadow_log = str(tmp_path / "shadow.jsonl")
+    shadow = ChunkFilter(shadow_log=shadow_log)
+    shadow.record(task(ROOMS), None)
+    shadow.record(task("Contact us", index=1), [])
+    assert [record["text"] for record in logged(shadow_log)] == ["Contact us"]
+    assert shadow.stats["kept"] + shadow.stats["skipped"] == 1
+
+
+def test_shadow_log_keeps_each_chunk_once_across_runs(tmp_path, monkeypatch):
+    shadow_log = str(tmp_path / "shadow.jsonl")
+    for _ in range(2):
+        shadow = ChunkFilter(shadow_log=shadow_log)
+        shadow.record(task(ROOMS), [{"name": "Jungle Safari"}])
+    assert len(logged(shadow_log)) == 1
+
+    monkeypatch.setattr(chunk_filter, "SHADOW_LOG_MAX_RECORDS", 2)
+    capped = ChunkFilter(shadow_log=shadow_log)
+    for index in range(1, 5):
+        capped.record(task(f"Chunk {index}", index=index), [])
+    assert len(logged(shadow_log)) == 2
+
+
+def test_calibrate_scores_the_crawled_text(tmp_path):
+    pages_file, activities_file = tmp_path / "pages.jsonl", tmp_path / "activities.json"
+    pages = [("https://example.com/rooms", "Our rooms. " + ROOMS * 3),
+             ("https://example.com/story", "Once upon a time a pirate hid his treasure in the old harbour. " * 3),
+             ("https://example.com/jobs", "Careers: we are hiring game masters, apply now with your resume. " * 3)]
+    pages_file.write_text("".join(json.dumps({"type": "page", "url": url, "content": content}) + "\n"
+                                  for url, content in pages))
+    activities_file.write_text(json.dumps([{"name": "Jungle Safari", "source_url": pages[0][0]},
+                                           {"name": "Treasure", "source_url": pages[1][0]}]))
+
+    recalls = calibrate(None, str(pages_file), str(activities_file), thresholds=(0.0, 1.0))
+    # The story page has activities but no activity signals, so any positive threshold loses it
+    assert recalls["pages"] == {0.0: 1.0, 1.0: 0.5}
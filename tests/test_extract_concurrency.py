@@ -0,0 +1,122 @@
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ollama
+import pytest
+
+import extract_activities
+from extract_activities import extract_concurrently
+
+SEGMENT = re.compile(r"### Segment (\d+)\n(.*?)(?=\n\n### Segment |\Z)", re.S)
+
+
+class MockOllama:
+    """Answers /api/chat like a streaming Ollama server, one activity per segment of the prompt.
+
+    A segment containing "delay=<seconds>" is answered that much later, so chunks can be
+    made to finish out of order. Tracks how many calls were in flight at once.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with mock.lock:
+                    mock.calls += 1
+                    mock.in_flight += 1
+                    mock.max_in_flight = max(mock.max_in_flight, mock.in_flight)
+                try:
+                    segments = SEGMENT.findall(request["messages"][-1]["content"])
+                    delay = max((float(d) for _, text in segments for d in re.findall(r"delay=([\d.]+)", text)),
+                                default=0.01)
+                    time.sleep(delay)
+                    answer = json.dumps([{"segment": int(number), "name": text.split()[0], "description": text}
+                                         for number, text in segments])
+                    parts = [answer[i:i + 16] for i in range(0, len(answer), 16)]
+                    lines = [{"model": request["model"], "message": {"role": "assistant", "content": part},
+                              "done": False} for part in parts]
+                    lines.append({"model": request["model"], "message": {"role": "assistant", "content": ""},
+                                  "done": True, "eval_count": len(parts), "prompt_eval_count": 100})
+                    body = "".join(json.dumps(line) + "\n" for line in lines).encode()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/x-ndjson")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                finally:
+                    with mock.lock:
+                        mock.in_flight -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def host(self):
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+
+@pytest.fixture
+def mock_ollama(monkeypatch):
+    mock = MockOllama()
+    threading.Thread(target=mock.server.serve_forever, daemon=True).start()
+    monkeypatch.setenv("OLLAMA_HOST", mock.host)
+    # The module-level client read OLLAMA_HOST at import; a new one picks up the stub
+    monkeypatch.setattr(extract_activities.ollama, "chat", ollama.Client().chat)
+    yield mock
+    mock.server.shutdown()
+    mock.server.server_close()
+
+
+def chunk_tasks(delays, business=None):
+    business = business or {"business_id": "b1", "name": "Business"}
+    return [{"business": business, "page": {"url": f"https://example.com/{i}"}, "index": i,
+             "text": f"room{i} is a 60 minute escape room delay={delay}"} for i, delay in enumerate(delays)]
+
+
+def test_results_come_back_in_task_order(mock_ollama):
+    # Earlier chunks are slower, so the LLM finishes them last
+    tasks = chunk_tasks([0.4, 0.3, 0.2, 0.1, 0.05, 0.01, 0.01, 0.01])
+    results = list(extract_concurrently(tasks, concurrency=4))
+
+    assert [task["index"] for task, _ in results] == list(range(len(tasks)))
+    assert [activities[0]["name"] for _, activities in results] == [f"room{i}" for i in range(len(tasks))]
+    assert mock_ollama.max_in_flight == 4
+
+
+def test_slow_chunk_applies_backpressure(mock_ollama):
+    pulled = []
+
+    def tasks():
+        for task in chunk_tasks([1.0] + [0.01] * 30):
+            pulled.append(task["index"])
+            yield task
+
+    results = extract_concurrently(tasks(), concurrency=4, max_pending=6)
+    first_task, _ = next(results)
+    # The slow first chunk holds the read-ahead at max_pending tasks
+    assert first_task["index"] == 0
+    assert len(pulled) == 6
+    assert len(list(results)) == 30
+    assert len(pulled) == 31
+
+
+def test_batched_chunks_are_split_back_per_task(mock_ollama):
+    tasks = chunk_tasks([0.01] * 6)
+    results = list(extract_concurrently(tasks, concurrency=2, batch_tokens=10000))
+
+    assert mock_ollama.calls == 1
+    assert [activities[0]["name"] for _, activities in results] == [f"room{i}" for i in range(6)]
@@ -0,0 +1,73 @@
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import find_places
+
+LATENCY = 0.05  # Seconds the stub takes to answer, roughly a real Place Details round trip
+PLACE_IDS = [f"place-{i}" for i in range(40)]
+
+
+@pytest.fixture
+def places_api(monkeypatch):
+    """A local Places API stub; find_places is pointed at it as PLACES_API_URL would do."""
+    calls = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            params = dict(urllib.parse.parse_qsl(url.query))
+            calls.append((url.path, params))
+            time.sleep(LATENCY)
+            if url.path == "/details/json":
+                body = {"status": "OK", "result": {"website": f"https://{params['place_id']}.example"}}
+            else:
+                body = {"status": "INVALID_REQUEST"}
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(find_places, "PLACES_API_URL", f"http://127.0.0.1:{server.server_port}")
+    yield calls
+    server.shutdown()
+    server.server_close()
+
+
+def timed_details(workers):
+    start = time.perf_counter()
+    websites = find_places.get_places_details("test-key", PLACE_IDS, workers=workers, qps=1000)
+    return websites, time.perf_counter() - start
+
+
+def test_details_keep_input_order(places_api):
+    websites, _ = timed_details(workers=8)
+    assert websites == [f"https://{place_id}.example" for place_id in PLACE_IDS]
+    assert len(places_api) == len(PLACE_IDS)
+
+
+def test_details_scale_with_workers(places_api):
+    timings = {workers: timed_details(workers)[1] for workers in (1, 2, 4, 8)}
+    print(" ".join(f"{workers} workers: {elapsed:.2f}s" for workers, elapsed in timings.items()))
+    # One worker pays every round trip in turn; eight overlap them
+    assert timings[1] >= len(PLACE_IDS) * LATENCY
+    assert timings[8] < timings[1] / 4
+
+
+def test_details_respect_qps(places_api):
+    start = time.perf_counter()
+    find_places.get_places_details("test-key", PLACE_IDS, workers=8, qps=20)
+    # The bucket starts full, so the first 20 go at once and the other 20 take a second
+    assert time.perf_counter() - start >= (len(PLACE_IDS) - 20) / 20 * 0.9
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+import extract_activities
+from extract_activities import extract_with_llm, stream_activities
+from llm_stream import LLM_STREAM_REPORT
+
+
+class FakeChat:
+    """Stands in for ollama.chat(stream=True), streaming `answer` in small parts and counting those sent."""
+
+    def __init__(self, answer, part_size=8):
+        self.parts = [answer[i:i + part_size] for i in range(0, len(answer), part_size)]
+        self.sent = 0
+
+    def __call__(self, **kwargs):
+        for part in self.parts:
+            self.sent += 1
+            yield {"message": {"role": "assistant", "content": part}, "done": False}
+
+
+@pytest.fixture
+def report():
+    before = dict(LLM_STREAM_REPORT)
+    yield lambda key: LLM_STREAM_REPORT[key] - before[key]
+
+
+def activities_json(*segments):
+    return json.dumps([{"segment": segment, "name": f"Room {i}"} for i, segment in enumerate(segments)])
+
+
+def test_activities_are_yielded_as_they_close(monkeypatch, report):
+    chat = FakeChat(activities_json(1, 2, 2))
+    monkeypatch.setattr(extract_activities.ollama, "chat", chat)
+
+    activities = stream_activities(["room 0", "rooms 1 and 2"])
+    assert next(activities) == (0, {"name": "Room 0"})
+    # Only the parts up to the first closed object have been read
+    assert chat.sent < len(chat.parts) / 2
+    assert list(activities) == [(1, {"name": "Room 1"}), (1, {"name": "Room 2"})]
+    assert chat.sent == len(chat.parts)
+    assert (report("calls"), report("chunks"), report("activities")) == (1, 2, 3)
+
+
+def test_metrics_are_reported_per_chunk(monkeypatch, report):
+    broken = '[{"segment": 1, "name": "Room 0"}, {"segment": 2, "name": }, ' + " " * 40
+    monkeypatch.setattr(extract_activities.ollama, "chat", FakeChat(broken))
+
+    assert extract_with_llm(["room 0", "room 1", "room 2"]) == [[{"name": "Room 0"}], [], []]
+    assert (report("calls"), report("chunks"), report("parse_failures")) == (1, 3, 1)
+    # Everything streamed after the last good object is wasted
+    assert report("wasted_tokens") > 0
@@ -0,0 +1,21 @@
+import os
+
+from scrape_output import iter_records
+from scrapy_website_scraper import run_sharded_crawl
+from stub_sites import StubSites, load_fixtures, site_records
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "html_fixtures")
+
+
+def test_shards_store_every_page_once(tmp_path):
+    pages_file = str(tmp_path / "pages.jsonl")
+    with StubSites(hosts=12, pages=3, latency=0.01, bodies=load_fixtures(FIXTURES)) as sites:
+        records = site_records(sites.urls)
+        run_sharded_crawl(records, 3, None, pages_file, 1, str(tmp_path / "jobs"), "density", 25)
+
+    pages = [record for _, record in iter_records(pages_file) if record.get("type") == "page"]
+    done = {record["business_id"] for _, record in iter_records(pages_file) if record.get("type") == "business_done"}
+    assert sites.requests == 12 * 3
+    assert len(pages) == len({page["url"] for page in pages}) == 12 * 3
+    assert done == {record["business_id"] for record in records}
+    assert all("error" not in record for record in records)
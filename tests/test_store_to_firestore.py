@@ -0,0 +1,92 @@
+import pytest
+
+pytest.importorskip("firebase_admin")
+pytest.importorskip("google.api_core")
+
+from google.api_core import exceptions
+
+import store_to_firestore
+from store_to_firestore import FakeFirestore, UploadState, document_id, upload_activities
+
+
+def activity(i, description="Solve the puzzles in 60 minutes."):
+    return {"activity_name": f"Room {i}", "place_id": f"place-{i // 3}", "description": description}
+
+
+class FlakyFirestore(FakeFirestore):
+    """Fails the first `failures` commits with a retryable error."""
+
+    def __init__(self, failures):
+        super().__init__(latency=0)
+        self.failures = failures
+
+    def _commit(self, writes):
+        if self.failures:
+            self.failures -= 1
+            raise exceptions.ServiceUnavailable("simulated outage")
+        super()._commit(writes)
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(store_to_firestore, "RETRY_BACKOFF", 0)
+
+
+@pytest.fixture
+def state(tmp_path):
+    state = UploadState(tmp_path / "uploads.db")
+    yield state
+    state.close()
+
+
+def test_document_id_is_deterministic():
+    assert document_id(activity(1)) == document_id(activity(1))
+    assert document_id(activity(1)) == document_id({**activity(1), "activity_name": "  room 1 "})
+    assert document_id(activity(1)) == document_id(activity(1, description="Edited."))
+    assert document_id(activity(1)) != document_id(activity(2))
+    located = {"name": "Room", "latitude": 43.6, "longitude": -79.4}
+    assert document_id(located) == document_id(dict(located))
+
+
+def test_rerun_upserts_instead_of_adding_copies():
+    db = FakeFirestore(latency=0)
+    activities = [activity(i) for i in range(10)]
+    upload_activities(db, activities)
+    edited = [activity(i, description="Now with a second room.") for i in range(10)]
+    counts = upload_activities(db, edited)
+    assert counts["written"] == 10
+    assert len(db.documents) == 10
+    assert all(doc["description"] == "Now with a second room." for doc in db.documents.values())
+
+
+def test_unchanged_documents_are_skipped(state):
+    db = FakeFirestore(latency=0)
+    activities = [activity(i) for i in range(10)]
+    assert upload_activities(db, activities, state=state)["written"] == 10
+    activities[3] = activity(3, description="Edited.")
+    counts = upload_activities(db, activities, state=state)
+    assert (counts["unchanged"], counts["written"]) == (9, 1)
+    assert db.commits == 2
+
+
+def test_retryable_failures_are_retried(state):
+    db = FlakyFirestore(failures=2)
+    counts = upload_activities(db, [activity(i) for i in range(5)], state=state)
+    assert (counts["written"], counts["failed"]) == (5, 0)
+    assert len(db.documents) == 5
+
+
+def test_batch_that_keeps_failing_is_counted_and_not_recorded(state):
+    db = FlakyFirestore(failures=store_to_firestore.MAX_RETRIES + 1)
+    counts = upload_activities(db, [activity(i) for i in range(5)], state=state)
+    assert (counts["written"], counts["failed"]) == (0, 5)
+    assert state.uploaded_hashes(store_to_firestore.COLLECTION) == {}
+    assert upload_activities(db, [activity(i) for i in range(5)], state=state)["written"] == 5
+
+
+def test_writes_are_split_into_batches_of_500():
+    db = FakeFirestore(latency=0)
+    counts = upload_activities(db, [activity(i) for i in range(1200)])
+    assert counts["written"] == 1200
+    assert db.commits == 3
+    assert len(db.documents) == 1200
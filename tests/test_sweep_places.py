@@ -0,0 +1,78 @@
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import find_places
+
+LATENCY = 0.1
+
+
+@pytest.fixture
+def nearby_api(monkeypatch):
+    """A nearby search stub: tiles north of 43.5 are denied, the first call for each other tile fails."""
+    calls = {}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            params = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+            location = params["location"]
+            with lock:
+                calls[location] = calls.get(location, 0) + 1
+                attempt = calls[location]
+            time.sleep(LATENCY)
+            if float(location.split(",")[0]) > 43.5:
+                body = {"status": "REQUEST_DENIED", "error_message": "denied"}
+            elif attempt == 1:
+                body = {"status": "UNKNOWN_ERROR"}
+            else:
+                body = {"status": "OK", "results": [{"place_id": location}]}
+            data = json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(find_places, "PLACES_API_URL", f"http://127.0.0.1:{server.server_port}")
+    monkeypatch.setattr(find_places, "PAGE_TOKEN_DELAY", 0.05)
+    yield calls
+    server.shutdown()
+    server.server_close()
+
+
+def test_large_boxes_are_split_to_the_radius_limit():
+    tiles = find_places.initial_tiles((43.0, -80.0, 44.0, -79.0))
+    assert len(tiles) == 4
+    assert all(find_places.tile_center_and_radius(tile)[1] <= find_places.MAX_TILE_RADIUS for tile in tiles)
+
+
+def test_failed_tiles_are_retried_then_reported(nearby_api, capsys):
+    places = list(find_places.sweep_places("key", (43.0, -80.0, 44.0, -79.0), "escape room", workers=2))
+
+    assert len(places) == 2  # The two tiles south of 43.5, each on its second attempt
+    assert sorted(nearby_api.values()) == [2, 2, 3, 3]
+    out = capsys.readouterr().out
+    assert "Swept 2 tiles" in out
+    assert "2 tiles failed" in out
+
+
+def test_full_pool_waits_instead_of_spinning(nearby_api, monkeypatch):
+    bounds = (43.0, -80.0, 43.5, -79.0)  # South of the denied band
+    initial_tiles = find_places.initial_tiles
+    monkeypatch.setattr(find_places, "initial_tiles", lambda box: initial_tiles(box, max_radius=15000))
+    tiles = len(initial_tiles(bounds, max_radius=15000))
+    wall, cpu = time.perf_counter(), time.process_time()
+    list(find_places.sweep_places("key", bounds, "escape room", workers=2, cache=None))
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    assert tiles >= 8
+    assert cpu < wall / 4
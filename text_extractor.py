@@ -0,0 +1,168 @@
+import hashlib
+import os
+import re
+import sys
+import time
+
+SKIP_TAGS = {
+    "script", "style", "noscript", "template", "svg", "iframe", "form", "button", "select",
+    "nav", "footer", "aside",
+}
+PAGE_HEADER_TAG = "header"  # Skipped as page chrome, except inside a content section where it holds titles
+CONTENT_SECTION_TAGS = {"article", "main", "section"}
+BLOCK_TAGS = {
+    "address", "article", "blockquote", "dd", "details", "div", "dl", "dt", "figcaption", "h1", "h2", "h3",
+    "h4", "h5", "h6", "li", "main", "ol", "p", "pre", "section", "summary", "table", "td", "th", "tr", "ul",
+}
+HEADING_TAGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+# class/id words that mark navigation, banners and other chrome
+BOILERPLATE_PATTERN = re.compile(
+    r"(?:^|[\s_-])(?:cookies?|consent|gdpr|nav|navbar|navigation|menu|footer|breadcrumbs?|sidebar|social|share|"
+    r"newsletter|popup|modal)(?:$|[\s_-])",
+    re.IGNORECASE,
+)
+
+MIN_BLOCK_CHARS = 10  # Shorter blocks are kept only if they contain a number ("60 min", "4/5")
+MAX_LINK_DENSITY = 0.5  # Share of a block's text that may be link text
+MIN_REPEATED_CHARS = 40  # Repeated short blocks are usually data ("Max 9 players"), not boilerplate
+
+
+def extract_xpath_text(response):
+    """The original content-container / element-text / whole-body XPath chain."""
+    main_content = response.xpath(
+        '//*[self::main or self::article or self::section or self::div][contains(@class, "content") or contains(@class, "main") or contains(@class, "article") or contains(@class, "body")]')
+
+    if main_content:
+        text = ' '.join(main_content.xpath('.//text()').getall())
+        text = ' '.join(text.split())
+        if len(text) > 200:
+            return text
+
+    # Fallback: get text from common content elements
+    content_elements = response.xpath(
+        '//*[self::p or self::li or self::h1 or self::h2 or self::h3 or self::h4 or self::h5 or self::span or self::div]/text()').getall()
+    text = ' '.join([el.strip() for el in content_elements if len(el.strip()) > 20])
+
+    # If still not enough content, get all text
+    if len(text) < 200:
+        text = ' '.join(response.xpath('//body//text()').getall())
+        text = ' '.join(text.split())
+
+    return text
+
+
+class DensityExtractor:
+    """Single-pass DOM text extractor that keeps dense text blocks and drops boilerplate.
+
+    One instance is used per site: blocks of a page that were already emitted for another
+    page of the same site (headers, footers, address blurbs) are dropped.
+    """
+
+    def __init__(self):
+        self.seen_blocks = set()
+
+    def extract(self, root):
+        """Returns the content text of an lxml document, one block per line."""
+        body = root.find("body")
+        blocks = []
+        self._walk(body if body is not None else root, blocks, [0], False, False)
+        blocks.sort()
+
+        kept, page_hashes = [], set()
+        for _, tag, text, link_chars in blocks:
+            if not self._is_content(tag, text, link_chars):
+                continue
+            if len(text) >= MIN_REPEATED_CHARS:
+                block_hash = hashlib.md5(text.lower().encode("utf-8")).digest()
+                if block_hash in self.seen_blocks:
+                    continue
+                page_hashes.add(block_hash)
+            kept.append(text)
+
+        self.seen_blocks.update(page_hashes)
+        return "\n".join(kept)
+
+    def _walk(self, element, blocks, counter, in_link, in_section, block=None):
+        """Collects (order, tag, text, link_chars) for every block below `element`."""
+        tag = element.tag.lower() if isinstance(element.tag, str) else None
+        if block is None or tag in BLOCK_TAGS:
+            counter[0] += 1
+            block = [counter[0], tag, [], 0]
+            own_block = True
+        else:
+            own_block = False
+        in_link = in_link or tag == "a"
+        in_section = in_section or tag in CONTENT_SECTION_TAGS
+
+        self._add_text(block, element.text, in_link)
+        for child in element:
+            child_tag = child.tag.lower() if isinstance(child.tag, str) else None
+            if (child_tag is not None and child_tag not in SKIP_TAGS and not self._is_boilerplate(child)
+                    and (child_tag != PAGE_HEADER_TAG or in_section)):
+                self._walk(child, blocks, counter, in_link, in_section, block)
+            # Text after a child belongs to this element, even when the child itself is skipped
+            self._add_text(block, child.tail, in_link)
+
+        if own_block:
+            text = " ".join(" ".join(block[2]).split())
+            if text:
+                blocks.append((block[0], block[1], text, block[3]))
+
+    @staticmethod
+    def _add_text(block, text, in_link):
+        if text and not text.isspace():
+            block[2].append(text)
+            if in_link:
+                block[3] += len(text.strip())
+
+    @staticmethod
+    def _is_boilerplate(element):
+        marker = f"{element.get('class', '')} {element.get('id', '')} {element.get('role', '')}"
+        return bool(marker.strip()) and BOILERPLATE_PATTERN.search(marker) is not None
+
+    @staticmethod
+    def _is_content(tag, text, link_chars):
+        if tag in HEADING_TAGS:
+            return True  # Activity names are often linked headings on listing pages
+        if link_chars / len(text) > MAX_LINK_DENSITY:
+            return False
+        return len(text) >= MIN_BLOCK_CHARS or any(char.isdigit() for char in text)
+
+
+def benchmark_extractors(fixture_dir):
+    """Compares pages/s and characters emitted per page of both extractors on saved .html files.
+
+    Files sharing a name prefix up to the first "-" are pages of one site and share a
+    DensityExtractor, as they would in one BusinessSpider crawl.
+    """
+    from lxml import html
+    from scrapy.http import HtmlResponse
+
+    pages = []  # (site, body)
+    for name in sorted(os.listdir(fixture_dir)):
+        if name.endswith((".html", ".htm")):
+            with open(os.path.join(fixture_dir, name), "rb") as f:
+                pages.append((name.split("-", 1)[0], f.read()))
+    if not pages:
+        print(f"No .html fixtures found in {fixture_dir}")
+        return
+
+    def run_xpath(site, body):
+        return extract_xpath_text(HtmlResponse(url="http://fixture/", body=body, encoding="utf-8"))
+
+    extractors = {}
+
+    def run_density(site, body):
+        if site not in extractors:
+            extractors[site] = DensityExtractor()
+        return extractors[site].extract(html.fromstring(body))
+
+    for name, run in (("xpath", run_xpath), ("density", run_density)):
+        start = time.perf_counter()
+        characters = sum(len(run(site, body)) for site, body in pages)
+        elapsed = time.perf_counter() - start
+        print(f"{name:>8}: {len(pages) / elapsed:8.1f} pages/s, {characters / len(pages):8.0f} chars/page")
+
+
+if __name__ == "__main__":
+    benchmark_extractors(sys.argv[1] if len(sys.argv) > 1 else "html_fixtures")